@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the transcription server, for benchmarks and development.
+
+It implements the job, query, webhook and token endpoints used by the SDK.
+Jobs "complete" after a configurable delay, then the webhooks given at
+creation are called back like the real server does. Run it standalone with:
+
+    $ python benchmarks/mock_server.py [--port 8080] [--delay 0.5] ...
+
+or embed it with MockTranscriptionServer(...).start().
+"""
+from gevent import monkey
+
+if __name__ == "__main__":
+    monkey.patch_all()
+
+import gevent
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from flask import Flask, Response, jsonify, request
+import requests
+import urllib3
+
+import argparse
+import itertools
+import json
+import logging
+import random
+import socket
+import uuid
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+def _now():
+    return datetime.now(timezone.utc)
+
+
+class MockTranscriptionServer:
+    """
+    In-process mock of the transcription server.
+
+    Parameters
+    ----------
+    host, port : str, int
+        Listening address. Port 0 picks a free port, see `url`.
+    delay : float
+        Processing time of every job, in seconds.
+    jitter : float
+        Random extra processing time, uniform between 0 and `jitter`.
+    rtf : float
+        Extra processing time per second of audio, for 16-bit PCM WAV uploads.
+    workers : int, optional
+        Jobs processed at the same time. Others wait in a queue. If None, all
+        jobs are processed at once.
+    segments : int
+        Number of segments in each result, to control the payload size.
+    token_ttl : float, optional
+        Lifetime of the tokens of /auth/token. If set, requests without a
+        valid token are refused with 401.
+    webhook_retries : int
+        Attempts to deliver each webhook which fails or answers 5xx.
+    max_queue : int, optional
+        Jobs waiting for a worker beyond which new jobs are refused with 503.
+        Only meaningful with `workers`.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        delay=0.5,
+        jitter=0.0,
+        rtf=0.0,
+        workers=None,
+        segments=10,
+        token_ttl=None,
+        webhook_retries=5,
+        max_queue=None,
+    ):
+        self._log = logging.getLogger("mock_server")
+        self.delay = delay
+        self.jitter = jitter
+        self.rtf = rtf
+        self.segments = segments
+        self.token_ttl = token_ttl
+        self.webhook_retries = webhook_retries
+        self.max_queue = max_queue
+        self._queued = 0
+
+        self.jobs = {}  # job_id -> job document
+        self._results = {}  # job_id -> segments
+        self._webhook_tokens = {}  # "host:port" -> validation token
+        self._tokens = {}  # access token -> expiration
+        self._processing = Pool(workers)
+        self._session = requests.Session()
+        self._session.mount(
+            "http://", requests.adapters.HTTPAdapter(pool_maxsize=100)
+        )
+        self._session.mount(
+            "https://", requests.adapters.HTTPAdapter(pool_maxsize=100)
+        )
+        self.stats = {"created": 0, "refused": 0, "webhooks": 0, "webhook_errors": 0}
+
+        self.app = self._create_app()
+        # Without TCP_NODELAY, responses written in several sends wait for
+        # delayed ACKs of the client, adding ~40 ms to every request.
+        family = socket.AF_INET6 if ":" in host else socket.AF_INET
+        listener = WSGIServer.get_listener((host, port), family=family)
+        listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._server = WSGIServer(listener, self.app, log=None)
+
+    @property
+    def url(self):
+        host, port = self._server.address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self._server.start()
+        return self
+
+    def stop(self):
+        self._server.stop()
+        self._processing.kill()
+
+    def serve_forever(self):
+        self._server.serve_forever()
+
+    def _create_app(self):
+        app = Flask("mock_server")
+
+        @app.before_request
+        def check_token():
+            if self.token_ttl is None or request.path == "/auth/token":
+                return None
+            token = request.headers.get("Authorization", "")[len("Bearer ") :]
+            expiration = self._tokens.get(token)
+            if expiration is None or expiration < _now().timestamp():
+                return "Invalid token", 401
+            return None
+
+        @app.route("/auth/token", methods=["POST"])
+        def auth_token():
+            token = uuid.uuid4().hex
+            ttl = self.token_ttl or 3600
+            self._tokens[token] = _now().timestamp() + ttl
+            return jsonify(access_token=token, expires_in=ttl)
+
+        @app.route("/webhook/whoami")
+        def whoami():
+            return jsonify(address=request.remote_addr)
+
+        @app.route("/webhook/validate", methods=["GET", "POST"])
+        def validate():
+            url = urlparse(request.args["url"])
+            token = (request.get_json(silent=True) or {}).get("token")
+            self._webhook_tokens[url.netloc] = token
+            try:
+                port = url.port or (443 if url.scheme == "https" else 80)
+                socket.create_connection((url.hostname, port), timeout=5).close()
+                reachable = True
+            except OSError:
+                reachable = False
+            return jsonify(url=request.args["url"], reachable=reachable)
+
+        @app.route("/job/create", methods=["POST"])
+        def create():
+            if self.max_queue is not None and self._queued >= self.max_queue:
+                self.stats["refused"] += 1
+                return "Server busy", 503
+            upload = request.files["upload_file"]
+            audio = upload.read()
+            callbacks = request.form.get("callback_urls", "")
+            job = {
+                "id": uuid.uuid4().hex,
+                "status": "SENT",
+                "filename": upload.filename,
+                "tag": request.args.get("tag"),
+                "config": request.form.getlist("config"),
+                "created_at": _now().isoformat(),
+            }
+            self.jobs[job["id"]] = job
+            self.stats["created"] += 1
+            urls = [u for u in callbacks.split(",") if u]
+            self._queued += 1
+            gevent.spawn(self._enqueue, job, len(audio), urls)
+            return jsonify(job=job)
+
+        @app.route("/job")
+        def list_jobs():
+            page = int(request.args.get("page", 1))
+            limit = int(request.args.get("limit", 100))
+            tag = request.args.get("tag")
+            jobs = [j for j in self.jobs.values() if tag is None or j["tag"] == tag]
+            return jsonify(jobs=jobs[(page - 1) * limit : page * limit])
+
+        @app.route("/job/status/<job_id>")
+        def status(job_id):
+            if job_id not in self.jobs:
+                return "Job not found", 404
+            return jsonify(job=self.jobs[job_id])
+
+        @app.route("/job/result/<job_id>")
+        def result(job_id):
+            if job_id not in self.jobs:
+                return "Job not found", 404
+            return jsonify(self._result(job_id))
+
+        @app.route("/job/stop/<job_id>", methods=["POST"])
+        @app.route("/job/retry/<job_id>", methods=["POST"])
+        def stop_or_retry(job_id):
+            if job_id not in self.jobs:
+                return "Job not found", 404
+            return jsonify(job=self.jobs[job_id])
+
+        @app.route("/job/<job_id>", methods=["DELETE"])
+        def delete(job_id):
+            if self.jobs.pop(job_id, None) is None:
+                return "Job not found", 404
+            self._results.pop(job_id, None)
+            return jsonify(deleted=job_id)
+
+        @app.route("/query/job")
+        def query():
+            statuses = request.args.getlist("status")
+            tags = request.args.getlist("tag")
+            projection = request.args.getlist("projection")
+            page = int(request.args.get("page", 1))
+            limit = int(request.args.get("limit", 100))
+            start = request.args.get("start_date")
+            end = request.args.get("end_date")
+            start = datetime.fromisoformat(start) if start else None
+            end = datetime.fromisoformat(end) if end else None
+
+            def matches(job):
+                created = datetime.fromisoformat(job["created_at"])
+                return (
+                    (not statuses or job["status"] in statuses)
+                    and (not tags or job["tag"] in tags)
+                    and (start is None or created >= start)
+                    and (end is None or created < end)
+                )
+
+            jobs = itertools.islice(
+                filter(matches, list(self.jobs.values())),
+                (page - 1) * limit,
+                page * limit,
+            )
+            lines = []
+            for job in jobs:
+                if projection:
+                    job = {k: v for k, v in job.items() if k in projection}
+                lines.append(json.dumps({"job": job}) + "\n")
+            return Response(lines, mimetype="application/x-ndjson")
+
+        return app
+
+    def _result(self, job_id):
+        return {"job": self.jobs[job_id], "segments": self._results.get(job_id, [])}
+
+    def _enqueue(self, job, size, urls):
+        # Blocks while all workers are busy
+        try:
+            self._processing.spawn(self._process, job, size, urls)
+        finally:
+            self._queued -= 1
+
+    def _process(self, job, size, urls):
+        job["status"] = "TRANSCRIBING"
+        duration = max(0, size - 44) / 16000  # 8 kHz, 16-bit PCM
+        gevent.sleep(
+            self.delay + random.uniform(0, self.jitter) + self.rtf * duration
+        )
+        if job["id"] not in self.jobs:
+            return  # Deleted while processing
+        self._results[job["id"]] = [
+            {
+                "start_time": i,
+                "end_time": i + 1,
+                "text": "segmento {} da transcrição".format(i),
+                "score": 90,
+            }
+            for i in range(self.segments)
+        ]
+        job["status"] = "COMPLETED"
+        job["updated_at"] = _now().isoformat()
+
+        # Named callbacks first, then the root webhook, as the job is done
+        for url in urls[1:] + urls[:1]:
+            gevent.spawn(self._deliver, url, job["id"])
+
+    def _deliver(self, url, job_id):
+        payload = dict(
+            self._result(job_id), token=self._webhook_tokens.get(urlparse(url).netloc)
+        )
+        for attempt in range(self.webhook_retries):
+            try:
+                r = self._session.post(
+                    "{}/{}".format(url, job_id), json=payload, verify=False, timeout=30
+                )
+                if r.status_code < 500:
+                    self.stats["webhooks"] += 1
+                    return
+            except requests.RequestException as e:
+                self._log.debug("Webhook {} failed: {}".format(url, e))
+            gevent.sleep(0.1 * 2 ** attempt)
+        self.stats["webhook_errors"] += 1
+        self._log.warning("Giving up webhook {} of job {}".format(url, job_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--delay", type=float, default=0.5)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--rtf", type=float, default=0.0)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--segments", type=int, default=10)
+    parser.add_argument("--token-ttl", type=float, default=None)
+    parser.add_argument("--max-queue", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = MockTranscriptionServer(
+        host=args.host,
+        port=args.port,
+        delay=args.delay,
+        jitter=args.jitter,
+        rtf=args.rtf,
+        workers=args.workers,
+        segments=args.segments,
+        token_ttl=args.token_ttl,
+        max_queue=args.max_queue,
+    )
+    server.start()
+    print("Mock transcription server on {}".format(server.url), flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""
+Startup benchmark: import times and webhook certificate creation.
+
+Each import is measured in a fresh interpreter. Run from the repository root:
+
+    $ python benchmarks/startup.py [--repeat N] [--max-import-ms MS]
+
+With --max-import-ms, exits with status 1 if "import cpqdtrd" is slower than
+the given median, so that it can be used to track regressions.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+IMPORTS = [
+    ("import cpqdtrd", "import cpqdtrd"),
+    ("TranscriptionApi", "from cpqdtrd import TranscriptionApi"),
+    ("TranscriptionClient", "from cpqdtrd import TranscriptionClient"),
+]
+
+
+def time_import(statement, repeat):
+    """Median wall time (ms) of a statement in fresh interpreters."""
+    code = (
+        "import time; t = time.perf_counter(); {}; "
+        "print((time.perf_counter() - t) * 1000)".format(statement)
+    )
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    samples = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, "-c", code], env=env)
+        samples.append(float(out))
+    return statistics.median(samples)
+
+
+def time_call(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        t = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t) * 1000)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-import-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    from cpqdtrd.cert import create_self_signed_cert, load_or_create_cert
+
+    results = []
+    for name, statement in IMPORTS:
+        results.append((name, time_import(statement, args.repeat)))
+
+    with tempfile.TemporaryDirectory() as d:
+        cert, key = os.path.join(d, "cert"), os.path.join(d, "key")
+        for key_type in ("rsa", "ec"):
+            results.append(
+                (
+                    "cert {} (ephemeral)".format(key_type),
+                    time_call(
+                        lambda: create_self_signed_cert(
+                            "127.0.0.1", cert, key, key_type=key_type
+                        ),
+                        args.repeat,
+                    ),
+                )
+            )
+        load_or_create_cert("127.0.0.1", d, "rsa")
+        results.append(
+            (
+                "cert rsa (cached)",
+                time_call(lambda: load_or_create_cert("127.0.0.1", d, "rsa"), args.repeat),
+            )
+        )
+
+    width = max(len(name) for name, _ in results)
+    for name, ms in results:
+        print("{:<{}}  {:8.1f} ms".format(name, width, ms))
+
+    if args.max_import_ms is not None and results[0][1] > args.max_import_ms:
+        print(
+            "import cpqdtrd took {:.1f} ms, over the {:.1f} ms limit".format(
+                results[0][1], args.max_import_ms
+            )
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
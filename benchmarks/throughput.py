@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""
+Throughput benchmark of TranscriptionClient against the mock server.
+
+For each combination of concurrent jobs, registered callbacks and audio
+payload size, submits a batch of jobs and reports jobs/s, p50/p99 end-to-end
+latency (upload to result) and the resident memory of the client process.
+The mock server (see mock_server.py) runs in a separate process, so that it
+doesn't compete with the client for the gevent hub. Run from the repository
+root:
+
+    $ python benchmarks/throughput.py [--jobs N] [--concurrency 1 8 64] \\
+        [--callbacks 0 4] [--payload-kb 16 1024] [--delay 0.2] [--json]
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+from gevent.pool import Pool
+
+import argparse
+import io
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+import wave
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cpqdtrd import TranscriptionClient  # noqa: E402
+
+
+def make_audio(kb):
+    """Silent 8 kHz 16-bit mono WAV of about `kb` kilobytes."""
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(8000)
+        w.writeframes(b"\0" * (kb * 1024 // 2 * 2))
+    return buf.getvalue()
+
+
+def rss_mb():
+    """Current resident memory, or the peak where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(samples, q):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_mock_server(args):
+    port = free_port()
+    cmd = [
+        sys.executable,
+        os.path.join(ROOT, "benchmarks", "mock_server.py"),
+        "--port", str(port),
+        "--delay", str(args.delay),
+        "--jitter", str(args.jitter),
+        "--segments", str(args.segments),
+    ]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    process.stdout.readline()  # Printed once listening
+    return process, "http://127.0.0.1:{}".format(port)
+
+
+def run_batch(client, audio, jobs, concurrency):
+    latencies = []
+
+    def job():
+        start = time.perf_counter()
+        client.transcribe(audio, timeout=0)
+        latencies.append(time.perf_counter() - start)
+
+    pool = Pool(concurrency)
+    start = time.perf_counter()
+    for _ in range(jobs):
+        pool.spawn(job)
+    pool.join(raise_error=True)
+    elapsed = time.perf_counter() - start
+    return {
+        "jobs_per_s": jobs / elapsed,
+        "p50_s": percentile(latencies, 0.5),
+        "p99_s": percentile(latencies, 0.99),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--url", help="Use a running server instead of the mock")
+    parser.add_argument("--jobs", type=int, default=200, help="Jobs per scenario")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 64])
+    parser.add_argument("--callbacks", type=int, nargs="+", default=[0, 4])
+    parser.add_argument("--payload-kb", type=int, nargs="+", default=[16, 1024])
+    parser.add_argument("--delay", type=float, default=0.2)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--segments", type=int, default=10)
+    parser.add_argument("--webhook-port", type=int, default=None)
+    parser.add_argument("--json", action="store_true", help="Print JSON lines")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    server = None
+    url = args.url
+    if url is None:
+        server, url = start_mock_server(args)
+
+    try:
+        client = TranscriptionClient(
+            url,
+            webhook_host="127.0.0.1",
+            webhook_port=args.webhook_port or free_port(),
+            webhook_listener="127.0.0.1",
+            webhook_protocol="http",
+            api_kwargs={"pool_maxsize": max(args.concurrency)},
+        )
+        results = []
+        for kb in args.payload_kb:
+            audio = make_audio(kb)
+            for callbacks in args.callbacks:
+                names = [
+                    client.register_callback(lambda job_id, result: None)
+                    for _ in range(callbacks)
+                ]
+                for concurrency in args.concurrency:
+                    jobs = max(args.jobs, concurrency)
+                    row = {
+                        "concurrency": concurrency,
+                        "callbacks": callbacks,
+                        "payload_kb": kb,
+                        "jobs": jobs,
+                    }
+                    row.update(run_batch(client, audio, jobs, concurrency))
+                    row["rss_mb"] = rss_mb()
+                    results.append(row)
+                    if args.json:
+                        print(json.dumps(row), flush=True)
+                    else:
+                        print(
+                            "concurrency {concurrency:4d}  callbacks {callbacks:2d}  "
+                            "payload {payload_kb:6d} KB  {jobs_per_s:8.1f} jobs/s  "
+                            "p50 {p50_s:7.3f} s  p99 {p99_s:7.3f} s  "
+                            "rss {rss_mb:7.1f} MB".format(**row),
+                            flush=True,
+                        )
+                client.unregister_callback(*names)
+        client.stop()
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,26 @@
 # -*- coding: utf-8 -*-
-from .client import TranscriptionClient
-from .api import TranscriptionApi
+import importlib
+
+# Public names are imported on first access, so that "import cpqdtrd" does not
+# pull in flask, gevent and the other heavy dependencies.
+_exports = {
+    "TranscriptionClient": ".client",
+    "TranscriptionApi": ".api",
+    "AsyncTranscriptionApi": ".aio",
+    "AsyncTranscriptionClient": ".aio",
+    "AudioSource": ".audio",
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(_exports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+Concurrency primitives which cooperate with gevent when it is in use.
+
+The API wrapper does not depend on gevent, but must not block the gevent hub
+when used by the client. These helpers use gevent only if the application
+already imported it, and the standard library otherwise.
+"""
+import sys
+import threading
+import time
+
+
+def _gevent():
+    return sys.modules.get("gevent")
+
+
+def sleep(seconds):
+    gevent = _gevent()
+    if gevent is not None:
+        gevent.sleep(seconds)
+    else:
+        time.sleep(seconds)
+
+
+def spawn(fn, *args, **kwargs):
+    """Run fn in a greenlet or a daemon thread."""
+    gevent = _gevent()
+    if gevent is not None:
+        return gevent.spawn(fn, *args, **kwargs)
+    thread = threading.Thread(target=fn, args=args, kwargs=kwargs, daemon=True)
+    thread.start()
+    return thread
+
+
+def Event():
+    gevent = _gevent()
+    if gevent is not None:
+        from gevent.event import Event
+
+        return Event()
+    return threading.Event()
+
+
+def Lock():
+    gevent = _gevent()
+    if gevent is not None:
+        from gevent.lock import RLock
+
+        return RLock()
+    return threading.RLock()
+
+
+def wait_future(future):
+    """Result of a concurrent.futures.Future, without blocking the gevent hub."""
+    gevent = _gevent()
+    if gevent is not None:
+        return gevent.get_hub().threadpool.spawn(future.result).get()
+    return future.result()
+
+
+def Queue(maxsize=None):
+    """Queue of at most `maxsize` items, unbounded if None."""
+    gevent = _gevent()
+    if gevent is not None:
+        from gevent.queue import Queue
+
+        return Queue(maxsize)
+    import queue
+
+    return queue.Queue(maxsize or 0)
+
+
+def run_in_thread(fn, *args):
+    """
+    Call fn(*args) in a native thread, without blocking the gevent hub.
+
+    Without gevent, fn is called in the current thread.
+    """
+    gevent = _gevent()
+    if gevent is not None:
+        return gevent.get_hub().threadpool.spawn(fn, *args).get()
+    return fn(*args)
+
+
+def start_thread(fn, *args):
+    """
+    Run fn(*args) in a native daemon thread, even if gevent monkey patched
+    the threading module, e.g. for loops blocking in C or on real sockets.
+    """
+    gevent = _gevent()
+    if gevent is not None:
+        from gevent.monkey import get_original
+
+        get_original("_thread", "start_new_thread")(fn, args)
+    else:
+        threading.Thread(target=fn, args=args, daemon=True).start()
+
+
+def threadsafe_caller():
+    """
+    A function call(fn, *args) which native threads may use to run fn(*args)
+    in the current thread, i.e. in its gevent hub, e.g. to set gevent events.
+
+    Without gevent, fn is called right away in the calling thread.
+    """
+    gevent = _gevent()
+    if gevent is not None:
+        return gevent.get_hub().loop.run_callback_threadsafe
+    return lambda fn, *args: fn(*args)
@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Adaptive admission control of job submissions.
+
+Bursts of submissions don't make the server faster: they only lengthen its
+queue, and with it the wait of every job. The AdmissionController limits the
+jobs in flight (created and not yet completed), queueing excess submissions
+locally, and adapts the limit by AIMD (additive increase, multiplicative
+decrease), like TCP congestion control: the limit grows by about one job per
+window of completions while jobs complete promptly, and is cut when the
+queue-to-completion latency rises well above its baseline, or when the server
+refuses jobs with 429 or 503.
+"""
+from . import _compat
+from .metrics import REGISTRY
+
+from collections import deque
+import logging
+
+
+# Response statuses of a server refusing new jobs
+OVERLOAD_STATUSES = (429, 503)
+
+
+class AdmissionController:
+    """
+    AIMD limit of the jobs in flight.
+
+    Parameters
+    ----------
+    initial : int, optional
+        Initial limit.
+
+        Default: 16
+    min_limit, max_limit : int, optional
+        Bounds of the limit.
+
+        Default: 1, 1000
+    decrease : float, optional
+        Factor applied to the limit on overload.
+
+        Default: 0.7
+    tolerance : float, optional
+        Overload is detected when the latency of a job, per second of audio
+        if its duration is known, exceeds `tolerance` times the baseline (the
+        lowest observed, slowly forgotten).
+
+        Default: 2.0
+    baseline_drift : float, optional
+        Relative rise of the baseline per completed job, so that it follows
+        lasting changes of the server speed.
+
+        Default: 0.01
+    retries : int, optional
+        Times a submission refused with 429 or 503 waits for admission again,
+        after a jittered backoff, before the error is raised.
+
+        Default: 5
+    metrics : MetricsRegistry, optional
+        Registry of the limit, in flight and waiting gauges.
+
+        Default: cpqdtrd.metrics.REGISTRY
+    """
+
+    def __init__(
+        self,
+        initial=16,
+        min_limit=1,
+        max_limit=1000,
+        decrease=0.7,
+        tolerance=2.0,
+        baseline_drift=0.01,
+        retries=5,
+        metrics=None,
+    ):
+        if not 0 < min_limit <= initial <= max_limit:
+            raise ValueError(
+                "Invalid limits: {} <= {} <= {}".format(min_limit, initial, max_limit)
+            )
+        if not 0 < decrease < 1:
+            raise ValueError("decrease must be between 0 and 1!")
+        self._log = logging.getLogger("cpqdtrd.admission")
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.decrease = decrease
+        self.tolerance = tolerance
+        self.baseline_drift = baseline_drift
+        self.retries = retries
+        self._limit = float(initial)
+        self.in_flight = 0
+        self.baseline = None
+        self._jobs = {}  # job_id -> audio duration, for jobs in flight
+        self._waiters = deque()
+        self._lock = _compat.Lock()
+        self._events = 0  # Completions and rejections
+        self._decreased_at = None  # Value of _events at the last decrease
+
+        registry = metrics if metrics is not None else REGISTRY
+        self._m_limit = registry.gauge(
+            "cpqdtrd_admission_limit", "Current limit of jobs in flight."
+        )
+        self._m_in_flight = registry.gauge(
+            "cpqdtrd_admission_in_flight", "Jobs admitted and not yet completed."
+        )
+        self._m_waiting = registry.gauge(
+            "cpqdtrd_admission_waiting", "Submissions waiting for admission."
+        )
+        self._m_limit.set(initial)
+
+    @property
+    def limit(self):
+        return int(self._limit)
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def stats(self):
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "baseline": self.baseline,
+        }
+
+    def acquire(self, timeout=None):
+        """
+        Wait for a slot for a new job, in arrival order.
+
+        Returns False if `timeout` seconds passed first. The slot must then be
+        bound to the job with `admit`, or given back with `abort` or `reject`.
+        """
+        with self._lock:
+            if not self._waiters and self.in_flight < self.limit:
+                self._take()
+                return True
+            event = _compat.Event()
+            self._waiters.append(event)
+            self._m_waiting.set(len(self._waiters))
+        if event.wait(timeout):
+            return True
+        with self._lock:
+            if event.is_set():  # Granted while timing out
+                return True
+            self._waiters.remove(event)
+            self._m_waiting.set(len(self._waiters))
+        return False
+
+    def _take(self):
+        self.in_flight += 1
+        self._m_in_flight.set(self.in_flight)
+
+    def _give_back(self):
+        self.in_flight -= 1
+        self._grant()
+
+    def _grant(self):
+        while self._waiters and self.in_flight < self.limit:
+            self._take()
+            self._waiters.popleft().set()
+        self._m_in_flight.set(self.in_flight)
+        self._m_waiting.set(len(self._waiters))
+
+    def admit(self, job_id, duration=None):
+        """Bind an acquired slot to a created job, with its audio duration."""
+        with self._lock:
+            self._jobs[job_id] = duration
+
+    def abort(self):
+        """Give back an acquired slot, the job not being created."""
+        with self._lock:
+            self._give_back()
+
+    def reject(self):
+        """Give back an acquired slot, the server refusing the job as overloaded."""
+        with self._lock:
+            self._events += 1
+            self._decrease("server overloaded")
+            self._give_back()
+
+    def complete(self, job_id, latency):
+        """
+        Release the slot of a completed job, adapting the limit.
+
+        `latency` is the time from the job creation to its completion notice.
+        """
+        with self._lock:
+            if job_id not in self._jobs:
+                return
+            duration = self._jobs.pop(job_id)
+            sample = latency / duration if duration else latency
+            self._events += 1
+            if self.baseline is None or sample < self.baseline:
+                self.baseline = sample
+            else:
+                self.baseline *= 1 + self.baseline_drift
+            if sample > self.tolerance * self.baseline:
+                self._decrease("latency {:.2f}s".format(latency))
+            elif self.in_flight >= self.limit:
+                # Only grow while the limit is what holds submissions back
+                self._set_limit(self._limit + 1 / self._limit)
+            self._give_back()
+
+    def discard(self, job_id):
+        """Release the slot of a job without completion (evicted, cancelled)."""
+        with self._lock:
+            if self._jobs.pop(job_id, False) is not False:
+                self._give_back()
+
+    def _decrease(self, reason):
+        # At most once per window of `limit` events, so that the jobs in
+        # flight when the overload started don't collapse the limit.
+        if (
+            self._decreased_at is not None
+            and self._events - self._decreased_at < self.limit
+        ):
+            return
+        self._decreased_at = self._events
+        self._set_limit(self._limit * self.decrease)
+        self._log.info("Admission limit down to {} ({})".format(self.limit, reason))
+
+    def _set_limit(self, limit):
+        self._limit = min(self.max_limit, max(self.min_limit, limit))
+        self._m_limit.set(self.limit)
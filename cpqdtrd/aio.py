@@ -0,0 +1,703 @@
+# -*- coding: utf-8 -*-
+"""
+Native asyncio versions of the transcription API wrapper and client.
+
+Requires the optional aiohttp dependency, used both for the HTTP client and
+for the webhook receiver. All operations are coroutines, so a single event
+loop can drive many jobs concurrently.
+"""
+from . import _json
+from .audio import as_audio_source
+from .cert import create_self_signed_cert
+from .health import backoff_delays
+from .tracker import JobTracker
+
+import aiohttp
+from aiohttp import web
+
+import asyncio
+from collections import OrderedDict
+import itertools
+import logging
+import numbers
+import shutil
+import ssl
+import tempfile
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import datetime
+from typing import List, Optional
+
+
+IDEMPOTENT_METHODS = frozenset(["GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"])
+RETRY_STATUSES = frozenset([502, 503, 504])
+
+
+class AsyncTranscriptionApi:
+    """
+    Asyncio counterpart of TranscriptionApi, built on aiohttp.
+
+    The connectivity check backs off as in TranscriptionApi, and a 401
+    response triggers one token refresh and a single retry. Tokens are only
+    refreshed on demand, not in the background, and there is no circuit
+    breaker nor balancing across several servers.
+    """
+
+    class TimeoutException(Exception):
+        """Timeout exception for the Transcription REST API."""
+
+    def __init__(
+        self,
+        url: str,
+        username: str = "",
+        password: str = "",
+        retry: int = 60,
+        retry_period: float = 2,
+        sl_host=None,
+        sl_port=None,
+        sl_protocol="https",
+        sl_token=None,
+        sl_username=None,
+        sl_password=None,
+        pool_limit: int = 100,
+        pool_limit_per_host: int = 0,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        connect_timeout: Optional[float] = 10,
+        read_timeout: Optional[float] = 60,
+        preprocessor=None,
+        retry_max_period: float = 60,
+        retry_deadline: Optional[float] = None,
+    ):
+        self._log = logging.getLogger("cpqdtrd.aio.api")
+        self._preprocessor = preprocessor
+        self._url = url
+        self._retry = retry
+        self._retry_period = retry_period
+        self._retry_max_period = retry_max_period
+        if retry_deadline is None:
+            retry_deadline = retry * retry_period  # Total wait of the fixed period
+        self._retry_deadline = retry_deadline
+        self._sl_host = sl_host
+        self._sl_port = sl_port
+        self._sl_protocol = sl_protocol
+        self._sl_username = sl_username
+        self._sl_password = sl_password
+        self._sl_token = sl_token
+        self._token_expiration = None
+        self._token_lock = None
+        self._headers = {}
+        if sl_token:
+            self._headers = {"Authorization": "Bearer " + sl_token}
+        if username and password:
+            self._auth = aiohttp.BasicAuth(username, password)
+        else:
+            self._auth = None
+
+        self._pool_limit = pool_limit
+        self._pool_limit_per_host = pool_limit_per_host
+        self._max_retries = max_retries
+        self._backoff_factor = backoff_factor
+        self._timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout, sock_read=read_timeout
+        )
+        self._session = None
+
+    async def open(self, check=True):
+        """
+        Open the connection pool and, optionally, wait for the server.
+
+        Must be called from the event loop which will use the API.
+        """
+        if self._session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self._pool_limit, limit_per_host=self._pool_limit_per_host
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector, timeout=self._timeout
+            )
+            self._token_lock = asyncio.Lock()
+        if not self._sl_token:
+            self._sl_token, self._token_expiration = await self.create_token()
+            if self._sl_token:
+                self._headers = {"Authorization": "Bearer " + self._sl_token}
+        if check:
+            await self._check_connection()
+        return self
+
+    async def close(self):
+        """Close all pooled connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _check_connection(self):
+        delays = backoff_delays(self._retry_period, self._retry_max_period)
+        deadline = time.monotonic() + self._retry_deadline
+        i = 0
+        while True:
+            try:
+                async for r in self.query(limit=1):
+                    self._log.debug("response: {}".format(r))
+                return
+            except Exception as e:
+                self._log.warning("Exception on API list request: {}".format(e))
+                self._log.warning("Retry {} of {}".format(i, self._retry))
+                i += 1
+                remaining = deadline - time.monotonic()
+                if i > self._retry or remaining <= 0:
+                    msg = "API call retries exceeded"
+                    raise self.TimeoutException(msg)
+                # One last attempt at the deadline
+                await asyncio.sleep(min(next(delays), remaining))
+
+    async def _request(self, method: str, path: str, body=None, **kwargs):
+        """
+        Send a request and return the response with its body already read.
+
+        Idempotent methods are retried on connection errors and on the
+        statuses in RETRY_STATUSES, with exponential backoff. Other methods are
+        only retried if the connection could not be established. `body` is a
+        callable building the request data, since aiohttp consumes it on send.
+
+        A 401 response triggers one token refresh and a single retry, if the
+        token can be renewed.
+        """
+        await self.check_token_expiration()
+        kwargs.setdefault("auth", self._auth)
+        headers = kwargs.pop("headers", None)
+        url = "{}{}".format(self._url, path)
+        attempt = 0
+        refreshed = False
+        while True:
+            if body is not None:
+                kwargs["data"] = body()
+            token = self._sl_token
+            kwargs["headers"] = self._headers if headers is None else headers
+            try:
+                r = await self._session.request(method, url, **kwargs)
+                await r.read()
+            except aiohttp.ClientConnectorError:
+                if attempt >= self._max_retries:
+                    raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if method not in IDEMPOTENT_METHODS or attempt >= self._max_retries:
+                    raise
+            else:
+                if r.status == 401 and not refreshed and self._can_create_token():
+                    self._log.info("Unauthorized request, refreshing token")
+                    await self.refresh_token(stale_token=token)
+                    refreshed = True
+                    continue
+                retry = method in IDEMPOTENT_METHODS and r.status in RETRY_STATUSES
+                if not retry or attempt >= self._max_retries:
+                    return r
+            attempt += 1
+            await asyncio.sleep(self._backoff_factor * (2 ** (attempt - 1)))
+
+    async def create(
+        self,
+        file_path,
+        tag: str = None,
+        config: List[str] = None,
+        callbacks_url: List = [],
+        samplerate: Optional[int] = None,
+        filename: Optional[str] = None,
+    ):
+        """
+        Upload audio from any source accepted by AudioSource.
+
+        The audio is normalized first if a `preprocessor` was given.
+        """
+        source = as_audio_source(file_path, samplerate=samplerate, filename=filename)
+        if self._preprocessor is not None:
+            source = await self._preprocessor.aprocess(source)
+        upload_request = "/job/create"
+        params = {}
+        if tag:
+            params["tag"] = tag
+
+        with ExitStack() as stack:
+
+            def form():
+                data = aiohttp.FormData()
+                if config:
+                    for c in config:
+                        data.add_field("config", c)
+                if len(callbacks_url) > 0:
+                    data.add_field("callback_urls", ",".join(callbacks_url))
+                if source.kind == "path":
+                    value = stack.enter_context(open(source.path, "rb"))
+                else:
+                    value = _aiter(source.chunks())
+                data.add_field("upload_file", value, filename=source.filename)
+                return data
+
+            return await self._request("POST", upload_request, body=form, params=params)
+
+    async def list_jobs(self, page: int = 1, limit: int = 100, tag: str = None):
+        params = {"page": page, "limit": limit}
+        if tag:
+            params["tag"] = tag
+        return await self._request("GET", "/job", params=params)
+
+    async def status(self, job_id: str):
+        return await self._request("GET", "/job/status/{}".format(job_id))
+
+    async def result(self, job_id: str):
+        return await self._request("GET", "/job/result/{}".format(job_id))
+
+    async def stop(self, job_id: str):
+        return await self._request("POST", "/job/stop/{}".format(job_id))
+
+    async def retry(self, job_id: str):
+        return await self._request("POST", "/job/retry/{}".format(job_id))
+
+    async def delete(self, job_id: str):
+        return await self._request("DELETE", "/job/{}".format(job_id))
+
+    async def query(
+        self,
+        tags: List[str] = [],
+        filenames: List[str] = [],
+        statuses: List[str] = [],
+        projection: List[str] = [],
+        get_result: bool = False,
+        page: int = 1,
+        limit: int = 100,
+        start_date: datetime = None,
+        end_date: datetime = None,
+    ):
+        """Async generator of the raw response lines, as in TranscriptionApi."""
+        await self.check_token_expiration()
+        params = []
+        params += [("tag", t) for t in tags]
+        params += [("filenames", f) for f in filenames]
+        params += [("status", s) for s in statuses]
+        params += [("projection", p) for p in projection]
+        if get_result:
+            params.append(("result", "true"))
+        params.append(("page", page))
+        params.append(("limit", limit))
+        if start_date:
+            params.append(("start_date", start_date.isoformat()))
+        if end_date:
+            params.append(("end_date", end_date.isoformat()))
+
+        async with self._session.get(
+            "{}/query/job".format(self._url),
+            params=params,
+            auth=self._auth,
+            headers=self._headers,
+        ) as r:
+            # Lines may be longer than the aiohttp readline limit
+            buffer = b""
+            async for chunk in r.content.iter_any():
+                buffer += chunk
+                lines = buffer.split(b"\n")
+                buffer = lines.pop()
+                for line in lines:
+                    line = line.rstrip(b"\r")
+                    if line:
+                        yield line
+            if buffer.strip():
+                yield buffer.strip()
+
+    async def webhook_whoami(self):
+        return await self._request("GET", "/webhook/whoami")
+
+    async def webhook_validate(
+        self,
+        host: str,
+        port: Optional[int] = None,
+        timeout: Optional[int] = None,
+        retries: Optional[int] = None,
+        token: str = "",
+        crt: str = "",
+    ):
+        webhook_url = host
+        if port is not None:
+            webhook_url += ":{}".format(port)
+        payload = {"url": webhook_url}
+        if timeout:
+            payload["timeout"] = int(timeout)
+        if retries:
+            payload["retries"] = int(retries)
+        if crt is not None or token is not None:
+            return await self._request(
+                "POST",
+                "/webhook/validate",
+                params=payload,
+                json={"crt": crt, "token": token},
+            )
+        return await self._request("GET", "/webhook/validate", params=payload)
+
+    def _can_create_token(self):
+        return None not in (
+            self._sl_host,
+            self._sl_port,
+            self._sl_username,
+            self._sl_password,
+            self._sl_protocol
+        )
+
+    async def create_token(self):
+        if self._can_create_token():
+            async with self._session.post(
+                url="{}://{}:{}/auth/token".format(self._sl_protocol, self._sl_host, self._sl_port),
+                auth=aiohttp.BasicAuth(self._sl_username, self._sl_password),
+                timeout=aiohttp.ClientTimeout(total=10),
+            ) as request:
+                if request.status == 200:
+                    body = await request.json()
+                    access_token = body["access_token"]
+                    token_expiration = int(body["expires_in"]) + int(time.time())
+                    return access_token, token_expiration
+                request.raise_for_status()
+        return None, None
+
+    async def refresh_token(self, stale_token=None):
+        """
+        Create a new token, shared by all concurrent callers.
+
+        Callers that pass the token they found to be stale as `stale_token`
+        don't refresh it again if another task already did.
+        """
+        async with self._token_lock:
+            if stale_token is not None and self._sl_token != stale_token:
+                return
+            self._sl_token, self._token_expiration = await self.create_token()
+            if self._sl_token:
+                self._headers = {"Authorization": "Bearer " + self._sl_token}
+            else:
+                self._headers = {}
+
+    async def check_token_expiration(self):
+        if self._token_expiration and time.time() >= self._token_expiration:
+            await self.refresh_token(stale_token=self._sl_token)
+
+
+class AsyncTranscriptionClient:
+    """
+    Asyncio counterpart of TranscriptionClient.
+
+    The client must be started inside the event loop, either explicitly with
+    `await client.start()` or with `async with AsyncTranscriptionClient(...)`.
+    Callbacks may be plain functions or coroutine functions.
+    """
+
+    def __init__(
+        self,
+        api_url,
+        webhook_port=8443,
+        webhook_host=None,
+        webhook_listener="0.0.0.0",
+        webhook_protocol="https",
+        username=None,
+        password=None,
+        cert_path=None,
+        key_path=None,
+        sl_host=None,
+        sl_port=None,
+        sl_protocol="https",
+        sl_token=None,
+        sl_username=None,
+        sl_password=None,
+        api_kwargs=None,
+        job_ttl=86400,
+        max_tracked_jobs=100000,
+    ):
+        self._log = logging.getLogger(self.__class__.__name__)
+
+        # Jobs awaiting webhooks, evicted as in TranscriptionClient
+        self.jobs = JobTracker(
+            job_ttl,
+            max_tracked_jobs,
+            on_evict=self._on_evict,
+            event_factory=asyncio.Event,
+        )
+        self._expirer = None
+        self._early_notices = OrderedDict()
+
+        self.api = AsyncTranscriptionApi(
+            url=api_url,
+            username=username,
+            password=password,
+            sl_host=sl_host,
+            sl_port=sl_port,
+            sl_protocol=sl_protocol,
+            sl_token=sl_token,
+            sl_username=sl_username,
+            sl_password=sl_password,
+            **(api_kwargs or {})
+        )
+
+        if webhook_protocol not in ("http", "https"):
+            raise ValueError("Invalid protocol: {}".format(webhook_protocol))
+        self._webhook_host = webhook_host
+        self._webhook_port = webhook_port
+        self._webhook_listener = webhook_listener
+        self._webhook_protocol = webhook_protocol
+        self._runner = None
+        self._cert_dir = None
+        self._crt = None
+
+        if cert_path is None and key_path is None:
+            self._cert_dir = tempfile.mkdtemp()
+            self._cert_path = "{}/cert".format(self._cert_dir)
+            self._key_path = "{}/key".format(self._cert_dir)
+        elif cert_path is None or key_path is None:
+            raise ValueError("cert_path and key_path must be set together!")
+        else:
+            self._cert_path = cert_path
+            self._key_path = key_path
+
+        # User callbacks, looked up on each webhook so that the registry may
+        # change without restarting the server.
+        self._callbacks = {}
+        self._callback_ids = itertools.count()
+        self._validation_token = str(uuid.uuid4())
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def start(self):
+        """Start the webhook server and validate it against the API."""
+        await self.api.open()
+        if self._webhook_host is None:
+            r = await self.api.webhook_whoami()
+            self._webhook_host = (await r.json())["address"]
+
+        app = web.Application()
+        app.router.add_post("/{job_id}", self._root_handler)
+        app.router.add_post("/{name}/{job_id}", self._callback_handler)
+        self._runner = web.AppRunner(app, access_log=logging.getLogger("aiohttp.access"))
+        await self._runner.setup()
+
+        ssl_context = None
+        if self._webhook_protocol == "https":
+            if self._cert_dir is not None:
+                await asyncio.get_running_loop().run_in_executor(
+                    None,
+                    create_self_signed_cert,
+                    self._webhook_host,
+                    self._cert_path,
+                    self._key_path,
+                )
+                with open(self._cert_path, "r") as f:
+                    self._crt = f.read()
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(self._cert_path, self._key_path)
+        site = web.TCPSite(
+            self._runner,
+            self._webhook_listener,
+            self._webhook_port,
+            ssl_context=ssl_context,
+        )
+        await site.start()
+
+        r = await self.api.webhook_validate(
+            "{}://{}".format(self._webhook_protocol, self._webhook_host),
+            self._webhook_port,
+            crt=self._crt,
+            token=self._validation_token,
+        )
+        r = await r.json()
+        if "reachable" not in r:
+            raise ConnectionError(
+                "{}:{} Error in validation. Reason: {}".format(
+                    self._webhook_host, self._webhook_port, r
+                )
+            )
+        if not r["reachable"]:
+            raise ConnectionError(
+                "{}:{} not reachable by the transcription server.".format(
+                    self._webhook_host, self._webhook_port
+                )
+            )
+        if self.jobs.ttl is not None:
+            self._expirer = asyncio.ensure_future(self._expire_loop())
+        return self
+
+    async def stop(self):
+        if self._expirer is not None:
+            self._expirer.cancel()
+            self._expirer = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        if self._cert_dir is not None:
+            shutil.rmtree(self._cert_dir, ignore_errors=True)
+        await self.api.close()
+
+    async def _read_payload(self, request):
+        result = await request.json(loads=_json.loads)
+        if "token" not in result or result["token"] != self._validation_token:
+            raise web.HTTPUnauthorized(reason="Invalid token")
+        return result
+
+    def _signal(self, job_id, name):
+        if self.jobs.signal(job_id, name) is None and job_id not in self.jobs:
+            # The webhook may beat the create response: keep the notice
+            # until the job is tracked, or it would wait until evicted
+            self._remember_notice(job_id, name)
+
+    def _remember_notice(self, job_id, name, max_size=10000):
+        # Notices of unknown jobs (e.g. already collected) are kept as well,
+        # the oldest being dropped
+        self._early_notices.setdefault(job_id, []).append(name)
+        while len(self._early_notices) > max_size:
+            self._early_notices.popitem(last=False)
+
+    async def _expire_loop(self):
+        while True:
+            await asyncio.sleep(self.jobs.expire_interval)
+            self.jobs.expire()
+
+    def _on_evict(self, job):
+        self._log.warning(
+            "Job {} evicted after {:.0f}s, still awaiting {}".format(
+                job.job_id, job.age, sorted(job.pending)
+            )
+        )
+
+    async def _root_handler(self, request):
+        # Root callback is only responsible for signaling that the job will
+        # no longer be processed.
+        job_id = request.match_info["job_id"]
+        await self._read_payload(request)
+        self._signal(job_id, "__root__")
+        return web.Response(text="OK")
+
+    async def _callback_handler(self, request):
+        job_id = request.match_info["job_id"]
+        name = request.match_info["name"]
+        # Requests with an invalid token must not touch the job
+        r = await self._read_payload(request)
+        try:
+            job = self.jobs.get(job_id)
+            callback = job.callbacks.get(name) if job and job.callbacks else None
+            if callback is None:
+                callback = self._callbacks.get(name)
+            if callback is None:
+                raise web.HTTPNotFound(reason="Callback {} not registered".format(name))
+            ret = callback(job_id, r)
+            if asyncio.iscoroutine(ret):
+                await ret
+        finally:  # Emit events regardless of the success of the callback op
+            self._signal(job_id, name)
+        return web.Response(text="OK")
+
+    def register_callback(self, callback, name=None):
+        """Register a callback with optional name. It may be a coroutine function."""
+        if name is None:
+            name = "_callback_{}".format(next(self._callback_ids))
+        elif name[:9] == "_callback":
+            raise ValueError("Prefix _callback is reserved for callback names!")
+        self._callbacks[name] = callback
+        return name
+
+    def unregister_callback(self, *callback_names):
+        """Unregister one or more named callbacks. Jobs already submitted keep them."""
+        for name in callback_names:
+            if type(name) is int:
+                name = "_callback_{}".format(name)
+            elif type(name) is not str:
+                raise ValueError("{} not a string!".format(name))
+            if name in self._callbacks:
+                del self._callbacks[name]
+            else:
+                self._log.warning("Callback {} not registered".format(name))
+
+    def unregister_all(self):
+        """Unregister all callbacks."""
+        self._callbacks.clear()
+
+    async def transcribe(
+        self,
+        path,
+        tag=None,
+        config=None,
+        timeout="auto",
+        delete_after=True,
+        samplerate=None,
+        filename=None,
+    ):
+        """
+        Transcribe an audio file.
+
+        Same semantics as TranscriptionClient.transcribe.
+
+        Returns
+        -------
+        Only the job id if timeout < 0, or a tuple (job_id: str, result: dict)
+        """
+        source = as_audio_source(path, samplerate=samplerate, filename=filename)
+        if timeout == "auto":
+            duration = await asyncio.get_running_loop().run_in_executor(
+                None, source.duration
+            )
+            timeout = 0 if duration is None else max(30, duration)
+        elif not isinstance(timeout, numbers.Number):
+            raise ValueError("Invalid value for timeout: {}".format(timeout))
+
+        webhook_root = "{}://{}:{}".format(
+            self._webhook_protocol, self._webhook_host, self._webhook_port
+        )
+        callbacks = dict(self._callbacks)
+        webhooks = [webhook_root]
+        webhooks += ["{}/{}".format(webhook_root, name) for name in callbacks]
+
+        r = await self.api.create(source, tag=tag, config=config, callbacks_url=webhooks)
+        r.raise_for_status()
+        job_id = (await r.json())["job"]["id"]
+
+        self.jobs.add(job_id, ["__root__"] + list(callbacks), callbacks or None)
+        for name in self._early_notices.pop(job_id, ()):
+            self._signal(job_id, name)
+
+        if timeout < 0:
+            return job_id
+
+        return job_id, await self.wait_result(job_id, timeout, delete_after)
+
+    async def wait_result(self, job_id, timeout=0, delete_after=True):
+        """
+        Wait for the result of a job and for all of its callbacks.
+
+        Same semantics as TranscriptionClient.wait_result.
+        """
+        job = self.jobs.get(job_id)
+        if job is not None:
+            if timeout < 0:
+                return False
+            try:
+                await asyncio.wait_for(
+                    self.jobs.waiter(job).wait(), timeout if timeout > 0 else None
+                )
+            except asyncio.TimeoutError:
+                return False
+            if job.evicted:
+                raise AsyncTranscriptionApi.TimeoutException(
+                    "Job {} evicted before its completion notices".format(job_id)
+                )
+        r = await self.api.result(job_id)
+        result = await r.json(loads=_json.loads)
+        if delete_after:
+            await self.api.delete(job_id)
+        return result
+
+
+async def _aiter(chunks):
+    for chunk in chunks:
+        yield chunk
@@ -6,16 +6,78 @@ Created on Thu Nov 29 09:18:03 2018
 
 @author: valterf
 """
+from . import _compat, _json
+from .audio import MultipartStream, as_audio_source
+from .balancer import Balancer
+from .health import CircuitOpenError, backoff_delays
+from .metrics import REGISTRY, MetricsRegistry
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+from urllib3.util.retry import Retry
 import time
 import logging
+import queue
 import urllib
 import json
-from datetime import datetime
-from typing import List, Dict, Optional
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Union
 from contextlib import closing
 
 
+def _not_connected(error):
+    """Whether a request failed before connecting, so nothing was sent."""
+    if isinstance(error, (CircuitOpenError, requests.ConnectTimeout)):
+        return True
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, "reason", reason)  # Unwrap MaxRetryError
+    return isinstance(reason, (NewConnectionError, ConnectTimeoutError))
+
+
+def create_session(
+    pool_connections: int = 10,
+    pool_maxsize: int = 10,
+    pool_block: bool = False,
+    max_retries: int = 3,
+    backoff_factor: float = 0.5,
+    status_forcelist=(502, 503, 504),
+):
+    """
+    Create a requests Session with a keep-alive connection pool and retries.
+
+    Retries on read errors and on the statuses in `status_forcelist` are only
+    performed for idempotent methods (GET, HEAD, DELETE, ...). Connection
+    errors are retried for every method, since the request never reached the
+    server. Backoff between attempts grows exponentially with `backoff_factor`.
+
+    The urllib3 pool is safe to share between greenlets as long as the
+    standard library is monkey patched by gevent. Use `pool_block=True` to
+    cap the number of connections per host at `pool_maxsize`, making the
+    exceeding requests wait for a free connection.
+    """
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries,
+        status=max_retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=pool_connections,
+        pool_maxsize=pool_maxsize,
+        pool_block=pool_block,
+        max_retries=retry,
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
 class TranscriptionApi:
     """Class which pre-tests the REST HTTP URL and wraps all requests."""
 
@@ -24,7 +86,7 @@ class TranscriptionApi:
 
     def __init__(
         self,
-        url: str,
+        url: Union[str, List[str]],
         username: str = "",
         password: str = "",
         retry: int = 60,
@@ -35,130 +97,449 @@ class TranscriptionApi:
         sl_token=None,
         sl_username=None,
         sl_password=None,
+        session: Optional[requests.Session] = None,
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        pool_block: bool = False,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        connect_timeout: Optional[float] = 10,
+        read_timeout: Optional[float] = 60,
+        wait_ready: bool = True,
+        retry_max_period: float = 60,
+        retry_deadline: Optional[float] = None,
+        breaker_threshold: int = 5,
+        breaker_reset: float = 30,
+        token_refresh_fraction: float = 0.8,
+        token_skew: float = 30,
+        metrics: Optional[MetricsRegistry] = None,
+        preprocessor=None,
+        balance: str = "least_outstanding",
     ):
+        """
+        Wrap the REST API at `url`, checking that it is reachable.
+
+        The connectivity check retries up to `retry` times, with jittered
+        exponential backoff starting at `retry_period` seconds and capped at
+        `retry_max_period`, for at most `retry_deadline` seconds (default:
+        `retry * retry_period`). If `wait_ready` is True, the constructor blocks
+        until the check succeeds, raising TimeoutException if retries are
+        exceeded. Otherwise the check runs in the background: see `ready` and
+        `wait_ready`.
+
+        Each server has a CircuitBreaker, which fails fast with
+        CircuitOpenError for `breaker_reset` seconds after
+        `breaker_threshold` consecutive connection errors or 5xx responses.
+
+        Tokens created from the license server credentials are refreshed in
+        the background once `token_refresh_fraction` of their lifetime has
+        passed, and at least `token_skew` seconds before they expire.
+
+        Request counts, latencies and retries are recorded in `metrics`
+        (default: cpqdtrd.metrics.REGISTRY).
+
+        If `preprocessor` is set (see cpqdtrd.preprocess.AudioPreprocessor),
+        audio is downmixed, resampled and re-encoded by it before upload.
+
+        `url` may be a list of servers, balanced by a cpqdtrd.balancer.Balancer
+        with the `balance` strategy ("least_outstanding" or "latency"). Each
+        server then has its own circuit breaker, which ejects it from the
+        choice of new jobs while open. Calls about a job go to the server
+        which created it, queries are sent to all servers, and `node_stats`
+        reports the load and health of each one.
+        """
         self._log = logging.getLogger("cpqdtrd.api")
+        self.balancer = Balancer(
+            [url] if isinstance(url, str) else list(url),
+            balance,
+            breaker_threshold,
+            breaker_reset,
+        )
+        self.nodes = self.balancer.nodes
+        self.breaker = self.nodes[0].breaker  # Of the first server
+        self._init_metrics(metrics if metrics is not None else REGISTRY)
+        self._ready = _compat.Event()
+        self._checked = _compat.Event()
+
+        # Shared keep-alive connection pool, reused by all requests
+        if session is None:
+            session = create_session(
+                pool_connections=pool_connections,
+                pool_maxsize=pool_maxsize,
+                pool_block=pool_block,
+                max_retries=max_retries,
+                backoff_factor=backoff_factor,
+            )
+        self._session = session
+        self._timeout = (connect_timeout, read_timeout)
+        self._preprocessor = preprocessor
 
-        i = 0
-        ok = False
-        self._url = url
+        self._url = self.nodes[0].url
         self._sl_host = sl_host
         self._sl_port = sl_port
         self._sl_protocol = sl_protocol
         self._sl_username = sl_username
         self._sl_password = sl_password
 
+        self._token_refresh_fraction = token_refresh_fraction
+        self._token_skew = token_skew
+        self._token_lock = _compat.Lock()
+        self._token_refresh_at = self._token_stale_at = None
+        self._closed = False
         if sl_token:
-            self._sl_token = sl_token
-            self._token_expiration = None
+            self._set_token(sl_token, None)
         else:
-            self._sl_token, self._token_expiration = self.create_token()
-
-        if self._sl_token:
-            self._headers = {"Authorization": "Bearer " + self._sl_token}
-        else:
-            self._headers = {}
+            self._set_token(*self.create_token())
+            if self._token_expiration:
+                _compat.spawn(self._refresh_loop)
 
         if username and password:
             self._auth = requests.auth.HTTPBasicAuth(username, password)
         else:
             self._auth = None
 
-        while not ok:
+        self._check_error = None
+        if wait_ready:
+            self._check_connection(
+                retry, retry_period, retry_max_period, retry_deadline
+            )
+            if self._check_error is not None:
+                raise self._check_error
+        else:
+            _compat.spawn(
+                self._check_connection,
+                retry,
+                retry_period,
+                retry_max_period,
+                retry_deadline,
+            )
+
+    def _init_metrics(self, registry):
+        self.metrics = registry
+        self._m_requests = registry.counter(
+            "cpqdtrd_api_requests_total",
+            "Requests to the transcription API, by response status code.",
+            ("method", "endpoint", "code"),
+        )
+        self._m_latency = registry.histogram(
+            "cpqdtrd_api_request_seconds",
+            "Time until the response headers, including the upload of the body.",
+            ("method", "endpoint"),
+        )
+        self._m_in_flight = registry.gauge(
+            "cpqdtrd_api_requests_in_flight",
+            "Requests to the transcription API waiting for a response.",
+        )
+        self._m_retries = registry.counter(
+            "cpqdtrd_api_retries_total",
+            "Requests to the transcription API sent again, by reason.",
+            ("reason",),
+        )
+        self._m_upload_bytes = registry.counter(
+            "cpqdtrd_api_upload_bytes_total", "Bytes of job creation requests sent."
+        )
+        self._m_token_refreshes = registry.counter(
+            "cpqdtrd_token_refreshes_total",
+            "Tokens created from the license server credentials.",
+        )
+
+    def _check_connection(self, retry, retry_period, retry_max_period, deadline):
+        delays = backoff_delays(retry_period, retry_max_period)
+        if deadline is None:
+            deadline = retry * retry_period  # Total wait of the fixed period
+        deadline += time.monotonic()
+        i = 0
+        while True:
             try:
-                for r in self.query():
+                for r in self.query(limit=1):
                     self._log.debug("response: {}".format(r))
-                ok = True
+                self._ready.set()
+                break
             except Exception as e:
                 self._log.warning("Exception on API list request: {}".format(e))
                 self._log.warning("Retry {} of {}".format(i, retry))
-                time.sleep(retry_period)
                 i += 1
-                if i > retry:
+                self._m_retries.labels("health_check").inc()
+                remaining = deadline - time.monotonic()
+                if i > retry or remaining <= 0:
                     msg = "API call retries exceeded"
-                    raise self.TimeoutException(msg)
+                    self._check_error = self.TimeoutException(msg)
+                    break
+                # One last attempt at the deadline
+                _compat.sleep(min(next(delays), remaining))
+        self._checked.set()
+
+    def ready(self):
+        """Whether the connectivity check has succeeded."""
+        return self._ready.is_set()
+
+    def wait_ready(self, timeout: Optional[float] = None):
+        """
+        Wait for the connectivity check.
+
+        Returns True if the server is reachable, False if `timeout` seconds
+        passed first. Raises TimeoutException if the check gave up.
+        """
+        self._checked.wait(timeout)
+        if self._check_error is not None:
+            raise self._check_error
+        return self._ready.is_set()
+
+    def _request(
+        self, method: str, path: str, endpoint: str = None, node=None, **kwargs
+    ):
+        """
+        Send a request to the API through the shared session.
+
+        A 401 response triggers one token refresh and a single retry, if the
+        token can be renewed and the request body can be sent again.
+
+        `endpoint` labels the request in the metrics. It defaults to the path,
+        so it must be given for paths which contain ids. `node` is the server
+        called, chosen by the balancer by default.
+        """
+        self.check_token_expiration()
+        if node is None:
+            node = self.nodes[0] if len(self.nodes) == 1 else self.balancer.choose()
+        if endpoint is None:
+            endpoint = path.split("?", 1)[0]
+        kwargs.setdefault("auth", self._auth)
+        kwargs.setdefault("timeout", self._timeout)
+        headers = kwargs.pop("headers", {})
+        token = self._sl_token
+        r = self._send(node, method, path, endpoint, headers, **kwargs)
+        if (
+            r.status_code == 401
+            and self._can_create_token()
+            and getattr(kwargs.get("data"), "rewindable", True)
+        ):
+            self._log.info("Unauthorized request, refreshing token")
+            self.refresh_token(stale_token=token)
+            r.close()
+            self._m_retries.labels("unauthorized").inc()
+            r = self._send(node, method, path, endpoint, headers, **kwargs)
+        return r
+
+    def _send(self, node, method, path, endpoint, headers, **kwargs):
+        try:
+            node.breaker.allow()
+        except CircuitOpenError:
+            self._m_requests.labels(method, endpoint, "circuit_open").inc()
+            raise
+        self._m_in_flight.inc()
+        node.in_flight += 1
+        start = time.perf_counter()
+        failed = True
+        recorded = False
+        try:
+            r = self._session.request(
+                method,
+                "{}{}".format(node.url, path),
+                headers=dict(self._headers, **headers),
+                **kwargs
+            )
+        except Exception:
+            node.breaker.record_failure()
+            recorded = True
+            self._m_requests.labels(method, endpoint, "error").inc()
+            raise
+        else:
+            failed = r.status_code >= 500
+            if failed:
+                node.breaker.record_failure()
+            else:
+                node.breaker.record_success()
+            recorded = True
+        finally:
+            # Interrupted (e.g. the greenlet was killed): a half-open
+            # circuit must let another trial call through
+            if not recorded:
+                node.breaker.release()
+            elapsed = time.perf_counter() - start
+            self._m_in_flight.dec()
+            node.in_flight -= 1
+            self._m_latency.labels(method, endpoint).observe(elapsed)
+            self.balancer.observe(node, elapsed, failed)
+        # Retries done by urllib3 within the request
+        retries = getattr(r.raw, "retries", None)
+        if retries is not None and retries.history:
+            self._m_retries.labels("transport").inc(len(retries.history))
+        self._m_requests.labels(method, endpoint, str(r.status_code)).inc()
+        return r
+
+    def _job_request(
+        self, method: str, path: str, endpoint: str, job_id: str, **kwargs
+    ):
+        """
+        Send a request about a job to the server which owns it.
+
+        Jobs not pinned to a server (e.g. created by another process) are
+        looked up on each server in turn, until one doesn't answer 404.
+        """
+        node = self.balancer.node_for(job_id)
+        if node is not None or len(self.nodes) == 1:
+            return self._request(
+                method, path, endpoint, node=node or self.nodes[0], **kwargs
+            )
+        r = error = None
+        for node in self.nodes:
+            try:
+                r = self._request(method, path, endpoint, node=node, **kwargs)
+            except (requests.ConnectionError, requests.Timeout, CircuitOpenError) as e:
+                error = e
+                continue
+            if r.status_code != 404:
+                self.balancer.pin(job_id, node, created=False)
+                return r
+        if r is None:
+            raise error
+        return r
+
+    def _fan_out(self, fn):
+        """
+        Call fn(node) on every server, chaining the items it yields.
+
+        With several servers, unreachable ones are skipped with a warning,
+        unless all of them are.
+        """
+        if len(self.nodes) == 1:
+            yield from fn(self.nodes[0])
+            return
+        error = None
+        failed = 0
+        for node in self.nodes:
+            try:
+                yield from fn(node)
+            except (requests.ConnectionError, requests.Timeout, CircuitOpenError) as e:
+                self._log.warning("Skipping server {}: {}".format(node.url, e))
+                error = e
+                failed += 1
+        if failed == len(self.nodes):
+            raise error
+
+    def node_stats(self):
+        """Load and health statistics of each server, as a list of dicts."""
+        return self.balancer.stats()
+
+    def close(self):
+        """Close all pooled connections and stop refreshing the token."""
+        self._closed = True
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
     def create(
         self,
-        file_path: str,
+        file_path,
         tag: str = None,
         config: List[str] = None,
         callbacks_url: List = [],
+        samplerate: Optional[int] = None,
+        filename: Optional[str] = None,
     ):
-        self.check_token_expiration()
-
-        upload_request = "{}/job/create".format(self._url)
+        """
+        Upload audio and create a transcription job.
+
+        `file_path` may be a path or any source accepted by AudioSource:
+        bytes, a file-like object, an iterator of byte chunks or a NumPy array
+        (with `samplerate`). The multipart body is streamed from the source,
+        with chunked transfer encoding if its size is not known beforehand.
+        """
+        source = as_audio_source(file_path, samplerate=samplerate, filename=filename)
+        if self._preprocessor is not None:
+            source = self._preprocessor.process(source)
+
+        upload_request = "/job/create"
         if tag:
             upload_request += "?tag={}".format(tag)
 
-        data = {}
+        fields = []
         if config:
-            data["config"] = config
+            fields += [("config", c) for c in config]
 
         if len(callbacks_url) > 0:
-            data["callback_urls"] = ",".join(callbacks_url)
-
-        with open(file_path, "rb") as f:
-            upload_file = [("upload_file", f)]
-            return requests.post(
-                upload_request,
-                data=data,
-                files=upload_file,
-                auth=self._auth,
-                headers=self._headers,
-            )
+            fields.append(("callback_urls", ",".join(callbacks_url)))
+
+        body = MultipartStream(fields, "upload_file", source)
+        headers = {"Content-Type": body.content_type}
+        # Only errors while connecting mean the job was not created: another
+        # server is then tried, if the body can be sent again. Once connected,
+        # the server may have created the job even if the response was lost.
+        tried = []
+        while True:
+            node = self.balancer.choose(exclude=tried)
+            try:
+                r = self._request(
+                    "POST", upload_request, node=node, data=body, headers=headers
+                )
+                break
+            except (requests.ConnectionError, CircuitOpenError) as e:
+                tried.append(node)
+                if (
+                    not _not_connected(e)
+                    or len(tried) == len(self.nodes)
+                    or not body.rewindable
+                ):
+                    raise
+                self._log.warning(
+                    "Could not create job on {}, trying another server: {}".format(
+                        node.url, e
+                    )
+                )
+                self._m_retries.labels("failover").inc()
+            finally:
+                self._m_upload_bytes.inc(body.sent)
+        if r.ok:
+            try:
+                self.balancer.pin(_json.loads(r.content)["job"]["id"], node)
+            except (ValueError, KeyError, TypeError):
+                pass
+        return r
 
     def list_jobs(self, page: int = 1, limit: int = 100, tag: str = None):
-        self.check_token_expiration()
-
         params = {"page": page, "limit": limit}
         if tag:
             params["tag"] = tag
-        return requests.get(
-            "{}/job".format(self._url),
-            params=params,
-            auth=self._auth,
-            headers=self._headers,
-        )
+        return self._request("GET", "/job", params=params)
 
     def status(self, job_id: str):
-        self.check_token_expiration()
-        return requests.get(
-            "{}/job/status/{}".format(self._url, job_id),
-            auth=self._auth,
-            headers=self._headers,
+        return self._job_request(
+            "GET", "/job/status/{}".format(job_id), "/job/status", job_id
         )
 
-    def result(self, job_id: str):
-        self.check_token_expiration()
-        return requests.get(
-            "{}/job/result/{}".format(self._url, job_id),
-            auth=self._auth,
-            headers=self._headers,
+    def result(self, job_id: str, stream: bool = False):
+        """
+        Request the result of a job.
+
+        If `stream` is True, the body is downloaded as it is read, e.g. by
+        cpqdtrd.streaming.SegmentStream, and the response must be closed.
+        """
+        r = self._job_request(
+            "GET", "/job/result/{}".format(job_id), "/job/result", job_id, stream=stream
         )
+        if r.status_code == 200:
+            self.balancer.release(job_id)
+        return r
 
     def stop(self, job_id: str):
-        self.check_token_expiration()
-        return requests.post(
-            "{}/job/stop/{}".format(self._url, job_id),
-            auth=self._auth,
-            headers=self._headers,
+        return self._job_request(
+            "POST", "/job/stop/{}".format(job_id), "/job/stop", job_id
         )
 
     def retry(self, job_id: str):
-        self.check_token_expiration()
-        return requests.post(
-            "{}/job/retry/{}".format(self._url, job_id),
-            auth=self._auth,
-            headers=self._headers,
+        return self._job_request(
+            "POST", "/job/retry/{}".format(job_id), "/job/retry", job_id
         )
 
     def delete(self, job_id: str):
-        self.check_token_expiration()
-        return requests.delete(
-            "{}/job/{}".format(self._url, job_id),
-            auth=self._auth,
-            headers=self._headers,
-        )
+        r = self._job_request("DELETE", "/job/{}".format(job_id), "/job", job_id)
+        if r.ok or r.status_code == 404:
+            self.balancer.release(job_id, unpin=True)
+        return r
 
     def query(
         self,
@@ -172,9 +553,6 @@ class TranscriptionApi:
         start_date: datetime = None,
         end_date: datetime = None,
     ):
-        self.check_token_expiration()
-        request = "{}/query/job".format(self._url)
-
         params = {}
         if tags:
             params["tag"] = tags
@@ -195,22 +573,109 @@ class TranscriptionApi:
         if end_date:
             params["end_date"] = end_date.isoformat()
 
-        with closing(
-            requests.get(
-                request,
-                params=params,
-                stream=True,
-                auth=self._auth,
-                headers=self._headers,
-            )
-        ) as r:
-            for line in r.iter_lines():
-                yield line
+        def lines(node):
+            with closing(
+                self._request(
+                    "GET", "/query/job", node=node, params=params, stream=True
+                )
+            ) as r:
+                yield from r.iter_lines()
+
+        yield from self._fan_out(lines)
+
+    def iter_query(
+        self,
+        tags: List[str] = [],
+        filenames: List[str] = [],
+        statuses: List[str] = [],
+        projection: List[str] = [],
+        get_result: bool = False,
+        limit: int = 100,
+        start_date: datetime = None,
+        end_date: datetime = None,
+        window: Optional[timedelta] = None,
+        prefetch: int = 1,
+    ):
+        """
+        Iterate over all jobs matching a query, decoded one at a time.
+
+        Pages are requested in sequence until one comes back incomplete. While
+        a page is being consumed, up to `prefetch` following pages are fetched
+        by a background thread (a greenlet, if gevent monkey patched the
+        standard library), so memory use is bounded by `limit * (prefetch + 1)`
+        jobs regardless of the total.
+
+        If `window` is set, the [start_date, end_date) interval is split in
+        consecutive windows of that length, each paginated separately, which
+        keeps page offsets small on very long scans. Setting `end_date`
+        also keeps pagination stable while new jobs are created.
+
+        Parameters are the same as in `query`, except for:
+
+        window : timedelta, optional
+            Length of each date window. Requires start_date and end_date.
+        prefetch : int, optional
+            Number of pages fetched ahead. If 0, pages are fetched on demand
+            in the calling thread.
+
+            Default: 1
+
+        Yields
+        ------
+        Each job as a dict, decoded as MongoDB Extended JSON (dates and
+        object ids are converted as by bson.json_util).
+        """
+        if window is not None:
+            if start_date is None or end_date is None:
+                raise ValueError("window requires start_date and end_date!")
+            if window <= timedelta(0):
+                raise ValueError("window must be positive!")
+            ranges = []
+            start = start_date
+            while start < end_date:
+                ranges.append((start, min(start + window, end_date)))
+                start += window
+        else:
+            ranges = [(start_date, end_date)]
+
+        def pages():
+            for start, end in ranges:
+                page = 1
+                while True:
+                    lines = [
+                        line
+                        for line in self.query(
+                            tags=tags,
+                            filenames=filenames,
+                            statuses=statuses,
+                            projection=projection,
+                            get_result=get_result,
+                            page=page,
+                            limit=limit,
+                            start_date=start,
+                            end_date=end,
+                        )
+                        if line
+                    ]
+                    if lines:
+                        yield lines
+                    if len(lines) < limit:
+                        break
+                    page += 1
+
+        if prefetch > 0:
+            page_iter = _prefetch(pages(), prefetch)
+        else:
+            page_iter = pages()
+        try:
+            for lines in page_iter:
+                for line in lines:
+                    yield _json.loads_extended(line)
+        finally:
+            page_iter.close()
 
     def webhook_whoami(self):
-        self.check_token_expiration()
-        whoami_request = "{}/webhook/whoami".format(self._url)
-        return requests.get(whoami_request, auth=self._auth, headers=self._headers)
+        return self._request("GET", "/webhook/whoami")
 
     def webhook_validate(
         self,
@@ -221,8 +686,6 @@ class TranscriptionApi:
         token: str = "",
         crt: str = "",
     ):
-        self.check_token_expiration()
-        test_request = "{}/webhook/validate".format(self._url)
         webhook_url = host
         if port is not None:
             webhook_url += ":{}".format(port)
@@ -231,42 +694,151 @@ class TranscriptionApi:
             payload["timeout"] = int(timeout)
         if retries:
             payload["retries"] = int(retries)
-        if crt is not None or token is not None:
-            r = requests.post(
-                test_request,
-                params=payload,
-                auth=self._auth,
-                json={"crt": crt, "token": token},
-                headers=self._headers,
+        # The server tries to reach the webhook before answering, so the read
+        # timeout must also cover its connection attempts.
+        request_timeout = self._timeout
+        if timeout and self._timeout[1] is not None:
+            request_timeout = (
+                self._timeout[0],
+                self._timeout[1] + int(timeout) * (int(retries or 0) + 1),
             )
-        else:
-            r = requests.get(
-                test_request, params=payload, auth=self._auth, headers=self._headers
-            )
-        return r
 
-    def create_token(self):
-        if None not in (
+        def validate(node):
+            if crt is not None or token is not None:
+                yield self._request(
+                    "POST",
+                    "/webhook/validate",
+                    node=node,
+                    params=payload,
+                    json={"crt": crt, "token": token},
+                    timeout=request_timeout,
+                )
+            else:
+                yield self._request(
+                    "GET",
+                    "/webhook/validate",
+                    node=node,
+                    params=payload,
+                    timeout=request_timeout,
+                )
+
+        # Every server must be able to reach the webhook: the first failed
+        # validation is returned, if any.
+        responses = list(self._fan_out(validate))
+        for r in responses:
+            try:
+                if not _json.loads(r.content).get("reachable"):
+                    return r
+            except (ValueError, AttributeError):
+                return r
+        return responses[-1]
+
+    def _can_create_token(self):
+        return None not in (
             self._sl_host,
             self._sl_port,
             self._sl_username,
             self._sl_password,
             self._sl_protocol
-        ):
-            request = requests.post(
+        )
+
+    def create_token(self):
+        if self._can_create_token():
+            request = self._session.post(
                 url="{}://{}:{}/auth/token".format(self._sl_protocol, self._sl_host, self._sl_port),
                 auth=(self._sl_username, self._sl_password),
                 timeout=10,
             )
             if request.status_code == 200:
+                self._m_token_refreshes.inc()
                 access_token = request.json()["access_token"]
                 token_expiration = int(request.json()["expires_in"]) + int(time.time())
                 return access_token, token_expiration
             request.raise_for_status()
         return None, None
 
+    def _set_token(self, token, expiration):
+        self._sl_token = token
+        self._token_expiration = expiration
+        if token:
+            self._headers = {"Authorization": "Bearer " + token}
+        else:
+            self._headers = {}
+        self._token_refresh_at = self._token_stale_at = None
+        if expiration:
+            now = time.time()
+            lifetime = max(0, expiration - now)
+            # Short-lived tokens must not be refreshed continuously
+            skew = min(self._token_skew, lifetime / 2)
+            self._token_stale_at = expiration - skew
+            self._token_refresh_at = min(
+                now + lifetime * self._token_refresh_fraction, self._token_stale_at
+            )
+
+    def refresh_token(self, stale_token=None):
+        """
+        Create a new token, shared by all concurrent callers.
+
+        Callers that pass the token they found to be stale as `stale_token`
+        don't refresh it again if another caller already did.
+        """
+        with self._token_lock:
+            if stale_token is not None and self._sl_token != stale_token:
+                return
+            self._set_token(*self.create_token())
+
+    def _refresh_loop(self):
+        """Refresh the token in the background, before it expires."""
+        delays = backoff_delays(1, self._token_skew)
+        while not self._closed and self._token_refresh_at is not None:
+            wait = self._token_refresh_at - time.time()
+            if wait > 0:
+                _compat.sleep(wait)
+                continue
+            try:
+                self.refresh_token(stale_token=self._sl_token)
+                delays = backoff_delays(1, self._token_skew)
+            except Exception as e:
+                self._log.warning("Exception refreshing token: {}".format(e))
+                _compat.sleep(next(delays))
+
     def check_token_expiration(self):
-        if self._token_expiration:
-            if time.time() >= self._token_expiration:
-                self._sl_token, self._token_expiration = self.create_token()
-                self._headers = {"Authorization": "Bearer " + self._sl_token}
+        # Normally done in the background, unless the refresh is late
+        if self._token_stale_at and time.time() >= self._token_stale_at:
+            self.refresh_token(stale_token=self._sl_token)
+
+
+def _prefetch(iterator, size):
+    """Consume an iterator in a greenlet or thread, up to `size` items ahead."""
+    items = _compat.Queue(size)
+    stop = _compat.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterator:
+                items.put((item, None))
+                if stop.is_set():
+                    return
+        except Exception as e:
+            items.put((done, e))
+        else:
+            items.put((done, None))
+
+    _compat.spawn(produce)
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        # Unblock the producer, which stops after its current item
+        stop.set()
+        while True:
+            try:
+                items.get_nowait()
+            except queue.Empty:
+                break
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+"""
+Audio sources for upload, streamed without intermediate files.
+
+An AudioSource wraps a path, a bytes-like buffer, a file-like object, an
+iterator of byte chunks or a NumPy sample array. Its contents are read lazily
+in chunks, so the upload never needs the whole file in memory.
+"""
+import functools
+import io
+import os
+import struct
+import uuid
+
+
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DURATION_CACHE_SIZE = 4096
+
+_PCM_SUBTYPES = {"PCM_16": ("<i2", 2), "PCM_32": ("<i4", 4)}
+
+
+class AudioSource:
+    """
+    Audio data to be uploaded, from any of the supported input types.
+
+    Parameters
+    ----------
+    data : str, os.PathLike, bytes, file-like, iterable of bytes or numpy.ndarray
+        The audio. Arrays are shaped (frames,) or (frames, channels) and are
+        encoded on the fly to `format`.
+    samplerate : int, optional
+        Sample rate of NumPy arrays. Required for arrays, ignored otherwise.
+    filename : str, optional
+        File name informed to the server. Defaults to the path basename or the
+        `name` attribute of file objects.
+    format : str, optional
+        Encoding of NumPy arrays, "WAV" or "FLAC".
+
+        WAV is streamed as it is encoded. FLAC needs seekable output, so it is
+        encoded in memory when the upload starts.
+
+        Default: "WAV"
+    subtype : str, optional
+        Sample format of encoded NumPy arrays.
+
+        Default: "PCM_16"
+    chunk_size : int, optional
+        Size of the chunks read from the source.
+    """
+
+    def __init__(
+        self,
+        data,
+        samplerate=None,
+        filename=None,
+        format="WAV",
+        subtype="PCM_16",
+        chunk_size=DEFAULT_CHUNK_SIZE,
+    ):
+        self.data = data
+        self.samplerate = samplerate
+        self.format = format.upper()
+        self.subtype = subtype
+        self.chunk_size = chunk_size
+        self.path = None
+        self._start = 0
+
+        if isinstance(data, (str, os.PathLike)):
+            self.kind = "path"
+            self.path = os.fspath(data)
+            default_name = os.path.basename(self.path)
+        elif isinstance(data, (bytes, bytearray, memoryview)):
+            self.kind = "buffer"
+            default_name = None
+        elif _is_array(data):
+            if samplerate is None:
+                raise ValueError("samplerate is required for sample arrays!")
+            if self.format not in ("WAV", "FLAC"):
+                raise ValueError("Invalid format for arrays: {}".format(format))
+            if self.format == "WAV" and subtype not in _PCM_SUBTYPES:
+                raise ValueError("Invalid subtype for WAV: {}".format(subtype))
+            self.kind = "array"
+            default_name = None
+        elif hasattr(data, "read"):
+            self.kind = "file"
+            name = getattr(data, "name", None)
+            default_name = os.path.basename(name) if isinstance(name, str) else None
+            if _seekable(data):
+                self._start = data.tell()
+        elif hasattr(data, "__iter__"):
+            self.kind = "iterator"
+            default_name = None
+        else:
+            raise TypeError("Unsupported audio source: {}".format(type(data)))
+
+        if filename is None:
+            filename = default_name
+        if filename is None:
+            ext = self.format.lower() if self.kind == "array" else "wav"
+            filename = "{}.{}".format(uuid.uuid4().hex, ext)
+        self.filename = filename
+
+    @property
+    def rewindable(self):
+        """Whether the contents may be read more than once."""
+        if self.kind == "iterator":
+            return False
+        if self.kind == "file":
+            return _seekable(self.data)
+        return True
+
+    @property
+    def size(self):
+        """Size in bytes of the contents, or None if unknown beforehand."""
+        if self.kind == "path":
+            return os.path.getsize(self.path)
+        if self.kind == "buffer":
+            return memoryview(self.data).nbytes
+        if self.kind == "file" and _seekable(self.data):
+            pos = self.data.tell()
+            end = self.data.seek(0, io.SEEK_END)
+            self.data.seek(pos)
+            return end - self._start
+        if self.kind == "array" and self.format == "WAV":
+            frames, channels = _array_shape(self.data)
+            return 44 + frames * channels * _PCM_SUBTYPES[self.subtype][1]
+        return None
+
+    def chunks(self):
+        """Generate the contents as byte chunks."""
+        if self.kind == "path":
+            with open(self.path, "rb") as f:
+                yield from _read_chunks(f, self.chunk_size)
+        elif self.kind == "buffer":
+            view = memoryview(self.data).cast("B")
+            for i in range(0, len(view), self.chunk_size):
+                yield view[i : i + self.chunk_size].tobytes()
+        elif self.kind == "file":
+            if _seekable(self.data):
+                self.data.seek(self._start)
+            yield from _read_chunks(self.data, self.chunk_size)
+        elif self.kind == "array":
+            if self.format == "WAV":
+                yield from _wav_chunks(
+                    self.data, self.samplerate, self.subtype, self.chunk_size
+                )
+            else:
+                with _encode(self.data, self.samplerate, self.format, self.subtype) as f:
+                    yield from _read_chunks(f, self.chunk_size)
+        else:
+            for chunk in self.data:
+                if chunk:
+                    yield bytes(chunk)
+
+    def open(self):
+        """Return a binary file-like object with the contents, for decoding."""
+        if self.kind == "path":
+            return open(self.path, "rb")
+        if self.kind == "buffer":
+            return io.BytesIO(self.data)
+        if self.kind == "file" and _seekable(self.data):
+            self.data.seek(self._start)
+            return _Unclosable(self.data)
+        if self.kind == "array":
+            return _encode(self.data, self.samplerate, "WAV", "PCM_16")
+        raise ValueError("{} sources can only be read once".format(self.kind))
+
+    def duration(self):
+        """Duration in seconds, or None if it can't be known before upload."""
+        if self.kind == "array":
+            return _array_shape(self.data)[0] / self.samplerate
+        if self.kind == "path":
+            return audio_duration(self.path)
+        if not self.rewindable:
+            return None
+        with self.open() as f:
+            start = f.tell()
+            duration = probe_duration(f)
+            if duration is None:
+                f.seek(start)
+                duration = _soundfile_duration(f)
+        return duration
+
+
+def as_audio_source(data, **kwargs):
+    """Wrap `data` in an AudioSource, unless it already is one."""
+    if isinstance(data, AudioSource):
+        return data
+    return AudioSource(data, **kwargs)
+
+
+def audio_duration(path):
+    """
+    Duration in seconds of an audio file.
+
+    WAV, FLAC and Ogg (Vorbis/Opus) durations are read from the file headers
+    only. Other formats fall back to soundfile. Results are kept in an LRU
+    cache keyed by path, size and modification time, so unchanged files are
+    never read twice.
+    """
+    path = os.fspath(path)
+    st = os.stat(path)
+    return _cached_duration(path, st.st_size, st.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=DURATION_CACHE_SIZE)
+def _cached_duration(path, size, mtime_ns):
+    with open(path, "rb") as f:
+        duration = probe_duration(f)
+        if duration is None:
+            f.seek(0)
+            duration = _soundfile_duration(f)
+    return duration
+
+
+def probe_duration(f):
+    """
+    Duration in seconds from the headers of a seekable binary file object.
+
+    Returns None if the format is not PCM/float WAV, FLAC or Ogg Vorbis/Opus,
+    or if the headers do not carry the length (e.g. streamed FLAC files).
+    """
+    start = f.tell()
+    head = f.read(12)
+    try:
+        if head[:4] == b"RIFF" and head[8:12] == b"WAVE":
+            return _wav_duration(f)
+        if head[:3] == b"ID3":
+            # Skip an ID3v2 tag, sometimes prepended to FLAC files
+            f.seek(start + 6)
+            size = f.read(4)
+            if len(size) < 4:
+                return None
+            tag_size = 0
+            for b in size:
+                tag_size = (tag_size << 7) | (b & 0x7F)
+            f.seek(start + 10 + tag_size)
+            head = f.read(4)
+        if head[:4] == b"fLaC":
+            f.seek(f.tell() - len(head) + 4)
+            return _flac_duration(f)
+        if head[:4] == b"OggS":
+            f.seek(start)
+            return _ogg_duration(f)
+    except (struct.error, ValueError, ZeroDivisionError):
+        return None
+    return None
+
+
+def _wav_duration(f):
+    block_align = samplerate = None
+    while True:
+        header = f.read(8)
+        if len(header) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack("<4sI", header)
+        if chunk_id == b"fmt ":
+            fmt = f.read(chunk_size + (chunk_size & 1))
+            format_tag, _, samplerate, _, block_align = struct.unpack(
+                "<HHIIH", fmt[:14]
+            )
+            if format_tag not in (1, 3, 0xFFFE):  # Compressed, left to soundfile
+                return None
+        elif chunk_id == b"data":
+            if not samplerate or not block_align:
+                return None
+            if chunk_size in (0, 0xFFFFFFFF):  # Unknown length (streamed)
+                pos = f.tell()
+                chunk_size = f.seek(0, io.SEEK_END) - pos
+            return (chunk_size // block_align) / samplerate
+        else:
+            f.seek(chunk_size + (chunk_size & 1), io.SEEK_CUR)
+
+
+def _flac_duration(f):
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            return None
+        block_type = header[0] & 0x7F
+        length = int.from_bytes(header[1:], "big")
+        if block_type == 0:  # STREAMINFO
+            info = f.read(length)
+            bits = int.from_bytes(info[10:18], "big")
+            samplerate = bits >> 44
+            frames = bits & ((1 << 36) - 1)
+            if not samplerate or not frames:
+                return None
+            return frames / samplerate
+        if header[0] & 0x80:
+            return None
+        f.seek(length, io.SEEK_CUR)
+
+
+def _ogg_duration(f):
+    page = f.read(27)
+    if len(page) < 27:
+        return None
+    serial = page[14:18]
+    segments = f.read(page[26])
+    packet = f.read(sum(segments))
+    if packet[:7] == b"\x01vorbis":
+        samplerate = struct.unpack("<I", packet[12:16])[0]
+        pre_skip = 0
+    elif packet[:8] == b"OpusHead":
+        # Opus granule positions always count 48 kHz samples
+        samplerate = 48000
+        pre_skip = struct.unpack("<H", packet[10:12])[0]
+    else:
+        return None
+
+    # The granule position of the last page is the total number of samples.
+    # Pages are at most ~64 KiB, so the last one is within the file tail.
+    end = f.seek(0, io.SEEK_END)
+    f.seek(max(0, end - 65536 - 27))
+    tail = f.read()
+    i = len(tail)
+    while True:
+        i = tail.rfind(b"OggS", 0, i)
+        if i < 0 or len(tail) - i < 27:
+            return None
+        if tail[i + 14 : i + 18] == serial:
+            granule = struct.unpack("<q", tail[i + 6 : i + 14])[0]
+            if granule >= 0:
+                return max(0, granule - pre_skip) / samplerate
+        i -= 1
+
+
+def _soundfile_duration(f):
+    import soundfile as sf
+
+    info = sf.info(f)
+    return info.frames / info.samplerate
+
+
+class MultipartStream:
+    """
+    A multipart/form-data body generated while it is sent.
+
+    Requests sends iterable bodies as they are produced, with a Content-Length
+    header if `len` is known, or with chunked transfer encoding otherwise.
+    Iterating again restarts the body, which allows retries on connection
+    errors for rewindable sources.
+    """
+
+    def __init__(self, fields, file_field, source):
+        self.boundary = uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary={}".format(self.boundary)
+        self._fields = fields
+        self._file_field = file_field
+        self._source = source
+
+        preamble = []
+        for name, value in fields:
+            preamble.append(
+                '--{}\r\nContent-Disposition: form-data; name="{}"\r\n\r\n{}\r\n'.format(
+                    self.boundary, name, value
+                ).encode("utf-8")
+            )
+        preamble.append(
+            (
+                '--{}\r\nContent-Disposition: form-data; name="{}"; filename="{}"\r\n'
+                "Content-Type: application/octet-stream\r\n\r\n"
+            )
+            .format(self.boundary, file_field, source.filename.replace('"', "%22"))
+            .encode("utf-8")
+        )
+        self._preamble = b"".join(preamble)
+        self._epilogue = "\r\n--{}--\r\n".format(self.boundary).encode("utf-8")
+
+        size = source.size
+        if size is not None:
+            self.len = len(self._preamble) + size + len(self._epilogue)
+        else:
+            self.len = None
+        self.sent = 0
+
+    @property
+    def rewindable(self):
+        return self._source.rewindable
+
+    def __iter__(self):
+        self.sent = 0  # Bytes produced by the last iteration
+        for chunk in self._parts():
+            self.sent += len(chunk)
+            yield chunk
+
+    def _parts(self):
+        yield self._preamble
+        yield from self._source.chunks()
+        yield self._epilogue
+
+
+class _Unclosable(io.BufferedIOBase):
+    """Wraps a caller-owned file object so that closing it is a no-op."""
+
+    def __init__(self, f):
+        self._f = f
+
+    def read(self, size=-1):
+        return self._f.read(size)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._f.seek(offset, whence)
+
+    def tell(self):
+        return self._f.tell()
+
+
+def _is_array(data):
+    return type(data).__module__ == "numpy" and hasattr(data, "shape")
+
+
+def _seekable(f):
+    try:
+        return f.seekable()
+    except AttributeError:
+        return hasattr(f, "seek") and hasattr(f, "tell")
+
+
+def _array_shape(data):
+    frames = data.shape[0]
+    channels = data.shape[1] if data.ndim > 1 else 1
+    return frames, channels
+
+
+def _read_chunks(f, chunk_size):
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def _to_pcm(block, subtype):
+    import numpy as np
+
+    dtype, width = _PCM_SUBTYPES[subtype]
+    if block.dtype.kind == "f":
+        scale = 2 ** (8 * width - 1)
+        block = np.clip(block * scale, -scale, scale - 1)
+    elif block.dtype.kind in "iu" and block.dtype != np.dtype(dtype):
+        # Rescale to the range of the target type, unsigned samples being
+        # centered on the middle of their range, as in 8-bit WAV files
+        bits = 8 * block.dtype.itemsize
+        shift = 8 * width - bits
+        unsigned = block.dtype.kind == "u"
+        block = block.astype(np.int64)
+        if unsigned:
+            block -= 1 << (bits - 1)
+        block = block << shift if shift >= 0 else block >> -shift
+    return block.astype(dtype, copy=False).tobytes()
+
+
+def _wav_chunks(data, samplerate, subtype, chunk_size):
+    frames, channels = _array_shape(data)
+    width = _PCM_SUBTYPES[subtype][1]
+    data_size = frames * channels * width
+    yield struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF",
+        36 + data_size,
+        b"WAVE",
+        b"fmt ",
+        16,
+        1,
+        channels,
+        int(samplerate),
+        int(samplerate) * channels * width,
+        channels * width,
+        8 * width,
+        b"data",
+        data_size,
+    )
+    step = max(1, chunk_size // (channels * width))
+    for i in range(0, frames, step):
+        yield _to_pcm(data[i : i + step], subtype)
+
+
+def _encode(data, samplerate, format, subtype):
+    import soundfile as sf
+
+    f = io.BytesIO()
+    sf.write(f, data, int(samplerate), format=format, subtype=subtype)
+    f.seek(0)
+    return f
@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+"""
+Load balancing of jobs across several transcription servers.
+
+New jobs go to the healthy node with the fewest outstanding jobs, or with the
+lowest observed latency. Each node has its own CircuitBreaker, so a node that
+keeps failing is ejected for a while (passive health checking), and jobs are
+pinned to the node that created them, since only that node knows them.
+"""
+from . import _compat
+from .health import CircuitBreaker
+
+from collections import OrderedDict
+import random
+
+
+STRATEGIES = ("least_outstanding", "latency")
+
+
+class Node:
+    """A transcription server, with its health and load statistics."""
+
+    __slots__ = (
+        "url",
+        "breaker",
+        "outstanding",
+        "in_flight",
+        "latency",
+        "requests",
+        "errors",
+        "jobs",
+    )
+
+    def __init__(self, url, breaker):
+        self.url = url
+        self.breaker = breaker
+        self.outstanding = 0  # Jobs created and not yet collected or deleted
+        self.in_flight = 0  # Requests waiting for a response
+        self.latency = None  # Moving average of the response time, in seconds
+        self.requests = 0
+        self.errors = 0  # Connection errors and 5xx responses
+        self.jobs = 0  # Jobs created
+
+    @property
+    def available(self):
+        """Whether the node may receive calls: not ejected by its breaker."""
+        return self.breaker.state != "open"
+
+    def stats(self):
+        return {
+            "url": self.url,
+            "state": self.breaker.state,
+            "outstanding": self.outstanding,
+            "in_flight": self.in_flight,
+            "latency": self.latency,
+            "requests": self.requests,
+            "errors": self.errors,
+            "jobs": self.jobs,
+        }
+
+
+class Balancer:
+    """
+    Choice of the node of each new job, and pinning of jobs to their node.
+
+    Parameters
+    ----------
+    urls : list of str
+        Base URLs of the transcription servers.
+    strategy : str, optional
+        "least_outstanding" picks the node with the fewest jobs created and
+        not yet collected. "latency" picks the node with the lowest average
+        response time, weighted by its requests in flight.
+
+        Default: "least_outstanding"
+    breaker_threshold, breaker_reset : int, float, optional
+        Failures after which a node is ejected, and for how many seconds.
+    latency_decay : float, optional
+        Weight of each new response time in the moving averages.
+
+        Default: 0.2
+    max_pinned : int, optional
+        Maximum number of job to node pins kept, the oldest being dropped.
+        Jobs not pinned are looked up on all nodes.
+
+        Default: 100000
+    """
+
+    def __init__(
+        self,
+        urls,
+        strategy="least_outstanding",
+        breaker_threshold=5,
+        breaker_reset=30.0,
+        latency_decay=0.2,
+        max_pinned=100000,
+    ):
+        if strategy not in STRATEGIES:
+            raise ValueError("Invalid strategy: {}".format(strategy))
+        if not urls:
+            raise ValueError("At least one URL is required!")
+        self.strategy = strategy
+        self.nodes = [
+            Node(url, CircuitBreaker(breaker_threshold, breaker_reset))
+            for url in urls
+        ]
+        self.latency_decay = latency_decay
+        self.max_pinned = max_pinned
+        self._pins = OrderedDict()  # job_id -> [node, outstanding]
+        self._lock = _compat.Lock()
+
+    def _load(self, node):
+        if self.strategy == "latency":
+            # Unmeasured nodes are tried first
+            return (node.latency or 0.0) * (node.in_flight + 1)
+        return (node.outstanding, node.in_flight)
+
+    def choose(self, exclude=()):
+        """
+        The node for a new job, other than those in `exclude`.
+
+        Ties are broken at random. If all nodes are ejected, any of them is
+        returned, and calling it raises CircuitOpenError.
+        """
+        nodes = [n for n in self.nodes if n not in exclude] or self.nodes
+        candidates = [n for n in nodes if n.available]
+        if not candidates:
+            return random.choice(nodes)
+        loads = [self._load(n) for n in candidates]
+        best = min(loads)
+        return random.choice([n for n, l in zip(candidates, loads) if l == best])
+
+    def observe(self, node, seconds, failed):
+        """Record the response time and outcome of a request to a node."""
+        node.requests += 1
+        if failed:
+            node.errors += 1
+        if node.latency is None:
+            node.latency = seconds
+        else:
+            node.latency += self.latency_decay * (seconds - node.latency)
+
+    def pin(self, job_id, node, created=True):
+        """
+        Record the node of a job.
+
+        New jobs (`created`) count as outstanding on the node. Jobs found by
+        looking them up on the nodes don't.
+        """
+        with self._lock:
+            if created:
+                node.jobs += 1
+                node.outstanding += 1
+            self._pins[job_id] = [node, created]
+            while len(self._pins) > self.max_pinned:
+                _, (old, outstanding) = self._pins.popitem(last=False)
+                if outstanding:
+                    old.outstanding -= 1
+
+    def node_for(self, job_id):
+        """The node of a job, or None if it is not pinned."""
+        pin = self._pins.get(job_id)
+        return None if pin is None else pin[0]
+
+    def release(self, job_id, unpin=False):
+        """
+        Stop counting a job as outstanding, once its result was collected.
+
+        If `unpin` is True (the job was deleted), also forget its node.
+        """
+        with self._lock:
+            pin = self._pins.pop(job_id, None) if unpin else self._pins.get(job_id)
+            if pin is not None and pin[1]:
+                pin[0].outstanding -= 1
+                pin[1] = False
+
+    def stats(self):
+        """Statistics of each node, as a list of dicts."""
+        return [node.stats() for node in self.nodes]
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Local cache of transcription results, keyed by audio content and config.
+
+Any object implementing the ResultCache interface may be given to
+TranscriptionClient as `result_cache`. Values are JSON-serializable dicts.
+"""
+from .audio import as_audio_source
+
+import abc
+from collections import OrderedDict
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+
+def content_key(audio, config=None):
+    """
+    Hash the audio bytes and the config list into a cache key.
+
+    The audio is read in chunks, so it is never loaded whole in memory. Only
+    rewindable sources may be hashed, since they are read again for upload.
+    """
+    source = as_audio_source(audio)
+    if not source.rewindable:
+        raise ValueError("Only rewindable audio sources can be hashed")
+    h = hashlib.sha256()
+    for chunk in source.chunks():
+        h.update(chunk)
+    h.update(b"\0")
+    h.update(json.dumps(list(config or [])).encode("utf-8"))
+    return h.hexdigest()
+
+
+class ResultCache(abc.ABC):
+    """Interface of result cache backends."""
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Return the value stored for `key`, or None."""
+
+    @abc.abstractmethod
+    def set(self, key, value):
+        """Store a value for `key`."""
+
+    @abc.abstractmethod
+    def delete(self, key):
+        """Remove `key` from the cache, if present."""
+
+
+class MemoryResultCache(ResultCache):
+    """In-memory LRU cache, with optional TTL (in seconds)."""
+
+    def __init__(self, max_entries=1024, ttl=None):
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._data = OrderedDict()  # key -> (timestamp, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if self._ttl is not None and time.time() - item[0] > self._ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.time(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self._max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class DiskResultCache(ResultCache):
+    """
+    On-disk cache with one JSON file per entry.
+
+    Entries older than `ttl` seconds are treated as missing and removed. When
+    the total size exceeds `max_size` bytes, the least recently used entries
+    are removed. The age of an entry is its file modification time, and its
+    last use is its access time, set on each hit, so the cache survives
+    restarts and may be shared by several processes.
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the cache, created if needed.
+    max_size : int, optional
+        Maximum total size in bytes.
+
+        Default: 1 GiB
+    ttl : float, optional
+        Time to live of the entries, in seconds. If None, never expire.
+    """
+
+    def __init__(self, directory, max_size=1 << 30, ttl=None):
+        self._log = logging.getLogger("cpqdtrd.cache")
+        self._directory = directory
+        self._max_size = max_size
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(os.path.getsize(p) for p, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self._directory, key[:2], "{}.json".format(key))
+
+    def _entries(self):
+        for root, _, files in os.walk(self._directory):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        yield path, os.stat(path)
+                    except FileNotFoundError:
+                        pass
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            st = os.stat(path)
+            if self._ttl is not None and time.time() - st.st_mtime > self._ttl:
+                self.delete(key)
+                return None
+            with open(path, "r") as f:
+                value = json.load(f)
+            # Mark as recently used, keeping the modification time for the TTL
+            os.utime(path, (time.time(), st.st_mtime))
+            return value
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            self._log.warning("Removing corrupt cache entry {}".format(path))
+            self.delete(key)
+            return None
+
+    def set(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first, so readers never see partial entries
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(value, f)
+        size = os.path.getsize(tmp)
+        with self._lock:
+            try:
+                self._size -= os.path.getsize(path)
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, path)
+            self._size += size
+            if self._size > self._max_size:
+                self._evict()
+
+    def delete(self, key):
+        path = self._path(key)
+        with self._lock:
+            try:
+                size = os.path.getsize(path)
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """Remove expired and least recently used entries until under max_size."""
+        now = time.time()
+        entries = sorted(self._entries(), key=lambda e: e[1].st_atime)
+        self._size = sum(st.st_size for _, st in entries)
+        # Evict down to 90% of the limit, so that eviction doesn't run on
+        # every insertion once the cache is full.
+        target = self._max_size * 0.9
+        for path, st in entries:
+            expired = self._ttl is not None and now - st.st_mtime > self._ttl
+            if not expired and self._size <= target:
+                continue
+            try:
+                os.remove(path)
+                self._size -= st.st_size
+            except FileNotFoundError:
+                pass
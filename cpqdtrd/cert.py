@@ -1,16 +1,41 @@
 # -*- coding: utf-8 -*-
 from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric import ec, rsa
 from cryptography.x509.oid import NameOID
 import ipaddress
 from datetime import datetime, timedelta, timezone
+import logging
+import os
 import re
+import tempfile
 
 
-def create_self_signed_cert(hostname, cert_path, pkey_path):
-    """Generate a certificate and private key, and returns the public key as str."""
-    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+def _generate_key(key_type):
+    if key_type == "rsa":
+        return rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    if key_type == "ec":
+        # Much faster to generate than RSA, with equivalent strength
+        return ec.generate_private_key(ec.SECP256R1())
+    raise ValueError("Invalid key type: {}".format(key_type))
+
+
+def _subject_alt_name(hostname):
+    if re.compile(r"[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}").match(hostname):
+        return x509.IPAddress(ipaddress.ip_address(hostname))
+    return x509.DNSName(hostname)
+
+
+def create_self_signed_cert(
+    hostname, cert_path, pkey_path, key_type="rsa", valid_days=3650
+):
+    """
+    Generate a certificate and private key and write them as PEM.
+
+    `key_type` is "rsa" (2048 bits) or "ec" (P-256). If `cert_path` and
+    `pkey_path` are the same, both are written to a single file.
+    """
+    key = _generate_key(key_type)
     now = datetime.now(timezone.utc)
     subject = issuer = x509.Name(
         [
@@ -22,19 +47,16 @@ def create_self_signed_cert(hostname, cert_path, pkey_path):
         ]
     )
 
-    if re.compile(r"[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}").match(hostname):
-        subject_alt_name = x509.IPAddress(ipaddress.ip_address(hostname))
-    else:
-        subject_alt_name = x509.DNSName(hostname)
+    subject_alt_name = _subject_alt_name(hostname)
 
     cert = (
         x509.CertificateBuilder()
         .subject_name(subject)
         .issuer_name(issuer)
         .public_key(key.public_key())
-        .serial_number(1000)
+        .serial_number(x509.random_serial_number())
         .not_valid_before(now)
-        .not_valid_after(now + timedelta(days=3650))
+        .not_valid_after(now + timedelta(days=valid_days))
         .add_extension(
             x509.SubjectAlternativeName([subject_alt_name]),
             critical=False,
@@ -42,15 +64,71 @@ def create_self_signed_cert(hostname, cert_path, pkey_path):
         .sign(private_key=key, algorithm=hashes.SHA512())
     )
 
-    with open(cert_path, "wb") as f:
-        f.write(cert.public_bytes(serialization.Encoding.PEM))
-    with open(pkey_path, "wb") as f:
-        f.write(
-            key.private_bytes(
-                encoding=serialization.Encoding.PEM,
-                format=serialization.PrivateFormat.TraditionalOpenSSL,
-                encryption_algorithm=serialization.NoEncryption(),
-            )
-        )
+    cert_pem = cert.public_bytes(serialization.Encoding.PEM)
+    key_pem = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+    if cert_path == pkey_path:
+        _write_private(cert_path, cert_pem + key_pem)
+    else:
+        with open(cert_path, "wb") as f:
+            f.write(cert_pem)
+        _write_private(pkey_path, key_pem)
 
     return
+
+
+def _write_private(path, data):
+    """Atomically write a file readable only by the owner."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+def load_or_create_cert(
+    hostname, cache_dir, key_type="ec", valid_days=30, renew_days=7
+):
+    """
+    Reuse a cached self-signed certificate, creating or rotating it if needed.
+
+    The certificate and its private key are kept together in a single PEM
+    file per hostname in `cache_dir`. A new pair is generated if there is
+    none, if it does not match `hostname` or `key_type`, or if it expires in
+    less than `renew_days` days. Files are replaced atomically, so several
+    processes may share the cache.
+
+    Returns the path of the PEM file and the certificate as str.
+    """
+    os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+    path = os.path.join(
+        cache_dir, "{}.{}.pem".format(re.sub(r"[^\w.-]", "_", hostname), key_type)
+    )
+    if os.path.exists(path):
+        try:
+            with open(path, "rb") as f:
+                pem = f.read()
+            cert = x509.load_pem_x509_certificate(pem)
+            san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+            expires = getattr(cert, "not_valid_after_utc", None)
+            if expires is None:  # cryptography < 42
+                expires = cert.not_valid_after.replace(tzinfo=timezone.utc)
+            remaining = expires - datetime.now(timezone.utc)
+            if _subject_alt_name(hostname) in san.value and remaining > timedelta(
+                days=renew_days
+            ):
+                return path, cert.public_bytes(serialization.Encoding.PEM).decode()
+        except Exception as e:
+            logging.getLogger("cpqdtrd.cert").warning(
+                "Invalid cached certificate {}: {}".format(path, e)
+            )
+    create_self_signed_cert(hostname, path, path, key_type, valid_days)
+    with open(path, "rb") as f:
+        cert = x509.load_pem_x509_certificate(f.read())
+    return path, cert.public_bytes(serialization.Encoding.PEM).decode()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+Long-audio mode: split a recording into chunks transcribed as parallel jobs,
+then merge their segments back into a single result.
+
+Chunks are cut at fixed windows, or at the quietest point near each window
+boundary, and extended by an overlap on both sides so that words at the cuts
+are not lost. When merging, segment times are shifted by the chunk offset,
+and each segment is kept only by the chunk that owns its midpoint, which
+removes the duplicates of the overlaps.
+"""
+from .audio import AudioSource
+
+import math
+
+
+# Keys of segment and word dicts holding times in seconds
+TIME_KEYS = ("start_time", "end_time", "start", "end")
+# Keys of segment dicts holding lists of timed items (e.g. words)
+NESTED_KEYS = ("words",)
+
+SILENCE_FRAME = 0.02  # Seconds per energy frame when looking for silence
+
+
+class Chunk:
+    """
+    A section of the recording, transcribed as one job.
+
+    `start` and `end` are the frames read for the job, including overlaps.
+    Segments are owned by the chunk if their midpoint is within
+    [own_start, own_end), in seconds from the start of the recording.
+    """
+
+    __slots__ = ("index", "start", "end", "samplerate", "own_start", "own_end")
+
+    def __init__(self, index, start, end, samplerate, own_start, own_end):
+        self.index = index
+        self.start = start
+        self.end = end
+        self.samplerate = samplerate
+        self.own_start = own_start
+        self.own_end = own_end
+
+    @property
+    def offset(self):
+        """Start of the chunk in seconds."""
+        return self.start / self.samplerate
+
+    @property
+    def duration(self):
+        return (self.end - self.start) / self.samplerate
+
+
+def _quietest(f, start, end, samplerate):
+    """Frame of lowest energy between frames `start` and `end` of a SoundFile."""
+    import numpy as np
+
+    f.seek(start)
+    x = f.read(end - start, dtype="float32", always_2d=True).mean(axis=1)
+    size = max(1, int(SILENCE_FRAME * samplerate))
+    frames = len(x) // size
+    if frames == 0:
+        return (start + end) // 2
+    energy = np.square(x[: frames * size]).reshape(frames, size).sum(axis=1)
+    return start + int(np.argmin(energy)) * size + size // 2
+
+
+def plan_chunks(source, length, overlap=2.0, split="silence", search=None):
+    """
+    Split an AudioSource in chunks of about `length` seconds.
+
+    Parameters
+    ----------
+    source : AudioSource
+        A rewindable source, in a format soundfile can decode.
+    length : float
+        Nominal chunk length in seconds.
+    overlap : float, optional
+        Seconds added on both sides of each cut.
+    split : str, optional
+        "silence" cuts at the quietest point within `search` seconds of each
+        nominal boundary. "fixed" cuts exactly every `length` seconds.
+    search : float, optional
+        Half width of the silence search window.
+
+        Default: 10% of `length`, at most 30 seconds
+
+    Returns
+    -------
+    A list of Chunk, in order.
+    """
+    import soundfile as sf
+
+    if split not in ("silence", "fixed"):
+        raise ValueError("Invalid split: {}".format(split))
+    if length <= 0 or overlap < 0:
+        raise ValueError("length must be positive and overlap non-negative!")
+    if not source.rewindable:
+        raise ValueError("Long-audio mode requires a rewindable audio source")
+    if search is None:
+        search = min(30.0, 0.1 * length)
+
+    with source.open() as raw, sf.SoundFile(raw) as f:
+        rate, total = f.samplerate, f.frames
+        step = int(length * rate)
+        cuts = [0]
+        while total - cuts[-1] > step * 1.5:  # Avoid a tiny last chunk
+            cut = cuts[-1] + step
+            if split == "silence":
+                width = int(search * rate)
+                cut = _quietest(f, max(cuts[-1] + 1, cut - width), cut + width, rate)
+            cuts.append(cut)
+    cuts.append(total)
+
+    pad = int(overlap * rate)
+    chunks = []
+    for i in range(len(cuts) - 1):
+        chunks.append(
+            Chunk(
+                i,
+                max(0, cuts[i] - pad),
+                min(total, cuts[i + 1] + pad),
+                rate,
+                cuts[i] / rate if i > 0 else -math.inf,
+                cuts[i + 1] / rate if i < len(cuts) - 2 else math.inf,
+            )
+        )
+    return chunks
+
+
+def read_chunk(source, chunk):
+    """The audio of a chunk, as an AudioSource encoded to WAV on upload."""
+    import soundfile as sf
+
+    with source.open() as raw, sf.SoundFile(raw) as f:
+        f.seek(chunk.start)
+        data = f.read(chunk.end - chunk.start, dtype="int16")
+    name, _, _ = source.filename.rpartition(".")
+    return AudioSource(
+        data,
+        samplerate=chunk.samplerate,
+        filename="{}.part{}.wav".format(name or source.filename, chunk.index),
+    )
+
+
+def _shift(item, offset):
+    item = dict(item)
+    for key in TIME_KEYS:
+        value = item.get(key)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            item[key] = value + offset
+    for key in NESTED_KEYS:
+        if isinstance(item.get(key), list):
+            item[key] = [
+                _shift(x, offset) if isinstance(x, dict) else x for x in item[key]
+            ]
+    return item
+
+
+def _midpoint(segment):
+    times = [
+        segment[k] for k in TIME_KEYS if isinstance(segment.get(k), (int, float))
+    ][:2]
+    return sum(times) / len(times) if times else None
+
+
+def merge_results(chunks, results):
+    """
+    Merge the results of the chunk jobs into a single result.
+
+    The result has the shape of a regular job result: the job dict is the one
+    of the first chunk, with the worst status among the chunks and a "chunks"
+    list of {"id", "offset", "status"}, and "segments" holds the segments of
+    all chunks in time order, without overlap duplicates.
+    """
+    segments = []
+    chunk_info = []
+    status = "COMPLETED"
+    for chunk, result in zip(chunks, results):
+        job = result.get("job", {})
+        chunk_info.append(
+            {"id": job.get("id"), "offset": chunk.offset, "status": job.get("status")}
+        )
+        if job.get("status") != "COMPLETED" and status == "COMPLETED":
+            status = job.get("status")
+        for segment in result.get("segments") or []:
+            segment = _shift(segment, chunk.offset)
+            midpoint = _midpoint(segment)
+            if midpoint is None or chunk.own_start <= midpoint < chunk.own_end:
+                segments.append(segment)
+    segments.sort(key=lambda s: _midpoint(s) or 0)
+
+    merged = dict(results[0])
+    merged["job"] = dict(results[0].get("job", {}), status=status, chunks=chunk_info)
+    merged["segments"] = segments
+    return merged
@@ -4,21 +4,37 @@ Created on Tue Nov 13 11:14:59 2018
 
 @author: valterf
 """
+from . import _json
+from .admission import OVERLOAD_STATUSES
 from .api import TranscriptionApi
-from .cert import create_self_signed_cert
+from .audio import as_audio_source
+from .cache import content_key
+from .chunking import merge_results, plan_chunks, read_chunk
+from .health import backoff_delays
+from .journal import COLLECTED, COMPLETED, DELETED, SUBMITTED, JobJournal
+from .metrics import CONTENT_TYPE, REGISTRY, callback_metrics
+from .streaming import SegmentStream
+from .tracker import JobTracker
 
-from bson.json_util import loads, ObjectId
 from flask import Flask, request
+from gevent import joinall, sleep, spawn
 from gevent.pywsgi import WSGIServer
-from gevent.event import Event
-import soundfile as sf
+from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore
+from gevent.pool import Group, Pool
+from gevent.queue import Empty, Queue
 
-from collections import defaultdict as dd
+from collections import OrderedDict
+from datetime import datetime, timezone
 import ipaddress
+import itertools
 import logging
 import numbers
 import shutil
+import socket
+import sys
 import tempfile
+import time
 import uuid
 
 
@@ -40,13 +56,120 @@ class TranscriptionClient:
         sl_token=None,
         sl_username=None,
         sl_password=None,
+        api_kwargs=None,
+        polling=False,
+        poller_kwargs=None,
+        result_cache=None,
+        callback_workers=None,
+        callback_executor="thread",
+        callback_queue_size=1000,
+        cert_cache_dir=None,
+        cert_key_type="rsa",
+        metrics=None,
+        metrics_route=False,
+        job_ttl=86400,
+        max_tracked_jobs=100000,
+        broker=None,
+        admission=None,
+        journal=None,
         **flask_kwargs
     ):
+        """
+        Transcription client with results signaled by webhooks.
+
+        `api_url` may be a list of transcription servers, among which new jobs
+        are balanced (see TranscriptionApi and the "balance" api_kwarg).
+
+        If `polling` is True, no webhook server is started. Instead, job
+        completion is detected by a background JobPoller, configured by
+        `poller_kwargs`, and registered callbacks are called with the result
+        fetched from the server. Use it when the transcription server can't
+        reach this client (e.g. behind NAT).
+
+        If `result_cache` is set (see cpqdtrd.cache), `transcribe` looks up
+        results by a hash of the audio content and config before uploading,
+        and concurrent submissions of the same content share a single job.
+
+        If `callback_workers` is set, webhooks are acknowledged as soon as
+        their token is validated, and callbacks run in a CallbackDispatcher
+        with that many workers of the `callback_executor` kind ("thread" or
+        "process") and a queue of `callback_queue_size` calls. Callback errors
+        are then only logged locally. The dispatcher is available as the
+        `dispatcher` attribute, for monitoring.
+
+        The HTTPS webhook certificate is ephemeral by default. Key generation
+        dominates startup time, so short-lived processes may set
+        `cert_cache_dir` to reuse a certificate cached on disk, rotated before
+        it expires (see cert.load_or_create_cert), and/or `cert_key_type="ec"`
+        for a much faster P-256 key instead of RSA.
+
+        Latencies, counters and in-flight gauges of the client and its API
+        wrapper are recorded in `metrics`, a cpqdtrd.metrics.MetricsRegistry
+        (default: cpqdtrd.metrics.REGISTRY), also available as the `metrics`
+        attribute. Hooks added to it are called on each job lifecycle event:
+        "created", "webhook", "signaled", "done", "cancelled" and "evicted". If
+        `metrics_route` is True, the registry is served in the Prometheus text
+        format on the `/metrics` route of the webhook server, so only enable it
+        if that server is not reachable by untrusted clients.
+
+        Jobs awaiting webhooks are kept in a JobTracker, available as the
+        `jobs` attribute, e.g. to list pending jobs and their age. Jobs whose
+        webhooks don't arrive within `job_ttl` seconds, or the oldest ones
+        beyond `max_tracked_jobs`, are evicted: waiting for them raises
+        TranscriptionApi.TimeoutException.
+
+        If `broker` is set (see cpqdtrd.broker), every completion notice is
+        published to it before the webhook is acknowledged, so that other
+        processes or nodes can wait on results with a ResultConsumer, or
+        process them from a shared queue. Callbacks need not be registered in
+        this client: notices of unknown callbacks are only published.
+
+        If `admission` is set (see cpqdtrd.admission.AdmissionController),
+        submissions wait for admission before uploading, so that the jobs in
+        flight stay within a limit adapted to the latency of the server and
+        to its 429/503 responses. It is available as the `admission`
+        attribute, e.g. to read the current limit and waiting count.
+
+        If `journal` is set (a path, or a cpqdtrd.journal.JobJournal), each
+        job is recorded on disk when submitted, completed, collected and
+        deleted. After a restart with the same journal, `resume` picks up the
+        jobs left unfinished.
+        """
         self._log = logging.getLogger(self.__class__.__name__)
 
-        self._result_events = dd(dict)  # Event variable dict
+        self.jobs = JobTracker(job_ttl, max_tracked_jobs, on_evict=self._on_evict)
+        self._expirer = None
+        if job_ttl is not None:
+            self._expirer = spawn(self._expire_loop)
+        self._init_metrics(metrics if metrics is not None else REGISTRY)
+        self._metrics_route = metrics_route
+
+        self.dispatcher = None
+        if callback_workers:
+            from .dispatch import CallbackDispatcher
+
+            self.dispatcher = CallbackDispatcher(
+                executor=callback_executor,
+                workers=callback_workers,
+                max_queue=callback_queue_size,
+                metrics=self.metrics,
+            )
+
+        self.broker = broker
+        self.admission = admission
+        self._own_journal = isinstance(journal, str)
+        self.journal = JobJournal(journal) if self._own_journal else journal
+        self._result_cache = result_cache
+        self._cache_jobs = {}  # content key -> job_id, for jobs in flight
+        self._uploads = {}  # content key -> AsyncResult of job_id, while uploading
+        self._job_keys = OrderedDict()  # job_id -> content key, bounded LRU
+        self._fetches = {}  # job_id -> AsyncResult, for results being fetched
+        # job_id -> [(name, arrived, route)], notices of jobs not tracked yet
+        self._early_notices = OrderedDict()
 
         self._flask_kwargs = flask_kwargs
+        api_kwargs = dict(api_kwargs or {})
+        api_kwargs.setdefault("metrics", self.metrics)
         self.api = TranscriptionApi(
             url=api_url,
             username=username,
@@ -57,8 +180,30 @@ class TranscriptionClient:
             sl_token=sl_token,
             sl_username=sl_username,
             sl_password=sl_password,
+            **api_kwargs
         )
 
+        self._http_server = None
+        self._cert_dir = None
+        self._crt = None
+
+        # User callbacks. Jobs keep the callbacks registered when submitted.
+        self._callbacks = {}
+        self._callback_ids = itertools.count()
+
+        self._poller = None
+        self._stopped = False  # Everything stop() releases is set from here
+        if polling:
+            from .poller import JobPoller
+
+            self._poller = JobPoller(
+                self.api, self._on_polled, **(poller_kwargs or {})
+            )
+            self._poller.start()
+            return
+
+        # The webhook must be validated by the server before any submission
+        self.api.wait_ready()
         if webhook_host is not None:
             self._webhook_host = webhook_host
         else:
@@ -66,11 +211,14 @@ class TranscriptionClient:
         self._webhook_port = webhook_port
         self._webhook_listener = webhook_listener
         self._webhook_protocol = webhook_protocol
-        self._http_server = None
-        self._cert_dir = None
-        self._crt = None
 
-        if cert_path is None and key_path is None:
+        self._cert_cache_dir = cert_cache_dir
+        self._cert_key_type = cert_key_type
+        if cert_cache_dir is not None:
+            if cert_path is not None or key_path is not None:
+                raise ValueError("cert_cache_dir can't be used with cert_path!")
+            self._cert_path = self._key_path = None
+        elif cert_path is None and key_path is None:
             self._cert_dir = tempfile.mkdtemp()
             self._cert_path = "{}/cert".format(self._cert_dir)
             self._key_path = "{}/key".format(self._cert_dir)
@@ -80,11 +228,45 @@ class TranscriptionClient:
             self._cert_path = cert_path
             self._key_path = key_path
 
-        # User callbacks
-        self._callbacks = {}
-
         self._reset_start()
 
+    def _init_metrics(self, registry):
+        self.metrics = registry
+        self._m_submitted = registry.counter(
+            "cpqdtrd_jobs_submitted_total", "Jobs created on the server."
+        )
+        self._m_cache_hits = registry.counter(
+            "cpqdtrd_cache_hits_total",
+            "Submissions answered by the result cache or by a job in flight.",
+        )
+        self._m_in_flight = registry.gauge(
+            "cpqdtrd_jobs_in_flight", "Jobs whose completion is being awaited."
+        )
+        self._m_server = registry.histogram(
+            "cpqdtrd_job_server_seconds",
+            "Time from job creation to its completion notice (queue and processing).",
+        )
+        self._m_job = registry.histogram(
+            "cpqdtrd_job_seconds",
+            "Time from job creation until all its callbacks have run.",
+        )
+        self._m_webhooks = registry.counter(
+            "cpqdtrd_webhooks_total",
+            "Completion notices received, by webhook route or poller.",
+            ("route",),
+        )
+        self._m_signal = registry.histogram(
+            "cpqdtrd_webhook_signal_seconds",
+            "Time from a completion notice until its event is set.",
+            ("route",),
+        )
+        self._m_calls, self._m_callback = callback_metrics(registry)
+        self._m_published = registry.counter(
+            "cpqdtrd_broker_publishes_total",
+            "Completion notices published to the broker, by outcome.",
+            ("outcome",),
+        )
+
     def _reset_start(self):
         """Start the Flask app and the WSGI server."""
         if self._http_server is not None:
@@ -97,39 +279,64 @@ class TranscriptionClient:
             # Root callback is only responsible for signaling that the job will
             # no longer be processed - either by finished, failed, reset or deleted
             # states.
-            result = request.json
+            arrived = time.perf_counter()
+            result = _json.loads(request.get_data())
             if "token" not in result or result["token"] != self._validation_token:
                 raise ValueError("Invalid token")
-            if (
-                job_id in self._result_events
-                and "__root__" in self._result_events[job_id]
-            ):
-                self._result_events[job_id]["__root__"].set()
-                del self._result_events[job_id]["__root__"]
-                if not self._result_events[job_id]:
-                    del self._result_events[job_id]
+            self._m_webhooks.labels("root").inc()
+            self.metrics.job_event("webhook", job_id, name="__root__")
+            if not self._publish(job_id, "__root__", result):
+                return "Broker unavailable", 503
+            self._signal(job_id, "__root__", arrived, "root")
             return "OK", 200
 
-        for name, callback in list(self._callbacks.items()):
-            self.register_callback(callback, name)
+        # A single route serves all callbacks, looked up in the registry on
+        # each call, so that callbacks may change while the server is up.
+        @self._app.route("/<name>/<job_id>", methods=["POST"])
+        def named_callback(name, job_id):
+            r = _json.loads(request.get_data())
+            return self._handle_callback(name, job_id, r)
+
+        if self._metrics_route:
 
+            @self._app.route("/metrics", methods=["GET"])
+            def metrics():
+                return self.metrics.render(), 200, {"Content-Type": CONTENT_TYPE}
+
+        # Webhook responses are written in several sends, which without
+        # TCP_NODELAY wait for the delayed ACK of the transcription server.
+        family = socket.AF_INET6 if ":" in self._webhook_listener else socket.AF_INET
+        listener = WSGIServer.get_listener(
+            (self._webhook_listener, self._webhook_port), family=family
+        )
+        listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
         if self._webhook_protocol == "http":
             self._http_server = WSGIServer(
-                (self._webhook_listener, self._webhook_port),
+                listener,
                 self._app,
                 log=logging.getLogger("WSGIServer"),
                 error_log=logging.getLogger("WSGIError"),
             )
         elif self._webhook_protocol == "https":
+            from .cert import create_self_signed_cert, load_or_create_cert
+
             # Create certificate and private key
-            if self._cert_dir is not None:
+            if self._cert_cache_dir is not None:
+                self._cert_path, self._crt = load_or_create_cert(
+                    self._webhook_host, self._cert_cache_dir, self._cert_key_type
+                )
+                self._key_path = self._cert_path
+            elif self._cert_dir is not None:
                 create_self_signed_cert(
-                    self._webhook_host, self._cert_path, self._key_path
+                    self._webhook_host,
+                    self._cert_path,
+                    self._key_path,
+                    key_type=self._cert_key_type,
                 )
                 with open(self._cert_path, "r") as f:
                     self._crt = f.read()
             self._http_server = WSGIServer(
-                (self._webhook_listener, self._webhook_port),
+                listener,
                 self._app,
                 certfile=self._cert_path,
                 keyfile=self._key_path,
@@ -138,10 +345,17 @@ class TranscriptionClient:
                 do_handshake_on_connect=False,
             )
         else:
+            listener.close()
             raise ValueError("Invalid protocol: {}".format(self._webhook_protocol))
 
         self._http_server.start()
-        self._validation_token = str(uuid.uuid4())
+        token = None
+        if self.journal is not None:
+            # The webhooks of resumed jobs carry the token of the previous run
+            token = self.journal.setting("webhook_token")
+        self._validation_token = token or str(uuid.uuid4())
+        if self.journal is not None and token is None:
+            self.journal.set_setting("webhook_token", self._validation_token)
         r = self.api.webhook_validate(
             "{}://{}".format(self._webhook_protocol, self._webhook_host),
             self._webhook_port,
@@ -162,56 +376,180 @@ class TranscriptionClient:
             )
 
     def __del__(self):
-        self.stop()
+        # At interpreter exit, gevent may be torn down already
+        if sys.is_finalizing():
+            return
+        try:
+            self.stop()
+        except Exception:
+            pass
 
     def stop(self):
+        """Stop the webhook server and the background work. Idempotent."""
+        if getattr(self, "_stopped", True):
+            return
+        self._stopped = True
+        if self._expirer is not None:
+            self._expirer.kill()
+            self._expirer = None
+        if self._poller is not None:
+            self._poller.stop()
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
         if self._http_server is not None:
             self._http_server.stop()
+            self._http_server = None
         if self._cert_dir is not None:
-            shutil.rmtree(self._cert_dir)
+            shutil.rmtree(self._cert_dir, ignore_errors=True)
+            self._cert_dir = None
+        if self.journal is not None and self._own_journal:
+            self.journal.close()
+        self.api.close()
 
     def register_callback(self, callback, name=None):
-        """Register a callback with optional name."""
-        # print("register_callback:", callback, name)
+        """
+        Register a callback with optional name, and return its name.
+
+        The callback is called as callback(job_id, result) for every job
+        submitted afterwards. Registration takes effect immediately.
+        """
         if name is None:
-            name = "_callback_{}".format(len(self._callbacks))
+            name = "_callback_{}".format(next(self._callback_ids))
         elif name[:9] == "_callback":
             raise ValueError("Prefix _callback is reserved for callback names!")
 
         self._callbacks[name] = callback
+        return name
 
-        # Oddly, Flask does not require server restart for adding new endpoints, so
-        # we do it while the WSGI is still up.
-        # Instead of using the decorator, we explicitly use the add_url_rule method to
-        # avoid endpoint name collision.
-        def new_callback(job_id):
-            try:
-                r = request.json
-                if "token" not in r or r["token"] != self._validation_token:
-                    raise ValueError("Invalid token")
-                callback(job_id, r)
-            except Exception:
-                raise
-            finally:  # Emit events regardless of the success of the callback op
-                if (
-                    job_id in self._result_events
-                    and name in self._result_events[job_id]
-                ):
-                    self._result_events[job_id][name].set()
-                    del self._result_events[job_id][name]
-                    if not self._result_events[job_id]:
-                        del self._result_events[job_id]
-
-            # Return status only if successful, so that any callback errors are
-            # logged in the transcription server.
+    def _callback_for(self, job_id, name):
+        """Callback of a job, as registered when the job was submitted."""
+        job = self.jobs.get(job_id)
+        if job is not None and job.callbacks and name in job.callbacks:
+            return job.callbacks[name]
+        return self._callbacks.get(name)
+
+    def _handle_callback(self, name, job_id, r):
+        """Webhook handler for the named callbacks."""
+        arrived = time.perf_counter()
+        if "token" not in r or r["token"] != self._validation_token:
+            raise ValueError("Invalid token")
+        self._m_webhooks.labels("callback").inc()
+        self.metrics.job_event("webhook", job_id, name=name)
+        if not self._publish(job_id, name, r):
+            return "Broker unavailable", 503
+        callback = self._callback_for(job_id, name)
+        if callback is None and self.broker is not None:
+            self._signal(job_id, name, arrived, "callback")
             return "OK", 200
+        if callback is None:
+            self._log.warning("Callback {} not registered".format(name))
+            self._signal(job_id, name, arrived, "callback")
+            return "Callback {} not registered".format(name), 404
 
-        self._app.add_url_rule(
-            "/{}/<job_id>".format(name), name, new_callback, methods=["POST"]
+        if self.dispatcher is not None:
+            # Events are emitted by the dispatcher once the callback has run.
+            # If the queue is full, the server retries later.
+            if not self.dispatcher.submit(
+                callback,
+                (job_id, r),
+                lambda: self._signal(job_id, name, arrived, "callback"),
+            ):
+                return "Callback queue full", 503
+            return "OK", 200
+
+        try:
+            self._run_callback(callback, job_id, r)
+        finally:  # Emit events regardless of the success of the callback op
+            self._signal(job_id, name, arrived, "callback")
+
+        # Return status only if successful, so that any callback errors are
+        # logged in the transcription server.
+        return "OK", 200
+
+    def _publish(self, job_id, name, payload):
+        """Publish a notice to the broker, if any. False if it failed."""
+        if self.broker is None:
+            return True
+        payload = {k: v for k, v in payload.items() if k != "token"}
+        try:
+            self.broker.publish(job_id, name, payload)
+        except Exception as e:
+            self._m_published.labels("error").inc()
+            self._log.warning(
+                "Could not publish notice {} of job {}: {}".format(name, job_id, e)
+            )
+            return False
+        self._m_published.labels("ok").inc()
+        return True
+
+    def _run_callback(self, callback, job_id, r):
+        """Run a callback in the current greenlet, recording its run time."""
+        start = time.perf_counter()
+        try:
+            callback(job_id, r)
+        except Exception:
+            self._m_calls.labels("failed").inc()
+            raise
+        else:
+            self._m_calls.labels("completed").inc()
+        finally:
+            self._m_callback.observe(time.perf_counter() - start)
+
+    def _signal(self, job_id, name, arrived=None, route=None):
+        """
+        Emit the event of a job for a callback name, if being waited.
+
+        `arrived` is the time (time.perf_counter) the completion notice was
+        received, by the webhook `route` or the poller.
+        """
+        job = self.jobs.signal(job_id, name)
+        if job is None:
+            if job_id not in self.jobs:
+                # The webhook may beat the create response: keep the notice
+                # until the job is tracked, or it would wait until evicted
+                self._remember_notice(job_id, name, arrived, route)
+            return
+        now = time.perf_counter()
+        if arrived is not None:
+            self._m_signal.labels(route).observe(now - arrived)
+        if name == "__root__":
+            latency = (arrived or now) - job.created
+            self._m_server.observe(max(latency, 0))
+            if self.journal is not None:
+                self.journal.record(job_id, COMPLETED)
+            if self.admission is not None and latency < 0:
+                # Notice received before the job was tracked: no latency sample
+                self.admission.discard(job_id)
+            elif self.admission is not None:
+                self.admission.complete(job_id, latency)
+        self.metrics.job_event("signaled", job_id, name=name)
+        if not job.pending:
+            self._m_in_flight.dec()
+            self._m_job.observe(now - job.created)
+            self.metrics.job_event("done", job_id)
+
+    def _expire_loop(self):
+        while True:
+            sleep(self.jobs.expire_interval)
+            self.jobs.expire()
+
+    def _on_evict(self, job):
+        """Forget a job whose completion notices didn't arrive in time."""
+        self._log.warning(
+            "Job {} evicted after {:.0f}s, still awaiting {}".format(
+                job.job_id, job.age, sorted(job.pending)
+            )
         )
+        self._m_in_flight.dec()
+        if self.admission is not None:
+            self.admission.discard(job.job_id)
+        self.metrics.job_event("evicted", job.job_id)
+        if self._poller is not None:
+            self._poller.discard(job.job_id)
+        self._forget_cache_job(job.job_id)
 
     def unregister_callback(self, *callback_names):
-        """Unregister one or more named callbacks."""
+        """Unregister one or more named callbacks. Jobs already submitted keep them."""
         names = []
         for name in callback_names:
             if type(name) is int:
@@ -225,18 +563,61 @@ class TranscriptionClient:
             else:
                 self._log.warning("Callback {} not registered".format(name))
 
-        # There's no way to remove endpoints in Flask. Therefore, we need to restart
-        # the server while re-regestring the remaining callbacks
-        self._reset_start()
-
     def unregister_all(self):
-        """Unregister all callbacks."""
-        for name in list(self._callbacks.keys()):
-            del self._callbacks[name]
-        self._reset_start()
+        """Unregister all callbacks. Jobs already submitted keep theirs."""
+        self._callbacks.clear()
+
+    def _on_polled(self, job_id, job):
+        """Run the callbacks of a job reported as finished by the poller."""
+        tracked = self.jobs.get(job_id)
+        names = [n for n in tracked.pending if n != "__root__"] if tracked else []
+        arrived = time.perf_counter()
+        self._m_webhooks.labels("poll").inc()
+
+        def run():
+            if names:
+                try:
+                    r = self.api.result(job_id).json()
+                except Exception as e:
+                    self._log.warning(
+                        "Could not get result of job {}: {}".format(job_id, e)
+                    )
+                    r = {"job": job}
+            for name in names:
+                callback = self._callback_for(job_id, name)
+                if callback is None:
+                    self._signal(job_id, name, arrived, "poll")
+                elif self.dispatcher is not None:
+                    done = lambda name=name: self._signal(job_id, name, arrived, "poll")
+                    while not self.dispatcher.submit(callback, (job_id, r), done):
+                        pass  # No server retries here: wait for room in the queue
+                else:
+                    try:
+                        self._run_callback(callback, job_id, r)
+                    except Exception as e:
+                        self._log.exception(
+                            "Callback {} failed for job {}: {}".format(name, job_id, e)
+                        )
+                    finally:
+                        self._signal(job_id, name, arrived, "poll")
+            self._publish(job_id, "__root__", {"job": job})
+            self._signal(job_id, "__root__", arrived, "poll")
+
+        spawn(run)
 
     def transcribe(
-        self, path, tag=None, config=None, timeout="auto", delete_after=True
+        self,
+        path,
+        tag=None,
+        config=None,
+        timeout="auto",
+        delete_after=True,
+        samplerate=None,
+        filename=None,
+        chunk_length=None,
+        chunk_overlap=2.0,
+        chunk_split="silence",
+        chunk_concurrency=4,
     ):
         """
         Transcribe an audio file.
@@ -247,8 +628,8 @@ class TranscriptionClient:
 
         Parameters
         ----------
-        path : str
-            Path of the audio file.
+        path : str, bytes, file-like, iterable of bytes, numpy.ndarray or AudioSource
+            Path of the audio file, or the audio itself (see AudioSource).
         timeout : str or float, optional
             Sets a timeout (in seconds) fot the result operation
 
@@ -257,7 +638,8 @@ class TranscriptionClient:
             If == 0, waits indefinitely
 
             If 'auto', the timeout is set as the max between 30 and the audio length
-            in seconds.
+            in seconds. If the length can't be known beforehand (e.g. audio from
+            an iterator), waits indefinitely.
 
             Default: 'auto'
         delete_after : bool, optional
@@ -266,42 +648,435 @@ class TranscriptionClient:
             the wait_result method.
 
             Default: True
+        samplerate : int, optional
+            Sample rate of the audio, required if it is a NumPy array.
+        filename : str, optional
+            File name informed to the server for in-memory audio.
+        chunk_length : float, optional
+            Enables the long-audio mode: audio longer than 1.5 * chunk_length
+            seconds is split in chunks of about this length, transcribed as
+            parallel jobs. Their segments are merged in a single result, with
+            times relative to the start of the audio. With timeout 'auto', the
+            timeout applies to each chunk. Requires timeout >= 0.
+        chunk_overlap : float, optional
+            Seconds of audio added on both sides of each cut. Segments
+            transcribed twice in the overlaps are kept only once.
+
+            Default: 2.0
+        chunk_split : str, optional
+            "silence" cuts at the quietest point near each chunk boundary,
+            "fixed" cuts exactly every chunk_length seconds.
+
+            Default: "silence"
+        chunk_concurrency : int, optional
+            Maximum number of chunk jobs running at the same time.
+
+            Default: 4
 
         Returns
         -------
         Only the job id if timeout < 0, or a tuple (job_id: str, result: dict)
+
+        In long-audio mode, job_id is the id of the first chunk job, and
+        result["job"]["chunks"] lists the id, offset and status of each chunk.
         """
+        source = as_audio_source(path, samplerate=samplerate, filename=filename)
+        if chunk_length is not None:
+            chunks = plan_chunks(source, chunk_length, chunk_overlap, chunk_split)
+            if len(chunks) > 1:
+                return self._transcribe_chunks(
+                    source,
+                    chunks,
+                    tag,
+                    config,
+                    timeout,
+                    delete_after,
+                    chunk_concurrency,
+                )
+        duration = None
         if timeout == "auto":
-            with sf.SoundFile(path) as f:
-                timeout = len(f) / f.samplerate
-            timeout = max(30, timeout)
+            duration = source.duration()
+            timeout = 0 if duration is None else max(30, duration)
         elif not isinstance(timeout, numbers.Number):
             raise ValueError("Invalid value for timeout: {}".format(timeout))
 
+        key = None
+        if self._result_cache is not None and source.rewindable:
+            key = content_key(source, config)
+            job_id = self._cache_jobs.get(key)
+            upload = self._uploads.get(key) if job_id is None else None
+            if upload is not None:
+                # Same content being uploaded: share its job, or its error
+                job_id = upload.get()
+            if job_id is None:
+                cached = self._result_cache.get(key)
+                if cached is not None:
+                    job_id = cached["job_id"]
+                    self._log.debug("Cache hit for job {}".format(job_id))
+            if job_id is not None:
+                # Result cached or job in flight: don't submit again
+                self._m_cache_hits.inc()
+                self._remember_key(job_id, key)
+                if timeout < 0:
+                    return job_id
+                return job_id, self.wait_result(job_id, timeout, delete_after)
+
         # Set webhooks in the request
-        webhook_root = "{}://{}:{}".format(
-            self._webhook_protocol, self._webhook_host, self._webhook_port
-        )
-        webhooks = [webhook_root]
-        webhooks += ["{}/{}".format(webhook_root, name) for name in self._callbacks]
+        callbacks = dict(self._callbacks)
+        if self._poller is not None:
+            webhooks = []
+        else:
+            webhook_root = "{}://{}:{}".format(
+                self._webhook_protocol, self._webhook_host, self._webhook_port
+            )
+            webhooks = [webhook_root]
+            webhooks += ["{}/{}".format(webhook_root, name) for name in callbacks]
 
         # Upload audio file. Currently only expects
-        r = self.api.create(path, tag=tag, config=config, callbacks_url=webhooks)
-        r.raise_for_status()
-        job = r.json()["job"]
+        if self.admission is not None and duration is None and source.rewindable:
+            try:
+                duration = source.duration()
+            except Exception:
+                pass
+        upload = None
+        if key is not None:
+            upload = self._uploads[key] = AsyncResult()
+        try:
+            job = self._create(source, tag, config, webhooks, duration)
+        except BaseException as e:
+            if upload is not None:
+                del self._uploads[key]
+                upload.set_exception(e)
+            raise
         job_id = job["id"]
+        self._m_submitted.inc()
+        self.metrics.job_event("created", job_id, tag=tag)
+        if self.journal is not None:
+            self.journal.record(job_id, SUBMITTED, tag, callbacks, delete_after)
+        if key is not None:
+            self._cache_jobs[key] = job_id
+            self._remember_key(job_id, key)
 
-        # Init events and start transcription. Return job_id if timeout < 0
-        self._result_events[job_id]["__root__"] = Event()
-        for name in self._callbacks:
-            self._result_events[job_id][name] = Event()
+        # Track the notices of the job. Return job_id if timeout < 0
+        self.jobs.add(job_id, ["__root__"] + list(callbacks), callbacks or None)
+        self._m_in_flight.inc()
+        for notice in self._early_notices.pop(job_id, ()):
+            self._signal(job_id, *notice)
+        if upload is not None:
+            del self._uploads[key]
+            upload.set(job_id)
+        if self._poller is not None:
+            if duration is None and source.rewindable:
+                try:
+                    duration = source.duration()
+                except Exception:
+                    pass
+            self._poller.add(job_id, duration)
 
         if timeout < 0:
             return job_id
 
         return job_id, self.wait_result(job_id, timeout, delete_after)
 
-    def wait_result(self, job_id, timeout=0, delete_after=True):
+    def _create(self, source, tag, config, webhooks, duration):
+        """Create a job, through admission control if enabled. Returns the job."""
+        if self.admission is None:
+            r = self.api.create(source, tag=tag, config=config, callbacks_url=webhooks)
+            r.raise_for_status()
+            return r.json()["job"]
+
+        delays = backoff_delays(1.0, 30.0)
+        for attempt in itertools.count():
+            self.admission.acquire()
+            try:
+                r = self.api.create(
+                    source, tag=tag, config=config, callbacks_url=webhooks
+                )
+            except Exception:
+                self.admission.abort()
+                raise
+            if r.status_code in OVERLOAD_STATUSES:
+                self.admission.reject()
+                if attempt < self.admission.retries and source.rewindable:
+                    self._log.info("Server overloaded, queueing submission again")
+                    r.close()
+                    sleep(next(delays))
+                    continue
+                r.raise_for_status()
+            try:
+                r.raise_for_status()
+                job = r.json()["job"]
+            except Exception:
+                self.admission.abort()
+                raise
+            self.admission.admit(job["id"], duration)
+            return job
+
+    def _transcribe_chunks(
+        self, source, chunks, tag, config, timeout, delete_after, concurrency
+    ):
+        if timeout != "auto" and (
+            not isinstance(timeout, numbers.Number) or timeout < 0
+        ):
+            raise ValueError("Invalid timeout for long-audio mode: {}".format(timeout))
+
+        slots = BoundedSemaphore(concurrency)
+        workers = Group()
+        in_flight = set()
+
+        def work(chunk):
+            chunk_timeout = max(30, chunk.duration) if timeout == "auto" else timeout
+            with slots:
+                job_id = self.transcribe(
+                    read_chunk(source, chunk), tag=tag, config=config, timeout=-1
+                )
+                in_flight.add(job_id)
+                result = self.wait_result(job_id, chunk_timeout, delete_after)
+            if result is False:
+                raise TranscriptionApi.TimeoutException(
+                    "Chunk {} (job {}) timed out after {}s".format(
+                        chunk.index, job_id, chunk_timeout
+                    )
+                )
+            in_flight.discard(job_id)
+            return result
+
+        self._log.debug(
+            "Transcribing {} in {} chunks".format(source.filename, len(chunks))
+        )
+        greenlets = [workers.spawn(work, chunk) for chunk in chunks]
+        try:
+            # Raises the first error as soon as it happens
+            joinall(greenlets, raise_error=True)
+        except BaseException:
+            # A partial transcription is useless: stop the other chunks
+            workers.kill()
+            for job_id in list(in_flight):
+                self._cancel(job_id)
+            raise
+        merged = merge_results(chunks, [g.value for g in greenlets])
+        return merged["job"].get("id"), merged
+
+    def transcribe_many(
+        self,
+        paths,
+        concurrency=4,
+        max_pending=None,
+        tag=None,
+        config=None,
+        timeout=0,
+        delete_after=True,
+        cancel_pending=True,
+    ):
+        """
+        Transcribe many audio files, yielding each result as soon as it is ready.
+
+        At most `concurrency` uploads run at the same time, and at most
+        `max_pending` jobs may be submitted and not yet consumed by the caller.
+        When this limit is reached, no new files are read from `paths` until
+        the caller consumes a result, so `paths` may be a lazy iterable.
+
+        Closing the generator (e.g. breaking out of the loop) stops the batch:
+        paths not yet uploaded are skipped, and jobs still being processed are
+        deleted on the server if `cancel_pending` is True.
+
+        Parameters
+        ----------
+        paths : iterable of str
+            Paths of the audio files.
+        concurrency : int, optional
+            Maximum number of simultaneous uploads.
+
+            Default: 4
+        max_pending : int, optional
+            Maximum number of jobs submitted but not yet yielded.
+
+            Default: 4 * concurrency
+        timeout : float, optional
+            Timeout (in seconds) for each job, as in the wait_result method.
+            If reached, the item is reported with a TimeoutException.
+
+            Default: 0 (waits indefinitely)
+        delete_after : bool, optional
+            Whether the results are deleted on the server after obtained.
+
+            Default: True
+        cancel_pending : bool, optional
+            Whether submitted jobs are deleted if the batch is stopped early.
+
+            Default: True
+
+        Yields
+        ------
+        Tuples (path: str, job_id: str, result), in completion order. If an item
+        fails, result is the raised exception, and job_id is None if the
+        upload itself failed.
+        """
+        if not isinstance(timeout, numbers.Number):
+            raise ValueError("Invalid value for timeout: {}".format(timeout))
+        if max_pending is None:
+            max_pending = 4 * concurrency
+        if max_pending < concurrency:
+            raise ValueError("max_pending must be at least equal to concurrency!")
+
+        upload_slots = BoundedSemaphore(concurrency)
+        pending_slots = BoundedSemaphore(max_pending)
+        done = Queue()
+        workers = Group()
+        in_flight = set()
+        finished = object()
+
+        def work(path):
+            job_id = None
+            try:
+                with upload_slots:
+                    job_id = self.transcribe(
+                        path, tag=tag, config=config, timeout=-1
+                    )
+                in_flight.add(job_id)
+                result = self.wait_result(job_id, timeout, delete_after)
+                in_flight.discard(job_id)
+                if result is False:
+                    raise TranscriptionApi.TimeoutException(
+                        "Job {} timed out after {}s".format(job_id, timeout)
+                    )
+                done.put((path, job_id, result))
+            except Exception as e:
+                self._log.warning("Error transcribing {}: {}".format(path, e))
+                done.put((path, job_id, e))
+
+        def feed():
+            try:
+                for path in paths:
+                    pending_slots.acquire()
+                    workers.spawn(work, path)
+                workers.join()
+            except Exception as e:
+                done.put((finished, e))
+            else:
+                done.put((finished, None))
+
+        feeder = spawn(feed)
+        try:
+            while True:
+                item = done.get()
+                if item[0] is finished:
+                    if item[1] is not None:
+                        raise item[1]
+                    return
+                pending_slots.release()
+                yield item
+        finally:
+            feeder.kill()
+            workers.kill()
+            if cancel_pending:
+                for job_id in list(in_flight):
+                    self._cancel(job_id)
+
+    def _cancel(self, job_id):
+        """Stop tracking a submitted job and delete it on the server."""
+        self._log.info("Cancelling job {}".format(job_id))
+        if self.jobs.discard(job_id) is not None:
+            self._m_in_flight.dec()
+        if self.admission is not None:
+            self.admission.discard(job_id)
+        self.metrics.job_event("cancelled", job_id)
+        self._forget_cache_job(job_id)
+        try:
+            self.api.delete(job_id)
+        except Exception as e:
+            self._log.warning("Could not delete job {}: {}".format(job_id, e))
+        else:
+            if self.journal is not None:
+                self.journal.record(job_id, DELETED)
+
+    def resume(self, collect=True):
+        """
+        Resume the jobs left unfinished in the journal by a previous run.
+
+        Their status is reconciled with a single paginated query. Jobs no
+        longer on the server are marked as deleted in the journal. The others
+        are tracked again, with the callbacks now registered under the names
+        they were submitted with, so register callbacks before resuming. The
+        callbacks of jobs which finished meanwhile are run with the fetched
+        result; those of jobs still running are called by their webhooks,
+        which reach this client if it listens at the same address (the
+        validation token is kept in the journal). As the server may still be
+        retrying webhooks that failed while the client was down, callbacks of
+        resumed jobs may run more than once.
+
+        Parameters
+        ----------
+        collect : bool, optional
+            Whether the results are collected in the background, and deleted
+            from the server if the job was submitted with delete_after.
+            Otherwise, call wait_result for each resumed job.
+
+            Default: True
+
+        Returns
+        -------
+        The list of resumed job ids.
+        """
+        from .poller import TERMINAL_STATUSES, job_from_document
+
+        if self.journal is None:
+            raise ValueError("resume requires a journal!")
+        entries = {e.job_id: e for e in self.journal.unfinished()}
+        if not entries:
+            return []
+        oldest = min(e.created for e in entries.values())
+        found = {}
+        for doc in self.api.iter_query(
+            projection=["id", "status"],
+            start_date=datetime.fromtimestamp(oldest - 300, timezone.utc),
+            limit=500,
+        ):
+            job = job_from_document(doc)
+            if job.get("id") in entries:
+                found[job["id"]] = job
+
+        resumed = []
+        for job_id, entry in entries.items():
+            job = found.get(job_id)
+            if job is None:
+                self._log.warning("Job {} not found on the server".format(job_id))
+                self.journal.record(job_id, DELETED)
+                continue
+            if entry.state == COLLECTED:
+                spawn(self._collect_resumed, job_id, True, False)
+                continue
+            callbacks = {}
+            for name in entry.callbacks:
+                if name in self._callbacks:
+                    callbacks[name] = self._callbacks[name]
+                else:
+                    self._log.warning(
+                        "Callback {} of job {} not registered".format(name, job_id)
+                    )
+            self.jobs.add(job_id, ["__root__"] + list(callbacks), callbacks or None)
+            self._m_in_flight.inc()
+            resumed.append(job_id)
+            if job.get("status") in TERMINAL_STATUSES:
+                self._on_polled(job_id, job)
+            elif self._poller is not None:
+                self._poller.add(job_id)
+            if collect:
+                spawn(self._collect_resumed, job_id, entry.delete_after, True)
+        self._log.info("Resumed {} jobs".format(len(resumed)))
+        return resumed
+
+    def _collect_resumed(self, job_id, delete_after, fetch):
+        try:
+            if fetch:
+                self.wait_result(job_id, 0, delete_after)
+            else:
+                self.api.delete(job_id)
+                self.journal.record(job_id, DELETED)
+        except Exception as e:
+            self._log.warning("Could not collect job {}: {}".format(job_id, e))
+
+    def wait_result(self, job_id, timeout=0, delete_after=True, stream=False):
         """
         Wait for the result of an audio file (Job).
 
@@ -323,21 +1098,274 @@ class TranscriptionClient:
             Whether the results are deleted on the server after obtaining the result.
 
             Default: True
+        stream : bool, optional
+            Whether the result is decoded while downloaded. A
+            cpqdtrd.streaming.SegmentStream is returned instead of the dict,
+            yielding the segments one at a time, so that memory use doesn't
+            grow with the result size. If delete_after is True, the result is
+            deleted once the stream is read to the end. Streamed results are
+            not cached.
+
+            Default: False
         Returns
         -------
         The transcription result as a dict or False if timeout < 0 and not completed.
+        Raises TranscriptionApi.TimeoutException if the job was evicted from
+        the tracker before its webhooks arrived.
         """
-        if job_id in self._result_events:
-            if timeout > 0:
-                for event in list(self._result_events[job_id].values()):
-                    if not event.wait(timeout):
-                        return False
-            elif timeout < 0:
+        job = self.jobs.get(job_id)
+        if job is not None:
+            if timeout < 0:
                 return False
-            else:
-                for event in list(self._result_events[job_id].values()):
-                    event.wait()
-        result = self.api.result(job_id).json()
-        if delete_after:
-            self.api.delete(job_id)
+            if not self.jobs.waiter(job).wait(timeout if timeout > 0 else None):
+                return False
+            if job.evicted:
+                raise self._evicted_error(job_id)
+        if stream:
+            return self._stream(job_id, delete_after)
+        return self._collect(job_id, delete_after)
+
+    def _stream(self, job_id, delete_after, chunk_size=65536):
+        """Open the result of a completed job as a SegmentStream."""
+        r = self.api.result(job_id, stream=True)
+        if r.status_code != 200:
+            r.close()
+            r.raise_for_status()
+            raise ValueError("Unexpected response {} for job {}".format(r, job_id))
+
+        def on_close(complete):
+            r.close()
+            # Streamed results are not cached: later submissions upload again
+            self._forget_cache_job(job_id)
+            if not complete:
+                return
+            if self.journal is not None:
+                self.journal.record(job_id, COLLECTED, delete_after=delete_after)
+            if delete_after:
+                self.api.delete(job_id)
+                if self.journal is not None:
+                    self.journal.record(job_id, DELETED)
+
+        return SegmentStream(r.iter_content(chunk_size), on_close)
+
+    def _evicted_error(self, job_id):
+        return TranscriptionApi.TimeoutException(
+            "Job {} evicted before its completion notices".format(job_id)
+        )
+
+    def _collect(self, job_id, delete_after):
+        """Fetch the result of a completed job, and delete it if requested."""
+        key = self._job_keys.get(job_id)
+        if key is not None and key not in self._cache_jobs:
+            cached = self._result_cache.get(key)
+            if cached is not None and cached["job_id"] == job_id:
+                return cached["result"]
+
+        # Several greenlets may wait on the same job, when it is shared by
+        # submissions of the same content. Only one of them fetches it.
+        fetch = self._fetches.get(job_id)
+        if fetch is not None:
+            return fetch.get()
+        fetch = self._fetches[job_id] = AsyncResult()
+        try:
+            result = _json.loads(self.api.result(job_id).content)
+            if self.journal is not None:
+                self.journal.record(job_id, COLLECTED, delete_after=delete_after)
+            if delete_after:
+                self.api.delete(job_id)
+                if self.journal is not None:
+                    self.journal.record(job_id, DELETED)
+            if key is not None:
+                self._store_cached(key, job_id, result)
+            fetch.set(result)
+        except Exception as e:
+            self._forget_cache_job(job_id)
+            fetch.set_exception(e)
+            raise
+        finally:
+            del self._fetches[job_id]
         return result
+
+    def wait_any(self, job_ids, timeout=0, delete_after=True):
+        """
+        Wait for the first of several jobs to complete.
+
+        Only the result of that job is fetched: the others can still be
+        waited on.
+
+        Parameters
+        ----------
+        job_ids : iterable of str
+            The IDs of the jobs to wait for.
+        timeout : float, optional
+            Timeout in seconds, as in the wait_result method.
+
+            Default: 0 (waits indefinitely)
+        delete_after : bool, optional
+            Whether the result is deleted on the server after obtained.
+
+            Default: True
+
+        Returns
+        -------
+        A tuple (job_id, result), or False on timeout. Raises
+        TranscriptionApi.TimeoutException if the first job to finish was
+        evicted from the tracker before its webhooks arrived.
+        """
+        job_ids = list(dict.fromkeys(job_ids))
+        if not job_ids:
+            raise ValueError("No jobs to wait for!")
+        ready = Queue()
+        notify = lambda job_id, evicted: ready.put((job_id, evicted))  # noqa: E731
+        self.jobs.watch(job_ids, notify)
+        try:
+            job_id, evicted = ready.get(
+                timeout=max(timeout, 0) if timeout else None
+            )
+        except Empty:
+            return False
+        finally:
+            self.jobs.unwatch(job_ids, notify)
+        if evicted:
+            raise self._evicted_error(job_id)
+        return job_id, self._collect(job_id, delete_after)
+
+    def as_completed(self, job_ids, timeout=0, delete_after=True, concurrency=8):
+        """
+        Wait for several jobs, yielding each result as soon as it is ready.
+
+        A single queue receives the completion of all jobs, and the results
+        are fetched (and deleted) by a pool of `concurrency` greenlets, so
+        slow fetches don't hold back the jobs completed after them.
+
+        Parameters
+        ----------
+        job_ids : iterable of str
+            The IDs of the jobs to wait for.
+        timeout : float, optional
+            Global deadline in seconds for the jobs to complete. Results of
+            jobs completed before it are still fetched and yielded. If < 0,
+            only jobs already completed are yielded.
+
+            Default: 0 (waits indefinitely)
+        delete_after : bool, optional
+            Whether the results are deleted on the server after obtained.
+
+            Default: True
+        concurrency : int, optional
+            Maximum number of simultaneous result fetches.
+
+            Default: 8
+
+        Yields
+        ------
+        Tuples (job_id, result), in completion order. If fetching a result
+        fails, or the job was evicted from the tracker, result is the raised
+        exception. Raises TranscriptionApi.TimeoutException, after the last
+        result, if some jobs didn't complete before the deadline.
+        """
+        if not isinstance(timeout, numbers.Number):
+            raise ValueError("Invalid value for timeout: {}".format(timeout))
+        job_ids = list(dict.fromkeys(job_ids))
+        deadline = time.monotonic() + max(timeout, 0) if timeout else None
+        ready = Queue()
+        done = Queue()
+        fetches = Pool(concurrency)
+        finished = object()
+
+        def collect(job_id, evicted):
+            try:
+                if evicted:
+                    raise self._evicted_error(job_id)
+                done.put((job_id, self._collect(job_id, delete_after)))
+            except Exception as e:
+                self._log.warning("Could not collect job {}: {}".format(job_id, e))
+                done.put((job_id, e))
+
+        def feed():
+            for _ in job_ids:
+                remaining = None
+                if deadline is not None:
+                    remaining = max(deadline - time.monotonic(), 0)
+                try:
+                    item = ready.get(timeout=remaining)
+                except Empty:
+                    break
+                fetches.spawn(collect, *item)  # Blocks while the pool is full
+            fetches.join()
+            done.put((finished, None))
+
+        notify = lambda job_id, evicted: ready.put((job_id, evicted))  # noqa: E731
+        self.jobs.watch(job_ids, notify)
+        feeder = spawn(feed)
+        yielded = set()
+        try:
+            while True:
+                item = done.get()
+                if item[0] is finished:
+                    break
+                yielded.add(item[0])
+                yield item
+        finally:
+            feeder.kill()
+            fetches.kill()
+            self.jobs.unwatch(job_ids, notify)
+        if len(yielded) < len(job_ids):
+            raise TranscriptionApi.TimeoutException(
+                "{} of {} jobs not completed after {}s".format(
+                    len(job_ids) - len(yielded), len(job_ids), timeout
+                )
+            )
+
+    def wait_all(self, job_ids, timeout=0, delete_after=True, concurrency=8):
+        """
+        Wait for several jobs, with a global deadline.
+
+        Parameters are those of the as_completed method.
+
+        Returns
+        -------
+        A dict of the results by job id, in the order of `job_ids`. The result
+        is False for jobs not completed before the deadline, and the raised
+        exception for jobs whose result could not be obtained.
+        """
+        job_ids = list(dict.fromkeys(job_ids))
+        results = dict.fromkeys(job_ids, False)
+        try:
+            for job_id, result in self.as_completed(
+                job_ids, timeout, delete_after, concurrency
+            ):
+                results[job_id] = result
+        except TranscriptionApi.TimeoutException:
+            pass
+        return results
+
+    def _remember_key(self, job_id, key, max_size=100000):
+        self._job_keys[job_id] = key
+        self._job_keys.move_to_end(job_id)
+        while len(self._job_keys) > max_size:
+            self._job_keys.popitem(last=False)
+
+    def _remember_notice(self, job_id, name, arrived, route, max_size=10000):
+        # Notices of unknown jobs (e.g. already collected) are kept as well,
+        # the oldest being dropped
+        self._early_notices.setdefault(job_id, []).append((name, arrived, route))
+        while len(self._early_notices) > max_size:
+            self._early_notices.popitem(last=False)
+
+    def _forget_cache_job(self, job_id):
+        """Stop sharing a job with new submissions of the same content."""
+        key = self._job_keys.get(job_id)
+        if key is not None and self._cache_jobs.get(key) == job_id:
+            del self._cache_jobs[key]
+
+    def _store_cached(self, key, job_id, result):
+        """Store a result in the cache, if the job completed."""
+        if self._cache_jobs.get(key) == job_id:
+            del self._cache_jobs[key]
+        if result.get("job", {}).get("status") != "COMPLETED":
+            return
+        try:
+            self._result_cache.set(key, {"job_id": job_id, "result": result})
+        except Exception as e:
+            self._log.warning("Could not cache result of {}: {}".format(job_id, e))
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Columnar export of transcription results, for analytics.
+
+Job results (or documents from `TranscriptionApi.iter_query(get_result=True)`)
+are flattened into one row per segment, and accumulated in column batches of
+a bounded size: NumPy arrays, Arrow record batches, or Parquet and Arrow IPC
+files written batch by batch. Results may come from a lazy iterable, so the
+whole result set is never held in memory.
+
+NumPy and PyArrow are optional dependencies, imported when first needed.
+"""
+from ._json import loads
+
+import math
+
+
+COLUMNS = ("job_id", "start_time", "end_time", "text", "confidence", "speaker")
+
+# Keys looked up in each segment for the columns, first found wins
+SEGMENT_KEYS = {
+    "start_time": ("start_time", "start"),
+    "end_time": ("end_time", "end"),
+    "text": ("text", "transcription"),
+    "confidence": ("score", "confidence"),
+    "speaker": ("speaker", "channel"),
+}
+
+FLOAT_COLUMNS = ("start_time", "end_time", "confidence")
+
+
+def _job_id(doc):
+    job = doc.get("job")
+    if isinstance(job, dict):
+        doc = job
+    job_id = doc.get("id", doc.get("_id"))
+    return None if job_id is None else str(job_id)
+
+
+def _segments(doc):
+    if "segments" in doc:
+        return doc["segments"] or []
+    result = doc.get("result")
+    if isinstance(result, dict):
+        return result.get("segments") or []
+    if isinstance(result, list):
+        return result
+    return []
+
+
+def _lookup(segment, keys):
+    for key in keys:
+        value = segment.get(key)
+        if value is not None:
+            return value
+    return None
+
+
+def iter_columns(results, batch_size=65536):
+    """
+    Flatten results into batches of columns.
+
+    Parameters
+    ----------
+    results : iterable
+        Job results as dicts, or as JSON str/bytes, e.g. webhook payloads,
+        `api.result(job_id).content` or query documents with results.
+    batch_size : int, optional
+        Maximum number of rows (segments) per batch.
+
+        Default: 65536
+
+    Yields
+    ------
+    Dicts of lists by column name (see COLUMNS), with at most `batch_size`
+    rows. Missing values are None.
+    """
+    if batch_size <= 0:
+        raise ValueError("batch_size must be positive!")
+    columns = {name: [] for name in COLUMNS}
+    rows = 0
+    for doc in results:
+        if isinstance(doc, (str, bytes, bytearray)):
+            doc = loads(doc)
+        job_id = _job_id(doc)
+        for segment in _segments(doc):
+            columns["job_id"].append(job_id)
+            for name, keys in SEGMENT_KEYS.items():
+                columns[name].append(_lookup(segment, keys))
+            rows += 1
+            if rows == batch_size:
+                yield columns
+                columns = {name: [] for name in COLUMNS}
+                rows = 0
+    if rows:
+        yield columns
+
+
+def _as_str(values):
+    # Speakers may be numbered, e.g. by channel
+    return [None if v is None else str(v) for v in values]
+
+
+def _to_numpy(columns):
+    import numpy as np
+
+    arrays = {}
+    for name, values in columns.items():
+        if name in FLOAT_COLUMNS:
+            arrays[name] = np.fromiter(
+                (math.nan if v is None else v for v in values),
+                dtype=np.float64,
+                count=len(values),
+            )
+        else:
+            if name == "speaker":
+                values = _as_str(values)
+            array = np.empty(len(values), dtype=object)
+            array[:] = values
+            arrays[name] = array
+    return arrays
+
+
+def iter_numpy(results, batch_size=65536):
+    """
+    Like `iter_columns`, with columns as NumPy arrays.
+
+    Times and confidence are float64 arrays, with NaN for missing values, and
+    the other columns are object arrays of str or None.
+    """
+    for columns in iter_columns(results, batch_size):
+        yield _to_numpy(columns)
+
+
+def schema():
+    """The Arrow schema of the batches."""
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("job_id", pa.string()),
+            ("start_time", pa.float64()),
+            ("end_time", pa.float64()),
+            ("text", pa.string()),
+            ("confidence", pa.float64()),
+            ("speaker", pa.string()),
+        ]
+    )
+
+
+def iter_record_batches(results, batch_size=65536):
+    """Like `iter_columns`, with each batch as a pyarrow.RecordBatch."""
+    import pyarrow as pa
+
+    arrow_schema = schema()
+    for columns in iter_columns(results, batch_size):
+        columns["speaker"] = _as_str(columns["speaker"])
+        yield pa.RecordBatch.from_pydict(columns, schema=arrow_schema)
+
+
+def write_parquet(results, path, batch_size=65536, **kwargs):
+    """
+    Write the segments of results to a Parquet file, one row group per batch.
+
+    Extra arguments are passed to pyarrow.parquet.ParquetWriter, e.g.
+    compression="zstd". Returns the number of rows written.
+    """
+    import pyarrow.parquet as pq
+
+    rows = 0
+    with pq.ParquetWriter(path, schema(), **kwargs) as writer:
+        for batch in iter_record_batches(results, batch_size):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
+
+
+def write_arrow(results, path, batch_size=65536, **kwargs):
+    """
+    Write the segments of results to an Arrow IPC file (Feather v2).
+
+    Extra arguments are passed to pyarrow.ipc.new_file. Returns the number of
+    rows written.
+    """
+    import pyarrow as pa
+
+    rows = 0
+    with pa.OSFile(str(path), "wb") as sink:
+        with pa.ipc.new_file(sink, schema(), **kwargs) as writer:
+            for batch in iter_record_batches(results, batch_size):
+                writer.write_batch(batch)
+                rows += batch.num_rows
+    return rows
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+"""
+Execution of webhook callbacks outside of the WSGI request greenlets.
+
+Webhook handlers only enqueue the payload, so CPU-heavy callbacks don't block
+the gevent hub nor delay other webhooks.
+"""
+import gevent
+from gevent.event import Event
+from gevent.queue import Full, Queue
+from gevent.threadpool import ThreadPool
+
+from .metrics import REGISTRY, callback_metrics
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import time
+
+
+def _call_in_process(executor, fn, args):
+    return executor.submit(fn, *args).result()
+
+
+class CallbackDispatcher:
+    """
+    Bounded queue of callback calls, run by a pool of threads or processes.
+
+    Parameters
+    ----------
+    executor : str, optional
+        "thread" runs callbacks in native threads. "process" runs them in a
+        process pool, for CPU-bound callbacks, in which case callbacks and
+        their payloads must be picklable.
+
+        Default: "thread"
+    workers : int, optional
+        Number of callbacks run at the same time.
+
+        Default: 4
+    max_queue : int, optional
+        Maximum number of calls waiting for a worker.
+
+        Default: 1000
+    put_timeout : float, optional
+        How long (in seconds) a webhook waits for room in a full queue before
+        being refused, so that the transcription server retries it later.
+
+        Default: 5
+    metrics : MetricsRegistry, optional
+        Registry of the queue depth and callback run time metrics.
+
+        Default: cpqdtrd.metrics.REGISTRY
+    """
+
+    def __init__(
+        self,
+        executor="thread",
+        workers=4,
+        max_queue=1000,
+        put_timeout=5,
+        metrics=None,
+    ):
+        if executor not in ("thread", "process"):
+            raise ValueError("Invalid executor: {}".format(executor))
+        self._log = logging.getLogger("cpqdtrd.dispatch")
+        self._queue = Queue(maxsize=max_queue)
+        self._put_timeout = put_timeout
+        self._m_calls, self._m_seconds = callback_metrics(metrics or REGISTRY)
+        self._m_queued = (metrics or REGISTRY).gauge(
+            "cpqdtrd_callback_queue_depth", "Callback calls waiting for a worker."
+        )
+        self._threads = ThreadPool(workers)
+        self._processes = None
+        if executor == "process":
+            self._processes = ProcessPoolExecutor(workers)
+
+        self._idle = Event()
+        self._idle.set()
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self._consumers = [gevent.spawn(self._consume) for _ in range(workers)]
+
+    def submit(self, fn, args, on_done=None):
+        """
+        Enqueue the call fn(*args), then on_done() once it has finished.
+
+        Returns False if the queue stayed full for `put_timeout` seconds.
+        """
+        try:
+            self._queue.put((fn, args, on_done), timeout=self._put_timeout)
+        except Full:
+            self.rejected += 1
+            self._m_calls.labels("rejected").inc()
+            self._log.warning("Callback queue full, refusing webhook")
+            return False
+        self._m_queued.inc()
+        self._idle.clear()
+        return True
+
+    def _consume(self):
+        while True:
+            fn, args, on_done = self._queue.get()
+            self._m_queued.dec()
+            self.running += 1
+            start = time.perf_counter()
+            try:
+                if self._processes is not None:
+                    self._threads.spawn(
+                        _call_in_process, self._processes, fn, args
+                    ).get()
+                else:
+                    self._threads.spawn(fn, *args).get()
+                self.completed += 1
+                self._m_calls.labels("completed").inc()
+            except Exception:
+                self.failed += 1
+                self._m_calls.labels("failed").inc()
+                self._log.exception("Callback {} failed".format(fn))
+            finally:
+                self._m_seconds.observe(time.perf_counter() - start)
+                self.running -= 1
+                if on_done is not None:
+                    on_done()
+                if not self.running and self._queue.empty():
+                    self._idle.set()
+
+    def join(self, timeout=None):
+        """Wait until all enqueued callbacks have finished."""
+        return self._idle.wait(timeout)
+
+    def stats(self):
+        """Queue depth and counters, for monitoring."""
+        return {
+            "queued": self._queue.qsize(),
+            "max_queue": self._queue.maxsize,
+            "running": self.running,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+    def stop(self):
+        gevent.killall(self._consumers)
+        self._threads.kill()
+        if self._processes is not None:
+            self._processes.shutdown(wait=False)
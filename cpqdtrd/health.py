@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+"""
+Backoff and circuit breaking for the calls to the transcription server.
+"""
+from . import _compat
+
+import logging
+import random
+import time
+
+
+def backoff_delays(base=1.0, cap=60.0):
+    """
+    Generate exponentially growing delays with full jitter.
+
+    Each delay is uniformly drawn between 0 and min(cap, base * 2 ** attempt),
+    so that many clients restarting together don't retry in lockstep.
+    """
+    attempt = 0
+    while True:
+        yield random.uniform(0, min(cap, base * 2 ** attempt))
+        attempt += 1
+
+
+class CircuitOpenError(ConnectionError):
+    """Raised instead of calling a server which is failing."""
+
+
+class CircuitBreaker:
+    """
+    Fail fast while the server is failing.
+
+    After `failure_threshold` consecutive failures the circuit opens, and
+    calls raise CircuitOpenError for `reset_timeout` seconds. Then a single
+    trial call is let through (half-open state): the circuit closes again if
+    it succeeds, or stays open for another period otherwise.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self._log = logging.getLogger("cpqdtrd.health")
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = _compat.Lock()
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return "closed"
+        if time.monotonic() - self._opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Raise CircuitOpenError if calls are not allowed right now."""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return
+            if state == "half-open" and not self._trial:
+                self._trial = True
+                return
+        raise CircuitOpenError("Circuit open after {} failures".format(self.failures))
+
+    def record_success(self):
+        with self._lock:
+            if self._opened_at is not None:
+                self._log.info("Circuit closed")
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def release(self):
+        """Give back the trial call of the half-open state, if it had no outcome."""
+        with self._lock:
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (
+                self._opened_at is None and self.failures >= self.failure_threshold
+            ):
+                if self._opened_at is None:
+                    self._log.warning(
+                        "Circuit opened after {} failures".format(self.failures)
+                    )
+                self._opened_at = time.monotonic()
+                self._trial = False
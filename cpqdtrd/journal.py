@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+Crash-safe journal of submitted jobs.
+
+Each job is recorded in a SQLite database (in WAL mode) when submitted, and
+updated when it completes, when its result is collected and when it is
+deleted from the server, so that a restarted client can resume the jobs it
+had in flight (see TranscriptionClient.resume) instead of leaving them on the
+server. Writes are queued and committed in batches by a background writer,
+so they stay off the submission path: a crash loses at most the last
+`flush_interval` seconds of records.
+"""
+from . import _compat
+
+from collections import deque
+import json
+import logging
+import sqlite3
+import time
+
+
+# Job states, in order
+SUBMITTED = "submitted"  # Created on the server
+COMPLETED = "completed"  # Completion notice received
+COLLECTED = "collected"  # Result fetched
+DELETED = "deleted"  # Deleted from the server, or not found there
+STATES = (SUBMITTED, COMPLETED, COLLECTED, DELETED)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    state TEXT NOT NULL,
+    tag TEXT,
+    callbacks TEXT,
+    delete_after INTEGER NOT NULL DEFAULT 1,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+)
+"""
+
+# States only move forward, in the order of STATES. The collection of the
+# result tells whether it is deleted after all (see JobJournal.record).
+_UPSERT = """
+INSERT INTO jobs (job_id, state, tag, callbacks, delete_after, created, updated)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (job_id) DO UPDATE SET state = excluded.state, updated = excluded.updated,
+delete_after = CASE WHEN excluded.state = '{1}' THEN excluded.delete_after
+ELSE jobs.delete_after END
+WHERE instr('{0}', excluded.state) > instr('{0}', jobs.state)
+""".format(",".join(STATES), COLLECTED)
+
+
+class JournalEntry:
+    """A job recorded in the journal."""
+
+    __slots__ = ("job_id", "state", "tag", "callbacks", "delete_after", "created")
+
+    def __init__(self, job_id, state, tag, callbacks, delete_after, created):
+        self.job_id = job_id
+        self.state = state
+        self.tag = tag
+        self.callbacks = json.loads(callbacks) if callbacks else []
+        self.delete_after = bool(delete_after)
+        self.created = created  # Unix time
+
+
+class JobJournal:
+    """
+    SQLite journal of the jobs of a client.
+
+    Parameters
+    ----------
+    path : str
+        Path of the database file, created if needed.
+    flush_interval : float, optional
+        Seconds between commits of the queued records.
+
+        Default: 0.5
+    retention : float, optional
+        Seconds for which finished jobs (deleted, or collected and kept on
+        the server) stay in the journal, for inspection.
+
+        Default: 604800 (one week)
+    """
+
+    def __init__(self, path, flush_interval=0.5, retention=7 * 86400):
+        self._log = logging.getLogger("cpqdtrd.journal")
+        self.path = path
+        self.flush_interval = flush_interval
+        self.retention = retention
+        # Commits run in native threads (see _write), one at a time
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+        self._pending = deque()
+        self._write_lock = _compat.Lock()
+        self._closed = False
+        self._last_prune = 0.0
+        self._writer = _compat.spawn(self._write_loop)
+
+    def record(self, job_id, state, tag=None, callbacks=None, delete_after=True):
+        """
+        Queue a state change of a job.
+
+        `tag` and `callbacks` (names) are only stored with the first record of
+        the job, and `delete_after` with the first one and the COLLECTED one,
+        since wait_result may override the choice made on submission.
+        """
+        if self._closed:
+            return
+        now = time.time()
+        self._pending.append(
+            (
+                job_id,
+                state,
+                tag,
+                json.dumps(list(callbacks)) if callbacks else None,
+                int(delete_after),
+                now,
+                now,
+            )
+        )
+
+    def _write_loop(self):
+        while not self._closed:
+            _compat.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                self._log.exception("Could not write the journal: {}".format(e))
+
+    def flush(self):
+        """Commit the queued records."""
+        with self._write_lock:
+            if self._db is None:
+                return
+            batch = []
+            while self._pending:
+                batch.append(self._pending.popleft())
+            prune = time.time() - self._last_prune > 3600
+            if batch or prune:
+                _compat.run_in_thread(self._write, batch, prune)
+
+    def _write(self, batch, prune):
+        with self._db:  # One transaction
+            if batch:
+                self._db.executemany(_UPSERT, batch)
+            if prune:
+                self._db.execute(
+                    "DELETE FROM jobs WHERE updated < ? AND (state = ? OR "
+                    "(state = ? AND delete_after = 0))",
+                    (time.time() - self.retention, DELETED, COLLECTED),
+                )
+        if prune:
+            self._last_prune = time.time()
+
+    def unfinished(self):
+        """
+        The jobs still needing work: not collected, or collected and not yet
+        deleted although they should be, oldest first.
+        """
+        self.flush()
+        with self._write_lock:
+            rows = self._open_db().execute(
+                "SELECT job_id, state, tag, callbacks, delete_after, created "
+                "FROM jobs WHERE state IN (?, ?) OR (state = ? AND delete_after = 1) "
+                "ORDER BY created",
+                (SUBMITTED, COMPLETED, COLLECTED),
+            ).fetchall()
+        return [JournalEntry(*row) for row in rows]
+
+    def setting(self, key, default=None):
+        """A value stored with `set_setting`, or `default`."""
+        with self._write_lock:
+            row = self._open_db().execute(
+                "SELECT value FROM settings WHERE key = ?", (key,)
+            ).fetchone()
+        return default if row is None else row[0]
+
+    def set_setting(self, key, value):
+        """Store a value across restarts, e.g. the webhook validation token."""
+        with self._write_lock:
+            db = self._open_db()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)",
+                    (key, value),
+                )
+
+    def counts(self):
+        """Number of jobs in the journal, by state."""
+        self.flush()
+        with self._write_lock:
+            rows = self._open_db().execute(
+                "SELECT state, COUNT(*) FROM jobs GROUP BY state"
+            )
+            return dict(rows.fetchall())
+
+    def _open_db(self):
+        """The database connection. Raises ValueError once closed."""
+        if self._db is None:
+            raise ValueError("Journal {} is closed".format(self.path))
+        return self._db
+
+    def close(self):
+        """
+        Commit the queued records and close the database. Afterwards, records
+        are dropped and queries raise ValueError.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.flush()
+        with self._write_lock:
+            self._db.close()
+            self._db = None
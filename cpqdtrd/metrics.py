@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight metrics of the SDK, exposed in the Prometheus text format.
+
+Counters, gauges and histograms are kept in a MetricsRegistry. The API wrapper
+and the client record into the module-level REGISTRY unless given another
+one, and the client may serve it on the `/metrics` route of its webhook
+server. Recording a value costs a dict lookup and a lock, so metrics are
+always on.
+
+Hooks may also be added to a registry to follow the lifecycle of each job:
+they are called as hook(event, job_id, timestamp, info), where info is a dict
+of event specific values (see TranscriptionClient for the events).
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1, 2.5, 5, 10, 30, 60, 120, 300, 600,
+)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if value == -math.inf:
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return "{:.1f}".format(value)
+    return repr(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r"\"")
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{{{}}}".format(
+        ",".join('{}="{}"'.format(n, _escape(v)) for n, v in pairs)
+    )
+
+
+class _Value:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = float(value)
+
+
+class _HistogramValue:
+    def __init__(self, bounds):
+        self._lock = threading.Lock()
+        self._bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # Last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the time spent in its block."""
+        return _Timer(self)
+
+
+class _Timer:
+    __slots__ = ("_histogram", "_start")
+
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self.labels()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """Child metric for the given label values, created on first use."""
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(
+                    "{} expects labels {}".format(self.name, self.labelnames)
+                )
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield self.name, _format_labels(self.labelnames, values), child.value
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for name, labels, value in self._samples():
+            lines.append("{}{} {}".format(name, labels, _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Monotonically increasing count."""
+
+    type = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    """Value which may go up and down, e.g. the number of requests in flight."""
+
+    type = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self._default.inc(amount)
+
+    def dec(self, amount=1):
+        self._default.dec(amount)
+
+    def set(self, value):
+        self._default.set(value)
+
+
+class Histogram(_Metric):
+    """Distribution of observed values, e.g. latencies in seconds."""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self._bounds = tuple(sorted(b for b in buckets if b != math.inf))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self._bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return self._default.time()
+
+    def _samples(self):
+        bounds = self._bounds + (math.inf,)
+        for values, child in list(self._children.items()):
+            with child._lock:
+                counts = list(child.counts)
+                total = child.sum
+            cumulative = 0
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield (
+                    self.name + "_bucket",
+                    _format_labels(
+                        self.labelnames, values, ("le", _format_value(float(bound)))
+                    ),
+                    cumulative,
+                )
+            labels = _format_labels(self.labelnames, values)
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, cumulative
+
+
+class MetricsRegistry:
+    """Collection of metrics and job lifecycle hooks."""
+
+    def __init__(self):
+        self._log = logging.getLogger("cpqdtrd.metrics")
+        self._metrics = OrderedDict()
+        self._hooks = []
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name, documentation, labelnames, **kwargs):
+        metric = self._metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(name)
+                if metric is None:
+                    metric = cls(name, documentation, labelnames, **kwargs)
+                    self._metrics[name] = metric
+        if type(metric) is not cls or metric.labelnames != tuple(labelnames):
+            raise ValueError("Metric {} already registered differently".format(name))
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(
+            Histogram, name, documentation, labelnames, buckets=buckets
+        )
+
+    def get(self, name):
+        """The metric registered as `name`, or None."""
+        return self._metrics.get(name)
+
+    def add_hook(self, hook):
+        """Call hook(event, job_id, timestamp, info) on each job lifecycle event."""
+        self._hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self._hooks.remove(hook)
+
+    def job_event(self, event, job_id, **info):
+        """Report a job lifecycle event to the hooks."""
+        if not self._hooks:
+            return
+        timestamp = time.time()
+        for hook in list(self._hooks):
+            try:
+                hook(event, job_id, timestamp, info)
+            except Exception:
+                self._log.exception("Metrics hook {} failed".format(hook))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        return "".join(m.render() + "\n" for m in list(self._metrics.values()))
+
+
+def callback_metrics(registry):
+    """Counter and run time histogram of callbacks, shared by their runners."""
+    return (
+        registry.counter(
+            "cpqdtrd_callbacks_total", "Callback calls, by outcome.", ("outcome",)
+        ),
+        registry.histogram("cpqdtrd_callback_seconds", "Run time of callbacks."),
+    )
+
+
+# Registry used when none is given
+REGISTRY = MetricsRegistry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Webhook-less job tracking, for clients the transcription server can't reach.
+
+A single background greenlet polls the server for all outstanding jobs at
+once through the query endpoint, so the request rate does not grow with the
+number of jobs in flight.
+"""
+from ._json import loads_extended
+
+import gevent
+from gevent.event import Event
+
+from datetime import datetime, timedelta, timezone
+import logging
+import time
+
+
+# Statuses after which a job is no longer processed
+TERMINAL_STATUSES = ("COMPLETED", "FAILED", "CANCELED")
+
+
+def job_from_document(doc):
+    """Extract the job dict from a decoded query document."""
+    if isinstance(doc, dict) and isinstance(doc.get("job"), dict):
+        doc = doc["job"]
+    if "id" not in doc and "_id" in doc:
+        doc = dict(doc, id=str(doc["_id"]))
+    return doc
+
+
+class JobPoller:
+    """
+    Poll the server for the completion of outstanding jobs.
+
+    Each cycle lists the jobs in a terminal status submitted since the oldest
+    outstanding one, paginating through `query`, and reports those which are
+    being tracked. A cycle only runs when at least one job is expected to be
+    done, estimated from its audio duration. After each cycle the poller waits
+    `min_interval` seconds per page requested, so the load on the server stays
+    roughly constant as the number of jobs grows.
+
+    Parameters
+    ----------
+    api : TranscriptionApi
+        The API wrapper used for queries.
+    on_done : callable
+        Called as on_done(job_id, job) for each finished job, where job is the
+        job document returned by the server.
+    min_interval : float, optional
+        Minimum interval (in seconds) between polling cycles.
+
+        Default: 1
+    max_interval : float, optional
+        Maximum interval (in seconds) between polling cycles.
+
+        Default: 30
+    expected_rtf : float, optional
+        Expected ratio between processing time and audio duration, used to
+        delay the first check of each job.
+
+        Default: 0.3
+    page_limit : int, optional
+        Number of jobs per query page.
+
+        Default: 500
+    start_margin : float, optional
+        Margin (in seconds) subtracted from the oldest submission time in the
+        query date filter, to tolerate clock differences with the server.
+
+        Default: 300
+    statuses : list of str, optional
+        Job statuses considered terminal.
+    """
+
+    def __init__(
+        self,
+        api,
+        on_done,
+        min_interval=1.0,
+        max_interval=30.0,
+        expected_rtf=0.3,
+        page_limit=500,
+        start_margin=300,
+        statuses=TERMINAL_STATUSES,
+    ):
+        self._log = logging.getLogger("cpqdtrd.poller")
+        self._api = api
+        self._on_done = on_done
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._expected_rtf = expected_rtf
+        self._page_limit = page_limit
+        self._start_margin = timedelta(seconds=start_margin)
+        self._statuses = list(statuses)
+
+        self._jobs = {}  # job_id -> (submission datetime, expected done time)
+        self._wakeup = Event()
+        self._greenlet = None
+        self.requests = 0  # Total query requests, for monitoring
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def start(self):
+        if self._greenlet is None or self._greenlet.dead:
+            self._greenlet = gevent.spawn(self._run)
+
+    def stop(self):
+        if self._greenlet is not None:
+            self._greenlet.kill()
+            self._greenlet = None
+
+    def add(self, job_id, duration=None):
+        """Track a job, optionally with the duration of its audio in seconds."""
+        expected = time.monotonic() + self._min_interval
+        if duration:
+            expected += duration * self._expected_rtf
+        self._jobs[job_id] = (datetime.now(timezone.utc), expected)
+        self._wakeup.set()
+
+    def discard(self, job_id):
+        """Stop tracking a job."""
+        self._jobs.pop(job_id, None)
+
+    def _run(self):
+        while True:
+            if not self._jobs:
+                self._wakeup.clear()
+                self._wakeup.wait()
+                continue
+            wait = min(e for _, e in self._jobs.values()) - time.monotonic()
+            if wait > 0:
+                # Nothing is due yet. Wake up early if a new job is added, as
+                # it may be due before the current ones.
+                self._wakeup.clear()
+                self._wakeup.wait(min(wait, self._max_interval))
+                continue
+            try:
+                pages = self._poll()
+            except Exception as e:
+                self._log.warning("Exception polling jobs: {}".format(e))
+                pages = self._max_interval / self._min_interval
+            interval = self._min_interval * max(1, pages)
+            gevent.sleep(min(interval, self._max_interval))
+
+    def _poll(self):
+        """Run one polling cycle and return the number of requests made."""
+        since = min(s for s, _ in self._jobs.values()) - self._start_margin
+        page = 1
+        while self._jobs:
+            count = 0
+            for line in self._api.query(
+                statuses=self._statuses,
+                projection=["id", "status"],
+                page=page,
+                limit=self._page_limit,
+                start_date=since,
+            ):
+                count += 1
+                job = job_from_document(loads_extended(line))
+                job_id = job.get("id")
+                if job_id in self._jobs:
+                    del self._jobs[job_id]
+                    self._on_done(job_id, job)
+            self.requests += 1
+            if count < self._page_limit:
+                break
+            page += 1
+        return page
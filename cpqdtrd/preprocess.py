@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Client-side audio normalization before upload.
+
+The recognizer only uses 8 or 16 kHz mono audio, so high-rate and
+multichannel recordings are downmixed, resampled and re-encoded (FLAC by
+default) before upload, which cuts upload size and time several times. The
+work runs in a process pool, overlapping with the uploads of other jobs.
+"""
+from . import _compat
+from .audio import AudioSource, as_audio_source
+
+from concurrent.futures import ProcessPoolExecutor
+import io
+import logging
+import math
+import os
+
+
+def _lowpass(x, cutoff, taps=127, nfft=1 << 16):
+    """
+    Windowed-sinc low-pass filter, with `cutoff` relative to the sample rate.
+
+    Applied by FFT overlap-add, so that long files are filtered in linear time.
+    """
+    import numpy as np
+
+    n = np.arange(taps) - (taps - 1) / 2
+    h = np.sinc(2 * cutoff * n) * np.hamming(taps)
+    h /= h.sum()
+    block = nfft - taps + 1  # Each block and its tail fit in one transform
+    spectrum = np.fft.rfft(h, nfft)
+    y = np.zeros(len(x) + taps - 1)
+    for start in range(0, len(x), block):
+        segment = x[start : start + block]
+        out = np.fft.irfft(np.fft.rfft(segment, nfft) * spectrum, nfft)
+        out = out[: len(segment) + taps - 1]
+        y[start : start + len(out)] += out
+    delay = (taps - 1) // 2
+    return y[delay : delay + len(x)]
+
+
+def resample(x, rate, target):
+    """
+    Resample a mono float signal from `rate` to `target` Hz.
+
+    Uses scipy.signal.resample_poly if SciPy is installed, or a low-pass
+    filter followed by linear interpolation otherwise.
+    """
+    import numpy as np
+
+    rate, target = int(rate), int(target)
+    if rate == target:
+        return x
+    try:
+        from scipy.signal import resample_poly
+    except ImportError:
+        pass
+    else:
+        g = math.gcd(rate, target)
+        return resample_poly(x, target // g, rate // g)
+    if target < rate:
+        x = _lowpass(x, 0.45 * target / rate)
+    frames = int(len(x) * target / rate)
+    positions = np.arange(frames) * (rate / target)
+    return np.interp(positions, np.arange(len(x)), x)
+
+
+def to_float(x):
+    """
+    Samples as float32 in [-1, 1).
+
+    Integer samples are scaled by the range of their type, unsigned ones being
+    centered on the middle of the range, as in 8-bit WAV files.
+    """
+    import numpy as np
+
+    x = np.asarray(x)
+    if x.dtype.kind in "iu":
+        info = np.iinfo(x.dtype)
+        scale = float(info.max) + 1
+        if x.dtype.kind == "u":
+            scale /= 2
+            return (x.astype(np.float64) - scale).astype(np.float32) / np.float32(scale)
+        return x.astype(np.float32) / np.float32(scale)
+    return x.astype(np.float32, copy=False)
+
+
+def normalize_audio(
+    data, samplerate=None, target_rate=16000, format="FLAC", subtype="PCM_16"
+):
+    """
+    Downmix to mono, resample down to `target_rate` and encode to `format`.
+
+    `data` is a path, encoded audio bytes, or a sample array with its
+    `samplerate`. Audio at or below the target rate is not resampled.
+
+    Returns the encoded bytes, or None if the audio is already mono, at most
+    at the target rate and in the target format.
+    """
+    import numpy as np
+    import soundfile as sf
+
+    if isinstance(data, (bytes, bytearray)):
+        data = io.BytesIO(data)
+    if isinstance(data, np.ndarray):
+        x, rate = data, samplerate
+    else:
+        info = sf.info(data)
+        if (
+            info.channels == 1
+            and info.samplerate <= target_rate
+            and info.format == format.upper()
+        ):
+            return None
+        if hasattr(data, "seek"):
+            data.seek(0)
+        x, rate = sf.read(data, dtype="float32", always_2d=True)
+
+    x = to_float(x)
+    if x.ndim > 1:
+        x = x.mean(axis=1)
+    if rate > target_rate:
+        x = resample(x, rate, target_rate)
+        rate = target_rate
+    out = io.BytesIO()
+    sf.write(out, np.clip(x, -1, 1), rate, format=format, subtype=subtype)
+    return out.getvalue()
+
+
+class AudioPreprocessor:
+    """
+    Normalize audio sources in a pool of worker processes.
+
+    Parameters
+    ----------
+    target_rate : int, optional
+        Maximum sample rate sent to the server, 8000 or 16000.
+
+        Default: 16000
+    format : str, optional
+        Encoding of the uploaded audio, as accepted by soundfile.
+
+        Default: "FLAC"
+    subtype : str, optional
+        Sample format of the encoded audio.
+
+        Default: "PCM_16"
+    workers : int, optional
+        Number of worker processes.
+
+        Default: the number of CPUs
+    """
+
+    def __init__(
+        self, target_rate=16000, format="FLAC", subtype="PCM_16", workers=None
+    ):
+        self._log = logging.getLogger("cpqdtrd.preprocess")
+        self.target_rate = target_rate
+        self.format = format.upper()
+        self.subtype = subtype
+        self._executor = ProcessPoolExecutor(workers)
+
+    def submit(self, source):
+        """
+        Start normalizing an AudioSource.
+
+        Returns a concurrent.futures.Future of the encoded bytes, which are
+        None if the source needs no change. Non-path sources are read whole,
+        to be sent to the worker.
+        """
+        if source.kind == "path":
+            args = (source.path, None)
+        elif source.kind == "array":
+            args = (source.data, source.samplerate)
+        else:
+            args = (b"".join(source.chunks()), None)
+        return self._executor.submit(
+            normalize_audio, *args, self.target_rate, self.format, self.subtype
+        )
+
+    def result(self, source, future):
+        """
+        The normalized AudioSource for a future from `submit`.
+
+        Falls back to the original source if it can't be decoded. Cooperates
+        with gevent while waiting, if it is in use.
+        """
+        try:
+            data = _compat.wait_future(future)
+        except Exception as e:
+            return self._fallback(source, e)
+        return self._wrap(source, data)
+
+    def process(self, audio, **kwargs):
+        """Normalize audio of any supported type, returning an AudioSource."""
+        source = self._readable(as_audio_source(audio, **kwargs))
+        return self.result(source, self.submit(source))
+
+    async def aprocess(self, audio, **kwargs):
+        """Coroutine version of `process`, for asyncio clients."""
+        import asyncio
+
+        source = self._readable(as_audio_source(audio, **kwargs))
+        try:
+            data = await asyncio.wrap_future(self.submit(source))
+        except Exception as e:
+            return self._fallback(source, e)
+        return self._wrap(source, data)
+
+    @staticmethod
+    def _readable(source):
+        if source.rewindable:
+            return source
+        # Read once here, so that the original can be uploaded on failure
+        return AudioSource(b"".join(source.chunks()), filename=source.filename)
+
+    def _fallback(self, source, error):
+        self._log.warning(
+            "Could not normalize {}, uploading as is: {}".format(source.filename, error)
+        )
+        return source
+
+    def _wrap(self, source, data):
+        if data is None:
+            return source
+        filename = "{}.{}".format(
+            os.path.splitext(source.filename)[0], self.format.lower()
+        )
+        return AudioSource(data, filename=filename)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
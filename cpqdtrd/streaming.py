@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental decoding of transcription results.
+
+Results of multi-hour recordings with word-level detail reach hundreds of
+megabytes. SegmentStream decodes a result while it is downloaded, yielding its
+segments one at a time, so memory use is bounded by the download chunk and the
+largest segment regardless of the result size, and processing starts with the
+first segment received.
+
+The decoder scans the fields and segments with the C scanner of the json
+module (JSONDecoder.raw_decode), each from a buffer holding about one download
+chunk; a value cut by the end of the buffer is decoded again once the next
+chunk arrives.
+"""
+import codecs
+import json
+import re
+
+
+_SEPARATORS = re.compile(r"[\s,:]*")
+_DELIMITERS = frozenset(" \t\r\n,:]}")
+
+
+class _Reader:
+    """Buffered scanner of a JSON document split in byte chunks."""
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder("utf-8")()
+        self._raw_decode = json.JSONDecoder().raw_decode
+        self._text = ""
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        """Append the next chunk to the buffer. False at the end of the input."""
+        if self._eof:
+            return False
+        # Drop the consumed text, keeping the buffer about one chunk long
+        self._text = self._text[self._pos :]
+        self._pos = 0
+        for chunk in self._chunks:
+            text = self._decoder.decode(chunk)
+            if text:
+                self._text += text
+                return True
+        self._text += self._decoder.decode(b"", final=True)
+        self._eof = True
+        return False
+
+    def peek(self):
+        """The next character after separators, or None at the end, not consumed."""
+        while True:
+            self._pos = _SEPARATORS.match(self._text, self._pos).end()
+            if self._pos < len(self._text):
+                return self._text[self._pos]
+            if not self._fill():
+                return None
+
+    def skip(self):
+        """Consume the character returned by peek."""
+        self._pos += 1
+
+    def value(self):
+        """Consume and decode the next value."""
+        while True:
+            try:
+                value, end = self._raw_decode(self._text, self._pos)
+            except json.JSONDecodeError as e:
+                if not self._fill():
+                    raise ValueError("Invalid JSON document: {}".format(e))
+                continue
+            # A number cut by the end of the buffer (e.g. "1." of "1.5") is
+            # decoded without error: values must be followed by a delimiter
+            if self._eof or (end < len(self._text) and self._text[end] in _DELIMITERS):
+                self._pos = end
+                return value
+            self._fill()
+
+
+def iter_fields(chunks, key="segments"):
+    """
+    Decode a JSON object incrementally, from an iterable of byte chunks.
+
+    Yields (name, value) for each field of the object, in document order,
+    except for the array `key`, whose elements are yielded one at a time as
+    (key, element).
+    """
+    reader = _Reader(chunks)
+    if reader.peek() != "{":
+        raise ValueError("Expected a JSON object")
+    reader.skip()
+    while True:
+        char = reader.peek()
+        if char is None:
+            raise ValueError("Truncated JSON document")
+        if char == "}":
+            return
+        name = reader.value()
+        if reader.peek() == "[" and name == key:
+            reader.skip()
+            while True:
+                char = reader.peek()
+                if char is None:
+                    raise ValueError("Truncated JSON document")
+                if char == "]":
+                    reader.skip()
+                    break
+                yield name, reader.value()
+        else:
+            yield name, reader.value()
+
+
+class SegmentStream:
+    """
+    Segments of a result, decoded as it is downloaded.
+
+    Iterating yields each segment as a dict, once. The other fields of the
+    result (e.g. "job") are stored in `fields` as they are decoded: those
+    preceding the segments are available from the first segment on, and all
+    of them once the iteration ends.
+
+    Parameters
+    ----------
+    chunks : iterable of bytes
+        The result document, e.g. requests.Response.iter_content().
+    on_close : callable, optional
+        Called as on_close(complete) when the stream is closed, complete
+        being whether the result was read to the end.
+    """
+
+    def __init__(self, chunks, on_close=None):
+        self.fields = {}
+        self.complete = False
+        self._items = iter_fields(chunks)
+        self._on_close = on_close
+
+    @property
+    def job(self):
+        """The job document, or None if not decoded yet."""
+        return self.fields.get("job")
+
+    def __iter__(self):
+        try:
+            for name, value in self._items:
+                if name == "segments":
+                    yield value
+                else:
+                    self.fields[name] = value
+            self.complete = True
+        finally:
+            self.close()
+
+    def result(self):
+        """Read the rest of the stream, returning the result as a dict."""
+        segments = list(self)
+        return dict(self.fields, segments=segments)
+
+    def close(self):
+        """Stop the download. Idempotent."""
+        on_close, self._on_close = self._on_close, None
+        if on_close is not None:
+            self._items.close()
+            on_close(self.complete)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded tracking of the jobs whose completion notices are awaited.
+
+Each job is a slotted record with the set of notices still pending (the root
+webhook and one per callback) and a single event, created only if someone
+waits for the job, or a list of watchers notified by callback (see
+JobTracker.watch), so that many jobs can be awaited at once without an event
+or a greenlet per job. Records are removed when their last notice arrives, and
+jobs whose notices never come (failed deliveries, lost webhooks) are evicted
+after a TTL or when the tracker is full, so memory stays flat in long-running
+clients.
+"""
+from . import _compat
+
+from collections import OrderedDict
+import time
+
+
+class TrackedJob:
+    """A job awaiting completion notices."""
+
+    __slots__ = (
+        "job_id",
+        "created",
+        "pending",
+        "callbacks",
+        "evicted",
+        "_event",
+        "_watchers",
+    )
+
+    def __init__(self, job_id, names, callbacks):
+        self.job_id = job_id
+        self.created = time.perf_counter()
+        self.pending = set(names)
+        self.callbacks = callbacks
+        self.evicted = False
+        self._event = None
+        self._watchers = None
+
+    @property
+    def age(self):
+        """Seconds since the job started being tracked."""
+        return time.perf_counter() - self.created
+
+    def _wake(self):
+        if self._event is not None:
+            self._event.set()
+        if self._watchers is not None:
+            for notify in self._watchers:
+                notify(self.job_id, self.evicted)
+            self._watchers = None
+
+
+class JobTracker:
+    """
+    Jobs awaiting completion notices, by job id.
+
+    Parameters
+    ----------
+    ttl : float, optional
+        Seconds after which a job still pending is evicted. If None, jobs are
+        only evicted when the tracker is full.
+
+        Default: 86400 (one day)
+    max_jobs : int, optional
+        Maximum number of jobs tracked. The oldest jobs are evicted first.
+
+        Default: 100000
+    on_evict : callable, optional
+        Called as on_evict(job) for each evicted job.
+    event_factory : callable, optional
+        Creates the events of `waiter`, e.g. asyncio.Event.
+
+        Default: _compat.Event (gevent or threading event)
+    """
+
+    def __init__(self, ttl=86400, max_jobs=100000, on_evict=None, event_factory=None):
+        self.ttl = ttl
+        self.max_jobs = max_jobs
+        self._on_evict = on_evict
+        self._event_factory = event_factory or _compat.Event
+        self._jobs = OrderedDict()  # Oldest first
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def __contains__(self, job_id):
+        return job_id in self._jobs
+
+    def get(self, job_id):
+        """The record of a job, or None if it is not tracked."""
+        return self._jobs.get(job_id)
+
+    def add(self, job_id, names, callbacks=None):
+        """
+        Track a job awaiting the given notice names.
+
+        `callbacks` is the snapshot of the callbacks of the job, by name.
+        """
+        self.expire()
+        job = self._jobs[job_id] = TrackedJob(job_id, names, callbacks)
+        while len(self._jobs) > self.max_jobs:
+            self._evict(next(iter(self._jobs)))
+        return job
+
+    def waiter(self, job):
+        """Event set once the job is done or evicted, created on first use."""
+        if job._event is None:
+            job._event = self._event_factory()
+            if not job.pending or job.evicted:
+                job._event.set()
+        return job._event
+
+    def watch(self, job_ids, notify):
+        """
+        Call notify(job_id, evicted) once each job is done or evicted.
+
+        Jobs not tracked (already done, or unknown) are notified right away,
+        with evicted False. `notify` runs in the greenlet delivering the last
+        notice of the job, so it must not block, e.g. put into a queue.
+        """
+        for job_id in job_ids:
+            job = self._jobs.get(job_id)
+            if job is None:
+                notify(job_id, False)
+            elif job._watchers is None:
+                job._watchers = [notify]
+            else:
+                job._watchers.append(notify)
+
+    def unwatch(self, job_ids, notify):
+        """Stop notifying the jobs still tracked, as registered by `watch`."""
+        for job_id in job_ids:
+            job = self._jobs.get(job_id)
+            if job is not None and job._watchers and notify in job._watchers:
+                job._watchers.remove(notify)
+
+    def signal(self, job_id, name):
+        """
+        Mark a notice of a job as received.
+
+        Returns the job record if the notice was pending, None otherwise. Once
+        no notices are pending, the job is removed and its waiters woken up.
+        """
+        job = self._jobs.get(job_id)
+        if job is None or name not in job.pending:
+            return None
+        job.pending.discard(name)
+        if not job.pending:
+            del self._jobs[job_id]
+            job._wake()
+        return job
+
+    def discard(self, job_id):
+        """Stop tracking a job, without waking up its waiters."""
+        return self._jobs.pop(job_id, None)
+
+    @property
+    def expire_interval(self):
+        """How often `expire` should run, to evict jobs close to their TTL."""
+        return None if self.ttl is None else max(1.0, min(60.0, self.ttl / 10))
+
+    def expire(self):
+        """Evict the jobs pending for longer than the TTL."""
+        if self.ttl is None:
+            return
+        deadline = time.perf_counter() - self.ttl
+        while self._jobs:
+            job_id, job = next(iter(self._jobs.items()))
+            if job.created > deadline:
+                break
+            self._evict(job_id)
+
+    def _evict(self, job_id):
+        job = self._jobs.pop(job_id)
+        job.evicted = True
+        self.evicted += 1
+        job._wake()
+        if self._on_evict is not None:
+            self._on_evict(job)
+
+    def pending(self):
+        """
+        List the tracked jobs, oldest first.
+
+        Returns a list of (job_id, age in seconds, pending notice names).
+        """
+        return [
+            (job.job_id, job.age, sorted(job.pending))
+            for job in list(self._jobs.values())
+        ]
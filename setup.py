@@ -11,6 +11,11 @@ setup(
     version="1.2.0",
     description="CPqD Dialog Transcription Client",
     install_requires=install_requires,
+    extras_require={
+        "asyncio": ["aiohttp>=3.8"],
+        "columnar": ["numpy", "pyarrow"],
+        "fast-json": ["orjson"],
+    },
     author="Akira Miasato",
     author_email="valterf@cpqd.com.br",
     packages=find_packages(),
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Shared fixtures: an in-process mock transcription server, and clients bound
+to free local ports, with webhooks over plain HTTP.
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import os
+import socket
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "benchmarks"))
+
+from mock_server import MockTranscriptionServer  # noqa: E402
+
+from cpqdtrd.client import TranscriptionClient  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wav_bytes(seconds=1.0, rate=8000):
+    """A silent 16-bit PCM WAV file."""
+    import io
+    import wave
+
+    out = io.BytesIO()
+    with wave.open(out, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(b"\0\0" * int(seconds * rate))
+    return out.getvalue()
+
+
+@pytest.fixture
+def make_mock():
+    servers = []
+
+    def make(**kwargs):
+        kwargs.setdefault("delay", 0.05)
+        server = MockTranscriptionServer(**kwargs).start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.stop()
+
+
+@pytest.fixture
+def mock(make_mock):
+    return make_mock()
+
+
+@pytest.fixture
+def make_client(mock):
+    clients = []
+
+    def make(**kwargs):
+        kwargs.setdefault("api_url", mock.url)
+        kwargs.setdefault("webhook_host", "127.0.0.1")
+        kwargs.setdefault("webhook_port", free_port())
+        kwargs.setdefault("webhook_protocol", "http")
+        client = TranscriptionClient(**kwargs)
+        clients.append(client)
+        return client
+
+    yield make
+    for client in clients:
+        client.stop()
+
+
+@pytest.fixture
+def client(make_client):
+    return make_client()
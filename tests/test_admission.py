@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import gevent
+import pytest
+
+from cpqdtrd.admission import AdmissionController
+from cpqdtrd.metrics import MetricsRegistry
+
+from conftest import wav_bytes
+
+
+def controller(**kw):
+    return AdmissionController(metrics=MetricsRegistry(), **kw)
+
+
+def test_submissions_queue_beyond_the_limit():
+    admission = controller(initial=2)
+    assert admission.acquire() and admission.acquire()
+    assert not admission.acquire(timeout=0.01)
+    waiter = gevent.spawn(admission.acquire)
+    gevent.sleep(0)
+    assert admission.waiting == 1
+    admission.admit("a")
+    admission.complete("a", 1.0)
+    assert waiter.get(timeout=1) and admission.in_flight == 2
+
+
+def test_overload_decreases_the_limit():
+    admission = controller(initial=10, decrease=0.5)
+    admission.acquire()
+    admission.reject()
+    assert admission.limit == 5 and admission.in_flight == 0
+
+
+def test_slow_completions_decrease_the_limit():
+    admission = controller(initial=4, tolerance=2.0)
+    for job_id, latency in (("a", 1.0), ("b", 5.0)):
+        admission.acquire()
+        admission.admit(job_id, duration=1.0)
+        admission.complete(job_id, latency)
+    assert admission.baseline == pytest.approx(1.01) and admission.limit == 2
+    assert admission.in_flight == 0
+
+
+def test_discard_releases_admitted_slots_once():
+    admission = controller()
+    admission.acquire()
+    admission.admit("a")
+    admission.discard("a")
+    admission.discard("a")
+    admission.complete("a", 1.0)
+    assert admission.in_flight == 0
+
+
+def test_client_waits_for_admission(make_mock, make_client):
+    mock = make_mock(delay=0.2)
+    admission = controller(initial=1, max_limit=1)
+    client = make_client(api_url=mock.url, admission=admission)
+    jobs = [gevent.spawn(client.transcribe, wav_bytes(), timeout=5) for _ in range(3)]
+    gevent.sleep(0.1)
+    assert admission.in_flight == 1 and admission.waiting == 2
+    assert all(job.get(timeout=5)[1] for job in jobs)
+    assert admission.in_flight == 0
+
+
+def test_webhook_before_create_response(make_mock, make_client):
+    mock = make_mock(delay=0)
+    admission = controller(initial=1)
+    client = make_client(api_url=mock.url, admission=admission)
+    create = client.api.create
+
+    def slow_create(*args, **kwargs):
+        r = create(*args, **kwargs)
+        gevent.sleep(0.3)  # The webhook arrives meanwhile
+        return r
+
+    client.api.create = slow_create
+    job_id, result = client.transcribe(wav_bytes(), timeout=2)
+    assert result and result["job"]["id"] == job_id
+    assert admission.in_flight == 0 and len(client.jobs) == 0
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from urllib.parse import urlparse
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+
+from aiohttp import web  # noqa: E402
+
+from cpqdtrd.aio import AsyncTranscriptionApi, AsyncTranscriptionClient  # noqa: E402
+
+from conftest import free_port, wav_bytes  # noqa: E402
+
+
+class FakeRequest:
+    def __init__(self, payload, **match_info):
+        self.match_info = match_info
+        self._payload = payload
+
+    async def json(self, loads=None):
+        return self._payload
+
+
+def run(coro):
+    return asyncio.new_event_loop().run_until_complete(coro)
+
+
+@pytest.fixture
+def aio_client():
+    client = AsyncTranscriptionClient("http://127.0.0.1:1", webhook_protocol="http")
+    calls = []
+    client.register_callback(lambda job_id, r: calls.append(job_id), "cb")
+    client.calls = calls
+    return client
+
+
+def test_invalid_token_changes_nothing(aio_client):
+    async def scenario():
+        aio_client.jobs.add("a", ["__root__", "cb"])
+        event = aio_client.jobs.waiter(aio_client.jobs.get("a"))
+        request = FakeRequest({"token": "wrong"}, job_id="a", name="cb")
+        with pytest.raises(web.HTTPUnauthorized):
+            await aio_client._callback_handler(request)
+        with pytest.raises(web.HTTPUnauthorized):
+            await aio_client._root_handler(FakeRequest({}, job_id="a"))
+        assert aio_client.jobs.get("a").pending == {"__root__", "cb"}
+        assert not event.is_set() and not aio_client.calls
+
+    run(scenario())
+
+
+def test_valid_webhooks_run_callbacks_and_wake_waiters(aio_client):
+    async def scenario():
+        aio_client.jobs.add("a", ["__root__", "cb"])
+        event = aio_client.jobs.waiter(aio_client.jobs.get("a"))
+        token = {"token": aio_client._validation_token}
+        await aio_client._callback_handler(FakeRequest(token, job_id="a", name="cb"))
+        await aio_client._root_handler(FakeRequest(token, job_id="a"))
+        assert event.is_set() and aio_client.calls == ["a"]
+
+    run(scenario())
+
+
+def client_for(mock):
+    return AsyncTranscriptionClient(
+        mock.url,
+        webhook_port=free_port(),
+        webhook_host="127.0.0.1",
+        webhook_listener="127.0.0.1",
+        webhook_protocol="http",
+    )
+
+
+def test_transcribe(mock):
+    calls = []
+
+    async def on_result(job_id, r):
+        calls.append(job_id)
+
+    async def scenario():
+        async with client_for(mock) as client:
+            client.register_callback(on_result, "cb")
+            job_id, result = await client.transcribe(wav_bytes(), timeout=5)
+            assert result["job"]["id"] == job_id and calls == [job_id]
+            assert job_id not in mock.jobs
+
+    run(scenario())
+
+
+def test_webhook_before_create_response(make_mock):
+    mock = make_mock(delay=0)
+
+    async def scenario():
+        async with client_for(mock) as client:
+            create = client.api.create
+
+            async def slow_create(*args, **kwargs):
+                r = await create(*args, **kwargs)
+                await asyncio.sleep(0.3)  # The webhook arrives meanwhile
+                return r
+
+            client.api.create = slow_create
+            job_id, result = await client.transcribe(wav_bytes(), timeout=3)
+            assert result and result["job"]["id"] == job_id
+            assert len(client.jobs) == 0 and not client._early_notices
+
+    run(scenario())
+
+
+def test_unauthorized_request_refreshes_once(make_mock):
+    mock = make_mock(token_ttl=3600)
+    url = urlparse(mock.url)
+    api = AsyncTranscriptionApi(
+        mock.url,
+        sl_host=url.hostname,
+        sl_port=url.port,
+        sl_protocol="http",
+        sl_username="user",
+        sl_password="password",
+    )
+
+    async def scenario():
+        async with api:
+            mock._tokens.clear()  # Revoked by the server
+            rs = await asyncio.gather(*[api.status("unknown") for _ in range(5)])
+            assert [r.status for r in rs] == [404] * 5
+            assert len(mock._tokens) == 1
+
+    run(scenario())
+
+
+def test_check_gives_up_at_the_deadline():
+    api = AsyncTranscriptionApi(
+        "http://127.0.0.1:{}".format(free_port()),
+        retry=100,
+        retry_period=0.05,
+        retry_deadline=0.5,
+    )
+
+    async def scenario():
+        start = time.monotonic()
+        with pytest.raises(AsyncTranscriptionApi.TimeoutException):
+            await api.open()
+        await api.close()
+        return time.monotonic() - start
+
+    assert run(scenario()) < 1.5
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timedelta, timezone
+import json
+from urllib.parse import urlparse
+
+import gevent
+import pytest
+from gevent.pywsgi import WSGIServer
+
+from cpqdtrd import _compat
+from cpqdtrd.api import TranscriptionApi, _prefetch, create_session
+from cpqdtrd.metrics import MetricsRegistry
+
+from conftest import wav_bytes
+
+
+@pytest.fixture
+def flaky_server():
+    """A server answering 503 to the first `failures` requests, then 200."""
+    state = {"failures": 0, "requests": [], "ports": set()}
+
+    def app(environ, start_response):
+        state["requests"].append((environ["REQUEST_METHOD"], environ["PATH_INFO"]))
+        state["ports"].add(environ["REMOTE_PORT"])
+        if state["failures"] > 0:
+            state["failures"] -= 1
+            start_response("503 Service Unavailable", [("Content-Length", "0")])
+            return [b""]
+        body = json.dumps({"job": {"id": "a", "status": "COMPLETED"}}).encode()
+        start_response(
+            "200 OK",
+            [("Content-Type", "application/json"), ("Content-Length", str(len(body)))],
+        )
+        return [body]
+
+    server = WSGIServer(("127.0.0.1", 0), app, log=None)
+    server.start()
+    state["url"] = "http://127.0.0.1:{}".format(server.server_port)
+    yield state
+    server.stop()
+
+
+def test_session_retries_idempotent_requests(flaky_server):
+    session = create_session(max_retries=2, backoff_factor=0)
+    flaky_server["failures"] = 2
+    assert session.get(flaky_server["url"] + "/job").status_code == 200
+    assert len(flaky_server["requests"]) == 3
+    flaky_server["failures"] = 1
+    assert session.post(flaky_server["url"] + "/job").status_code == 503
+    assert len(flaky_server["requests"]) == 4
+
+
+def test_requests_share_keep_alive_connections(flaky_server):
+    api = TranscriptionApi(flaky_server["url"], backoff_factor=0)
+    for _ in range(5):
+        assert api.status("a").json()["job"]["id"] == "a"
+    assert len(flaky_server["ports"]) == 1
+    api.close()
+
+
+def test_iter_query_paginates(make_mock):
+    mock = make_mock()
+    api = TranscriptionApi(mock.url, wait_ready=False)
+    created = [
+        api.create(wav_bytes(0.1), tag="batch").json()["job"]["id"] for _ in range(7)
+    ]
+    api.create(wav_bytes(0.1), tag="other")
+    for prefetch in (0, 2):
+        jobs = list(api.iter_query(tags=["batch"], limit=3, prefetch=prefetch))
+        assert [job["job"]["id"] for job in jobs] == created
+    now = datetime.now(timezone.utc)
+    jobs = api.iter_query(
+        tags=["batch"],
+        limit=3,
+        start_date=now - timedelta(hours=1),
+        end_date=now + timedelta(minutes=1),
+        window=timedelta(minutes=10),
+    )
+    assert [job["job"]["id"] for job in jobs] == created
+    with pytest.raises(ValueError):
+        next(api.iter_query(window=timedelta(minutes=10)))
+
+
+def test_iter_query_stops_early(make_mock):
+    mock = make_mock()
+    metrics = MetricsRegistry()
+    api = TranscriptionApi(mock.url, wait_ready=False, metrics=metrics)
+    for _ in range(10):
+        api.create(wav_bytes(0.1))
+    jobs = api.iter_query(limit=2, prefetch=1)
+    next(jobs)
+    jobs.close()
+    gevent.sleep(0.1)
+    requests = metrics.get("cpqdtrd_api_requests_total")
+    assert requests.labels("GET", "/query/job", "200").value <= 3
+
+
+def test_prefetch_uses_compat_primitives(monkeypatch):
+    spawned = []
+    spawn = _compat.spawn
+    monkeypatch.setattr(_compat, "spawn", lambda fn: spawned.append(spawn(fn)))
+    assert list(_prefetch(iter(range(5)), 2)) == list(range(5))
+    assert len(spawned) == 1 and isinstance(spawned[0], gevent.Greenlet)
+
+
+def licensed_api(mock, **kwargs):
+    url = urlparse(mock.url)
+    return TranscriptionApi(
+        mock.url,
+        sl_host=url.hostname,
+        sl_port=url.port,
+        sl_protocol="http",
+        sl_username="user",
+        sl_password="password",
+        metrics=MetricsRegistry(),
+        **kwargs
+    )
+
+
+def refreshes(api):
+    return api.metrics.get("cpqdtrd_token_refreshes_total").labels().value
+
+
+def test_concurrent_refreshes_create_one_token(make_mock):
+    api = licensed_api(make_mock(token_ttl=3600))
+    stale = api._sl_token
+    gevent.joinall([gevent.spawn(api.refresh_token, stale) for _ in range(10)])
+    assert refreshes(api) == 2 and api._sl_token != stale
+
+
+def test_token_refreshed_before_expiry(make_mock):
+    api = licensed_api(make_mock(token_ttl=2), token_refresh_fraction=0.5)
+    token = api._sl_token
+    gevent.sleep(1.5)
+    # Expirations are whole seconds, so the lifetime is between 1 and 2s
+    assert api._sl_token != token and refreshes(api) >= 2
+    assert api.status("unknown").status_code == 404  # Not 401
+    api.close()
+
+
+def test_unauthorized_request_refreshes_once(make_mock):
+    mock = make_mock(token_ttl=3600)
+    api = licensed_api(mock)
+    mock._tokens.clear()  # Revoked by the server
+    rs = gevent.joinall([gevent.spawn(api.status, "unknown") for _ in range(5)])
+    assert [g.value.status_code for g in rs] == [404] * 5
+    assert refreshes(api) == 2
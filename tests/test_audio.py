@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import io
+
+import numpy as np
+import pytest
+import soundfile as sf
+
+from cpqdtrd.audio import AudioSource, audio_duration, probe_duration
+
+from conftest import wav_bytes
+
+
+def decode(source):
+    return sf.read(io.BytesIO(b"".join(source.chunks())), dtype="int16")[0]
+
+
+def test_sources_yield_the_same_contents(tmp_path):
+    data = wav_bytes()
+    path = tmp_path / "a.wav"
+    path.write_bytes(data)
+    for audio in (str(path), data, io.BytesIO(data)):
+        source = AudioSource(audio, chunk_size=1000)
+        assert source.rewindable and source.size == len(data)
+        assert b"".join(source.chunks()) == data
+        assert b"".join(source.chunks()) == data
+    source = AudioSource(iter([data[:10], data[10:]]))
+    assert not source.rewindable and source.size is None
+    assert b"".join(source.chunks()) == data
+
+
+def test_integer_arrays_are_scaled_to_the_subtype():
+    samples = np.array([-32768, -1, 0, 1, 32767], dtype=np.int16)
+    expected = samples
+    for data in (
+        samples,
+        samples.astype(">i2"),
+        samples.astype(np.int32) << 16,
+        samples.astype(np.int64) << 48,
+        (samples.astype(np.int32) + 32768).astype(np.uint16),
+    ):
+        source = AudioSource(data, samplerate=8000, chunk_size=4)
+        assert np.array_equal(decode(source), expected)
+    source = AudioSource(np.array([0, 128, 255], dtype=np.uint8), samplerate=8000)
+    assert decode(source).tolist() == [-32768, 0, 127 << 8]
+    source = AudioSource(samples, samplerate=8000, subtype="PCM_32")
+    pcm = sf.read(io.BytesIO(b"".join(source.chunks())), dtype="int32")[0]
+    assert np.array_equal(pcm, samples.astype(np.int32) << 16)
+
+
+def test_float_arrays_are_clipped():
+    source = AudioSource(np.array([-2.0, 0.5, 2.0]), samplerate=8000)
+    assert decode(source).tolist() == [-32768, 16384, 32767]
+
+
+def test_array_sources_require_a_samplerate():
+    with pytest.raises(ValueError):
+        AudioSource(np.zeros(10))
+
+
+@pytest.mark.parametrize("format", ["WAV", "FLAC", "OGG"])
+def test_probe_duration(tmp_path, format):
+    path = tmp_path / "a.{}".format(format.lower())
+    sf.write(str(path), np.zeros(12000, dtype=np.int16), 8000, format=format)
+    with open(path, "rb") as f:
+        assert probe_duration(f) == pytest.approx(1.5, abs=0.01)
+    assert audio_duration(path) == pytest.approx(1.5, abs=0.01)
+    assert AudioSource(path.read_bytes()).duration() == pytest.approx(1.5, abs=0.01)
+
+
+def test_duration_cache_sees_changed_files(tmp_path):
+    path = tmp_path / "a.wav"
+    path.write_bytes(wav_bytes(1.0))
+    assert audio_duration(path) == pytest.approx(1.0)
+    path.write_bytes(wav_bytes(2.0))
+    assert audio_duration(path) == pytest.approx(2.0)
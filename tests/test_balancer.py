@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+import socket
+
+import gevent
+import pytest
+import requests
+
+from cpqdtrd.api import TranscriptionApi
+from cpqdtrd.balancer import Balancer
+
+from conftest import wav_bytes
+
+DEAD_URL = "http://127.0.0.1:1"
+
+
+def api(urls, **kwargs):
+    return TranscriptionApi(
+        urls, wait_ready=False, max_retries=0, backoff_factor=0, **kwargs
+    )
+
+
+def job_id(r):
+    assert r.ok, r.text
+    return r.json()["job"]["id"]
+
+
+@pytest.fixture
+def aborting_server():
+    """A server which reads each request and closes without answering."""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    requests_seen = []
+
+    def handle(conn):
+        with conn:
+            conn.settimeout(2)
+            try:
+                requests_seen.append(conn.recv(65536))
+            except OSError:
+                pass
+
+    def serve():
+        while True:
+            conn, _ = listener.accept()
+            gevent.spawn(handle, conn)
+
+    server = gevent.spawn(serve)
+    yield "http://127.0.0.1:{}".format(listener.getsockname()[1]), requests_seen
+    server.kill()
+    listener.close()
+
+
+def test_least_outstanding_spreads_jobs(make_mock):
+    mocks = [make_mock(delay=5), make_mock(delay=5)]
+    a = api([m.url for m in mocks])
+    for _ in range(10):
+        job_id(a.create(wav_bytes(0.1)))
+    assert [m.stats["created"] for m in mocks] == [5, 5]
+    assert [n["outstanding"] for n in a.node_stats()] == [5, 5]
+
+
+def test_job_requests_go_to_the_owning_node(make_mock):
+    mocks = [make_mock(), make_mock()]
+    a = api([m.url for m in mocks])
+    ids = [job_id(a.create(wav_bytes(0.1))) for _ in range(4)]
+    gevent.sleep(0.2)
+    for i in ids:
+        assert a.result(i).status_code == 200
+        assert a.delete(i).ok
+    assert not any(m.jobs for m in mocks)
+
+    # Jobs created elsewhere are looked up on every node
+    b = api([m.url for m in mocks])
+    other = job_id(a.create(wav_bytes(0.1)))
+    assert b.status(other).status_code == 200
+    assert b.balancer.node_for(other).url == a.balancer.node_for(other).url
+
+
+def test_create_fails_over_when_connection_refused(mock):
+    a = api([DEAD_URL, mock.url])
+    for _ in range(4):
+        job_id(a.create(wav_bytes(0.1)))
+    assert mock.stats["created"] == 4
+
+
+def test_create_does_not_fail_over_after_sending(mock, aborting_server):
+    url, seen = aborting_server
+    a = api([url, mock.url], balance="least_outstanding")
+    a.balancer.choose = lambda exclude=(): a.nodes[0] if not exclude else a.nodes[1]
+    with pytest.raises(requests.ConnectionError):
+        a.create(wav_bytes(0.1))
+    assert seen and mock.stats["created"] == 0
+
+
+def test_dead_node_is_ejected():
+    balancer = Balancer(["http://a", "http://b"], breaker_threshold=2)
+    dead, alive = balancer.nodes
+    for _ in range(2):
+        dead.breaker.record_failure()
+    assert not dead.available
+    assert all(balancer.choose() is alive for _ in range(10))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import time
+
+import gevent
+
+from conftest import wav_bytes
+
+
+def test_transcribe_many_yields_every_file(mock, client):
+    paths = [wav_bytes(0.1 * i) for i in range(1, 7)] + [b"not audio"]
+    items = list(client.transcribe_many(paths, concurrency=3, timeout=5))
+    assert len(items) == len(paths)
+    results = [r for _, _, r in items if isinstance(r, dict)]
+    assert len(results) == 7  # The mock server accepts anything
+    assert all(r["job"]["status"] == "COMPLETED" for r in results)
+    assert mock.stats["created"] == 7 and not mock.jobs
+
+
+def test_upload_errors_are_reported_per_item(client):
+    items = list(client.transcribe_many([wav_bytes(), "/nonexistent.wav"], timeout=5))
+    errors = [(path, job_id, r) for path, job_id, r in items if isinstance(r, Exception)]
+    assert [(path, job_id) for path, job_id, _ in errors] == [("/nonexistent.wav", None)]
+
+
+def test_pending_limit_holds_back_uploads(make_mock, make_client):
+    mock = make_mock(delay=0)
+    client = make_client(api_url=mock.url)
+    batch = client.transcribe_many(
+        (wav_bytes(0.1) for _ in range(10)), concurrency=2, max_pending=2, timeout=5
+    )
+    next(batch)
+    gevent.sleep(0.3)
+    assert mock.stats["created"] <= 3  # The yielded job and two pending
+    assert len(list(batch)) == 9
+
+
+def test_closing_the_batch_cancels_pending_jobs(make_mock, make_client):
+    mock = make_mock(delay=0.05, rtf=1.0)  # Only the short file completes soon
+    client = make_client(api_url=mock.url)
+    paths = [wav_bytes(0.1)] + [wav_bytes(10.0)] * 3
+    batch = client.transcribe_many(paths, concurrency=4)
+    start = time.monotonic()
+    next(batch)
+    batch.close()
+    assert time.monotonic() - start < 5
+    assert mock.stats["created"] == 4 and not mock.jobs and len(client.jobs) == 0
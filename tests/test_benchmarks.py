@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import subprocess
+import sys
+
+import gevent
+import requests
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "benchmarks")
+
+
+def test_mock_server_job_lifecycle(make_mock):
+    mock = make_mock(delay=0, segments=3)
+    r = requests.post(
+        mock.url + "/job/create", files={"upload_file": ("a.wav", b"\0" * 100)}
+    )
+    job_id = r.json()["job"]["id"]
+    with gevent.Timeout(5):
+        while requests.get(mock.url + "/job/status/" + job_id).json()["job"][
+            "status"
+        ] != "COMPLETED":
+            gevent.sleep(0.02)
+    result = requests.get(mock.url + "/job/result/" + job_id).json()
+    assert result["job"]["status"] == "COMPLETED" and len(result["segments"]) == 3
+    lines = requests.get(mock.url + "/query/job", params={"status": "COMPLETED"})
+    assert [json.loads(line)["job"]["id"] for line in lines.iter_lines()] == [job_id]
+    assert requests.delete(mock.url + "/job/" + job_id).ok
+    assert requests.get(mock.url + "/job/status/" + job_id).status_code == 404
+
+
+def test_refuses_jobs_beyond_max_queue(make_mock):
+    mock = make_mock(delay=5, workers=1, max_queue=1)
+    codes = [
+        requests.post(
+            mock.url + "/job/create", files={"upload_file": ("a.wav", b"")}
+        ).status_code
+        for _ in range(3)
+    ]
+    assert codes[0] == 200 and 503 in codes and mock.stats["refused"] >= 1
+
+
+def test_throughput_benchmark_runs():
+    out = subprocess.check_output(
+        [
+            sys.executable,
+            os.path.join(BENCHMARKS, "throughput.py"),
+            "--jobs", "4",
+            "--concurrency", "2",
+            "--callbacks", "1",
+            "--payload-kb", "4",
+            "--delay", "0",
+            "--json",
+        ],
+        text=True,
+        timeout=60,
+    )
+    (row,) = [json.loads(line) for line in out.splitlines() if line.startswith("{")]
+    assert row["jobs"] == 4 and row["jobs_per_s"] > 0
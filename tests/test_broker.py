@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import gevent
+import pytest
+from gevent.monkey import get_original
+
+from cpqdtrd.broker import AmqpBroker, InProcessBroker, Message, ResultConsumer
+
+from conftest import wav_bytes
+
+real_sleep = get_original("time", "sleep")
+
+
+def ticks_during(fn, *args):
+    """Run fn while counting how often another greenlet gets to run."""
+    ticks = []
+
+    def tick():
+        while True:
+            ticks.append(1)
+            gevent.sleep(0.01)
+
+    ticker = gevent.spawn(tick)
+    gevent.sleep(0)
+    try:
+        fn(*args)
+    finally:
+        ticker.kill()
+    return len(ticks)
+
+
+class NativeSubscription:
+    """A subscription blocking on real sleeps, like pika does."""
+
+    native = True
+
+    def __init__(self, messages):
+        self._messages = list(messages)
+        self.closed = False
+
+    def get(self, timeout=None):
+        real_sleep(0.05)
+        return self._messages.pop(0) if self._messages else None
+
+    def close(self):
+        self.closed = True
+
+
+class NativeBroker:
+    def __init__(self, messages):
+        self.subscription = NativeSubscription(messages)
+
+    def subscribe(self, **kwargs):
+        return self.subscription
+
+
+def test_consumer_waits_and_keeps_late_results():
+    broker = InProcessBroker()
+    consumer = ResultConsumer(broker)
+    gevent.sleep(0)
+    waiter = gevent.spawn(consumer.wait, "a", 2)
+    gevent.sleep(0.01)
+    broker.publish("a", "__root__", {"job": {"id": "a"}})
+    broker.publish("b", "__root__", {"job": {"id": "b"}})
+    assert waiter.get() == {"job": {"id": "a"}}
+    assert consumer.wait("b", 1) == {"job": {"id": "b"}}
+    assert consumer.wait("c", 0.05) is False
+    consumer.close()
+
+
+def test_named_queue_shares_notices():
+    broker = InProcessBroker()
+    workers = [broker.subscribe("work"), broker.subscribe("work")]
+    for i in range(6):
+        broker.publish(str(i), "__root__", {})
+    received = [w.get(timeout=0.1) for w in workers for _ in range(3)]
+    assert sorted(m.job_id for m in received) == [str(i) for i in range(6)]
+    assert workers[0].get(timeout=0.01) is None
+
+
+def test_native_subscription_does_not_block_the_hub():
+    broker = NativeBroker([Message("a", "__root__", {"ok": True})])
+    consumer = ResultConsumer(broker)
+    result = []
+    assert ticks_during(lambda: result.append(consumer.wait("a", 2))) >= 3
+    assert result == [{"ok": True}]
+    consumer.close()
+    gevent.sleep(1.2)
+    assert broker.subscription.closed
+
+
+def test_amqp_publish_does_not_block_the_hub(monkeypatch):
+    pytest.importorskip("pika")
+    published = []
+
+    class Channel:
+        def confirm_delivery(self):
+            pass
+
+        def basic_publish(self, exchange, key, body, properties):
+            real_sleep(0.2)  # Waiting for the confirm
+            published.append((key, body))
+
+    broker = AmqpBroker()
+    monkeypatch.setattr(broker, "_connect", lambda: (None, Channel()))
+    assert ticks_during(broker.publish, "a", "__root__", {"x": 1}) >= 5
+    assert [key for key, _ in published] == ["a"]
+
+
+def test_client_publishes_notices_without_token(make_client):
+    broker = InProcessBroker()
+    consumer = ResultConsumer(broker)
+    client = make_client(broker=broker)
+    job_id, _ = client.transcribe(wav_bytes())
+    payload = consumer.wait(job_id, 2)
+    assert payload["job"]["id"] == job_id
+    assert "token" not in payload
+    consumer.close()
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import gevent
+import pytest
+import time
+
+from cpqdtrd.cache import DiskResultCache, MemoryResultCache, ResultCache, content_key
+
+from conftest import wav_bytes
+
+
+def test_content_key_depends_on_audio_and_config():
+    audio = wav_bytes()
+    assert content_key(audio) == content_key(audio)
+    assert content_key(audio) != content_key(audio, ["a=b"])
+    assert content_key(audio) != content_key(wav_bytes(2.0))
+
+
+def test_backends_must_implement_the_interface():
+    class Incomplete(ResultCache):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete()
+    with pytest.raises(TypeError):
+        ResultCache()
+
+
+def test_memory_cache_lru():
+    cache = MemoryResultCache(max_entries=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+
+
+def test_concurrent_identical_submissions_share_one_job(mock, make_client):
+    client = make_client(result_cache=MemoryResultCache())
+    audio = wav_bytes()
+    greenlets = [gevent.spawn(client.transcribe, audio) for _ in range(5)]
+    gevent.joinall(greenlets, raise_error=True)
+    assert mock.stats["created"] == 1
+    assert len({g.value[0] for g in greenlets}) == 1
+    assert all(g.value[1]["segments"] for g in greenlets)
+
+    # Later submissions are served from the cache
+    client.transcribe(audio)
+    assert mock.stats["created"] == 1
+
+
+def test_failed_upload_is_shared_and_forgotten(mock, make_client, monkeypatch):
+    client = make_client(result_cache=MemoryResultCache())
+    create = client.api.create
+
+    def failing(*args, **kwargs):
+        gevent.sleep(0.05)
+        raise ConnectionError("upload failed")
+
+    monkeypatch.setattr(client.api, "create", failing)
+    audio = wav_bytes()
+    greenlets = [gevent.spawn(client.transcribe, audio) for _ in range(3)]
+    gevent.joinall(greenlets)
+    assert all(isinstance(g.exception, ConnectionError) for g in greenlets)
+
+    monkeypatch.setattr(client.api, "create", create)
+    job_id, result = client.transcribe(audio)
+    assert result["job"]["id"] == job_id
+    assert mock.stats["created"] == 1
+
+
+def test_disk_cache_ttl_counts_from_creation(tmp_path):
+    cache = DiskResultCache(str(tmp_path), ttl=0.3)
+    cache.set("ab12", {"x": 1})
+    assert cache.get("ab12") == {"x": 1}
+    time.sleep(0.2)
+    assert cache.get("ab12") == {"x": 1}  # Hits don't extend the TTL
+    time.sleep(0.2)
+    assert cache.get("ab12") is None
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskResultCache(str(tmp_path), max_size=100)
+    for key in ("aa01", "aa02", "aa03"):
+        cache.set(key, {"v": "x" * 20})
+        time.sleep(0.01)
+    cache.get("aa01")
+    cache.set("aa04", {"v": "x" * 20})
+    assert cache.get("aa02") is None
+    assert cache.get("aa01") is not None
+
+
+def test_cancelled_job_is_not_reused(make_mock, make_client):
+    mock = make_mock(delay=0, rtf=1.0)  # Only the short file completes soon
+    client = make_client(api_url=mock.url, result_cache=MemoryResultCache())
+    audio = wav_bytes(3.0)
+    batch = client.transcribe_many([wav_bytes(0.1), audio], concurrency=2)
+    next(batch)
+    batch.close()
+    assert not mock.jobs
+    job_id = client.transcribe(audio, timeout=-1)
+    assert job_id in mock.jobs and mock.stats["created"] == 3
+
+
+def test_streamed_job_is_not_reused(mock, make_client):
+    client = make_client(result_cache=MemoryResultCache())
+    audio = wav_bytes()
+    job_id = client.transcribe(audio, timeout=-1)
+    assert list(client.wait_result(job_id, 5, stream=True))
+    assert job_id not in mock.jobs
+    new_id, result = client.transcribe(audio, timeout=5)
+    assert new_id != job_id and result["job"]["id"] == new_id
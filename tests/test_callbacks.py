@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+import gevent
+import pytest
+
+from conftest import wav_bytes
+
+
+def test_callbacks_registered_while_serving(make_mock, make_client):
+    mock = make_mock(delay=0)
+    client = make_client(api_url=mock.url)
+    first = []
+    client.register_callback(lambda job_id, r: first.append(job_id), "first")
+    job_a, _ = client.transcribe(wav_bytes(), timeout=5)
+    server = client._http_server
+    second = []
+    name = client.register_callback(lambda job_id, r: second.append(job_id))
+    job_b, _ = client.transcribe(wav_bytes(), timeout=5)
+    assert client._http_server is server  # Not restarted
+    assert first == [job_a, job_b] and second == [job_b]
+    assert name.startswith("_callback_")
+
+
+def test_jobs_keep_the_callbacks_they_were_submitted_with(make_mock, make_client):
+    mock = make_mock(delay=0.2)
+    client = make_client(api_url=mock.url)
+    calls = []
+    client.register_callback(lambda job_id, r: calls.append("old"), "cb")
+    job_id = client.transcribe(wav_bytes(), timeout=-1)
+    client.unregister_callback("cb")
+    client.register_callback(lambda job_id, r: calls.append("new"), "cb")
+    assert client.wait_result(job_id, 5)
+    client.unregister_all()
+    client.transcribe(wav_bytes(), timeout=5)
+    gevent.sleep(0.1)
+    assert calls == ["old"]
+
+
+def test_callback_names(client):
+    with pytest.raises(ValueError):
+        client.register_callback(print, "_callback_x")
+    name = client.register_callback(print)
+    client.unregister_callback(int(name.rsplit("_", 1)[1]))
+    assert name not in client._callbacks
+    with pytest.raises(ValueError):
+        client.unregister_callback(1.5)
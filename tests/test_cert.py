@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import os
+import stat
+import subprocess
+import sys
+
+from cryptography import x509
+import pytest
+
+from cpqdtrd.cert import create_self_signed_cert, load_or_create_cert
+
+
+def test_cached_certificate_is_reused(tmp_path):
+    path, pem = load_or_create_cert("127.0.0.1", str(tmp_path))
+    mtime = os.stat(path).st_mtime_ns
+    assert load_or_create_cert("127.0.0.1", str(tmp_path)) == (path, pem)
+    assert os.stat(path).st_mtime_ns == mtime
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+
+def test_certificate_rotated_before_expiry(tmp_path):
+    path, pem = load_or_create_cert("example.com", str(tmp_path), valid_days=5)
+    assert load_or_create_cert("example.com", str(tmp_path), valid_days=5)[1] != pem
+
+
+def test_corrupt_cache_is_replaced(tmp_path):
+    path, _ = load_or_create_cert("example.com", str(tmp_path))
+    with open(path, "wb") as f:
+        f.write(b"garbage")
+    _, pem = load_or_create_cert("example.com", str(tmp_path))
+    cert = x509.load_pem_x509_certificate(pem.encode())
+    san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+    assert san.value.get_values_for_type(x509.DNSName) == ["example.com"]
+
+
+def test_separate_key_file(tmp_path):
+    cert, key = str(tmp_path / "a.crt"), str(tmp_path / "a.key")
+    create_self_signed_cert("example.com", cert, key, key_type="ec")
+    with open(key, "rb") as f:
+        assert b"EC PRIVATE KEY" in f.read()
+    with pytest.raises(ValueError):
+        create_self_signed_cert("example.com", cert, key, key_type="dsa")
+
+
+def test_import_is_lazy():
+    code = (
+        "import sys, cpqdtrd; "
+        "heavy = {'flask', 'gevent', 'requests', 'numpy', 'cryptography'}; "
+        "print(sorted(heavy & set(sys.modules)))"
+    )
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.check_output([sys.executable, "-c", code], cwd=root, text=True)
+    assert out.strip() == "[]"
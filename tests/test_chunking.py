@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import math
+import time
+
+import gevent
+import pytest
+
+from cpqdtrd.audio import AudioSource
+from cpqdtrd.chunking import merge_results, plan_chunks
+
+from conftest import wav_bytes
+
+
+def test_plan_chunks_covers_the_recording():
+    chunks = plan_chunks(AudioSource(wav_bytes(10.0)), 3.0, overlap=0.5, split="fixed")
+    assert [c.index for c in chunks] == [0, 1, 2]
+    assert chunks[0].start == 0 and chunks[-1].end == 80000
+    assert chunks[0].own_start == -math.inf and chunks[-1].own_end == math.inf
+    for a, b in zip(chunks, chunks[1:]):
+        assert a.own_end == b.own_start
+        assert a.end - b.start == 2 * 4000  # Overlap on both sides of the cut
+
+
+def test_merge_results_drops_overlap_duplicates():
+    chunks = plan_chunks(AudioSource(wav_bytes(4.0)), 2.0, overlap=0.5, split="fixed")
+    results = [
+        {
+            "job": {"id": "a", "status": "COMPLETED"},
+            "segments": [
+                {"start_time": 0.0, "end_time": 1.0},
+                {"start_time": 1.8, "end_time": 2.4},  # Owned by the next chunk
+            ],
+        },
+        {
+            "job": {"id": "b", "status": "FAILED"},
+            "segments": [
+                {"start_time": 0.3, "end_time": 0.9},
+                {"start_time": 1.0, "end_time": 2.0},
+            ],
+        },
+    ]
+    merged = merge_results(chunks, results)
+    assert merged["job"]["id"] == "a" and merged["job"]["status"] == "FAILED"
+    assert [c["id"] for c in merged["job"]["chunks"]] == ["a", "b"]
+    assert [s["start_time"] for s in merged["segments"]] == [0.0, 1.8, 2.5]
+
+
+def test_transcribe_in_chunks(make_mock, make_client):
+    client = make_client(api_url=make_mock(segments=2).url)
+    job_id, result = client.transcribe(
+        wav_bytes(3.0), chunk_length=1.0, chunk_split="fixed", timeout=10
+    )
+    assert result["job"]["id"] == job_id
+    assert len(result["job"]["chunks"]) == 3
+    assert all(c["status"] == "COMPLETED" for c in result["job"]["chunks"])
+
+
+def test_failed_chunk_cancels_the_others(make_mock, make_client):
+    mock = make_mock(delay=5)
+    client = make_client(api_url=mock.url)
+    create = client.api.create
+
+    def failing_create(source, *args, **kwargs):
+        if source.filename.endswith("part2.wav"):
+            gevent.sleep(0.2)  # Let the other chunks be submitted
+            raise ConnectionError("upload failed")
+        return create(source, *args, **kwargs)
+
+    client.api.create = failing_create
+    start = time.monotonic()
+    with pytest.raises(ConnectionError):
+        client.transcribe(wav_bytes(3.0), chunk_length=1.0, chunk_split="fixed")
+    assert time.monotonic() - start < 2
+    assert mock.stats["created"] == 2
+    assert not mock.jobs and len(client.jobs) == 0
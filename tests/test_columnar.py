@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+import json
+import math
+
+import pytest
+
+from cpqdtrd import _json
+from cpqdtrd.columnar import iter_columns, iter_numpy, write_arrow, write_parquet
+
+
+RESULTS = [
+    {
+        "job": {"id": "a"},
+        "segments": [
+            {"start_time": 0.0, "end_time": 1.0, "text": "olá", "score": 90},
+            {"start": 1.0, "end": 2.0, "transcription": "mundo", "channel": 1},
+        ],
+    },
+    json.dumps({"_id": 7, "result": [{"start_time": 5, "text": "x"}]}),
+    {"job": {"id": "empty"}, "segments": None},
+]
+
+
+def test_rows_in_batches():
+    batches = list(iter_columns(RESULTS, batch_size=2))
+    assert [len(b["job_id"]) for b in batches] == [2, 1]
+    assert batches[0]["text"] == ["olá", "mundo"]
+    assert batches[0]["speaker"] == [None, 1]
+    assert batches[1] == {
+        "job_id": ["7"],
+        "start_time": [5],
+        "end_time": [None],
+        "text": ["x"],
+        "confidence": [None],
+        "speaker": [None],
+    }
+    with pytest.raises(ValueError):
+        next(iter_columns(RESULTS, batch_size=0))
+
+
+def test_numpy_columns():
+    (arrays,) = iter_numpy(RESULTS)
+    assert arrays["start_time"].dtype == float
+    assert math.isnan(arrays["end_time"][2]) and arrays["confidence"][0] == 90
+    assert list(arrays["speaker"]) == [None, "1", None]
+
+
+@pytest.mark.parametrize("write", [write_parquet, write_arrow])
+def test_files(tmp_path, write):
+    pa = pytest.importorskip("pyarrow")
+    path = str(tmp_path / "out")
+    assert write(iter(RESULTS), path, batch_size=2) == 3
+    if write is write_parquet:
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path)
+    else:
+        table = pa.ipc.open_file(path).read_all()
+    assert table.column("job_id").to_pylist() == ["a", "a", "7"]
+    assert table.column("speaker").to_pylist() == [None, "1", None]
+
+
+def test_json_decoding():
+    doc = '{"job": {"id": "a", "created_at": {"$date": "2024-01-01T00:00:00Z"}}}'
+    for data in (doc, doc.encode()):
+        assert _json.loads(data)["job"]["created_at"] == {
+            "$date": "2024-01-01T00:00:00Z"
+        }
+        assert _json.loads_extended(data)["job"]["created_at"].year == 2024
+    assert _json.loads_extended(b'{"id": "a"}') == {"id": "a"}
+    assert _json.loads(_json.dumps({"text": "olá"})) == {"text": "olá"}
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import gevent
+from gevent.monkey import get_original
+
+from cpqdtrd.dispatch import CallbackDispatcher
+from cpqdtrd.metrics import MetricsRegistry
+
+from conftest import wav_bytes
+
+blocking_sleep = get_original("time", "sleep")
+
+
+def dispatcher(**kw):
+    return CallbackDispatcher(metrics=MetricsRegistry(), **kw)
+
+
+def test_callbacks_do_not_block_the_hub():
+    d = dispatcher(workers=2)
+    ticks = []
+    ticker = gevent.spawn(lambda: [ticks.append(gevent.sleep(0.01)) for _ in range(20)])
+    done = []
+    for i in range(2):
+        assert d.submit(blocking_sleep, (0.3,), lambda: done.append(1))
+    assert d.join(timeout=2) and len(done) == 2
+    assert len(ticks) >= 10  # The ticker ran while the callbacks blocked
+    ticker.kill()
+    d.stop()
+
+
+def test_failures_are_counted_and_on_done_still_called():
+    d = dispatcher(workers=1)
+    done = []
+    d.submit(lambda: 1 / 0, (), lambda: done.append(1))
+    d.submit(lambda: None, (), lambda: done.append(2))
+    d.join(timeout=2)
+    assert done == [1, 2]
+    assert d.stats()["failed"] == 1 and d.stats()["completed"] == 1
+    d.stop()
+
+
+def test_full_queue_refuses_calls():
+    d = dispatcher(workers=1, max_queue=1, put_timeout=0.05)
+    assert d.submit(blocking_sleep, (0.3,))
+    gevent.sleep(0.01)  # The worker takes the first call
+    assert d.submit(blocking_sleep, (0.3,))
+    assert not d.submit(blocking_sleep, (0.3,))
+    assert d.stats()["rejected"] == 1
+    d.stop()
+
+
+def test_webhooks_acknowledged_before_callbacks_finish(make_mock, make_client):
+    mock = make_mock(delay=0)
+    client = make_client(api_url=mock.url, callback_workers=2)
+    acknowledged = []
+
+    def slow(job_id, r):
+        blocking_sleep(0.5)
+        acknowledged.append(mock.stats["webhooks"])
+
+    client.register_callback(slow, "slow")
+    job_id, result = client.transcribe(wav_bytes(), timeout=5)
+    assert result and acknowledged == [2]  # Both webhooks, this one included
+    assert client.dispatcher.stats()["completed"] == 1
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import itertools
+import socket
+import time
+
+import gevent
+import pytest
+import requests
+
+from cpqdtrd.api import TranscriptionApi
+from cpqdtrd.health import CircuitBreaker, CircuitOpenError, backoff_delays
+
+
+def half_open_breaker(reset=0.05):
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=reset)
+    breaker.record_failure()
+    time.sleep(reset * 1.5)
+    assert breaker.state == "half-open"
+    return breaker
+
+
+@pytest.fixture
+def hanging_url():
+    """A server which accepts connections and never answers."""
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(16)
+    yield "http://127.0.0.1:{}".format(listener.getsockname()[1])
+    listener.close()
+
+
+def test_backoff_delays_are_capped():
+    delays = list(itertools.islice(backoff_delays(1.0, 8.0), 10))
+    assert all(0 <= d <= 8.0 for d in delays)
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    for _ in range(2):
+        breaker.record_failure()
+    breaker.allow()
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+
+
+def test_half_open_lets_a_single_trial_through():
+    breaker = half_open_breaker()
+    breaker.allow()
+    with pytest.raises(CircuitOpenError):
+        breaker.allow()
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_failed_trial_reopens():
+    breaker = half_open_breaker()
+    breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_unexpected_error_records_failure(monkeypatch):
+    api = TranscriptionApi("http://127.0.0.1:1", wait_ready=False)
+    breaker = api.nodes[0].breaker = half_open_breaker()
+
+    def broken(*args, **kwargs):
+        raise requests.exceptions.ChunkedEncodingError("broken body")
+
+    monkeypatch.setattr(api._session, "request", broken)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        api.status("x")
+    assert breaker.state == "open" and not breaker._trial
+
+
+def test_interrupted_trial_is_released(hanging_url):
+    api = TranscriptionApi(hanging_url, wait_ready=False, max_retries=0)
+    breaker = api.nodes[0].breaker = half_open_breaker()
+    call = gevent.spawn(api.status, "x")
+    gevent.sleep(0.1)
+    call.kill()
+    assert breaker.state == "half-open"
+    breaker.allow()  # Another trial is let through
+
+
+def test_constructor_does_not_wait_for_the_server():
+    start = time.monotonic()
+    api = TranscriptionApi(
+        "http://127.0.0.1:1",
+        wait_ready=False,
+        retry=2,
+        retry_period=0.01,
+        max_retries=0,
+    )
+    assert time.monotonic() - start < 0.5 and not api.ready()
+    with pytest.raises(TranscriptionApi.TimeoutException):
+        api.wait_ready(timeout=5)
+    with pytest.raises(TranscriptionApi.TimeoutException):
+        TranscriptionApi(
+            "http://127.0.0.1:1", retry=1, retry_period=0.01, max_retries=0
+        )
+
+
+def test_wait_ready(mock):
+    api = TranscriptionApi(mock.url, wait_ready=False)
+    assert api.wait_ready(timeout=5) and api.ready()
+
+
+@pytest.mark.parametrize("kwargs", [{"retry_deadline": 0.5}, {"retry_period": 0.05}])
+def test_check_gives_up_at_the_deadline(kwargs):
+    # Retries and backoff cap alone would allow minutes of waiting
+    kwargs = dict({"retry": 10, "retry_period": 1, "max_retries": 0}, **kwargs)
+    start = time.monotonic()
+    with pytest.raises(TranscriptionApi.TimeoutException):
+        TranscriptionApi("http://127.0.0.1:1", **kwargs)
+    assert time.monotonic() - start < 1.5
@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import time
+
+import pytest
+
+from cpqdtrd.journal import COLLECTED, COMPLETED, DELETED, SUBMITTED, JobJournal
+
+from conftest import free_port, wav_bytes
+
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = JobJournal(str(tmp_path / "jobs.db"))
+    yield journal
+    journal.close()
+
+
+def test_states_only_move_forward(journal):
+    journal.record("a", SUBMITTED, "tag", ["cb"], delete_after=False)
+    journal.record("a", COLLECTED, delete_after=False)
+    journal.record("a", COMPLETED)  # Late notice
+    journal.record("b", SUBMITTED)
+    journal.record("b", DELETED)
+    journal.record("c", SUBMITTED)
+    entries = journal.unfinished()
+    assert [e.job_id for e in entries] == ["c"]
+    assert journal.counts() == {COLLECTED: 1, DELETED: 1, SUBMITTED: 1}
+
+
+def test_unfinished_keeps_collected_jobs_to_delete(journal):
+    journal.record("a", SUBMITTED, "tag", ["cb"])
+    journal.record("a", COLLECTED)
+    (entry,) = journal.unfinished()
+    assert (entry.job_id, entry.state, entry.tag) == ("a", COLLECTED, "tag")
+    assert entry.callbacks == ["cb"] and entry.delete_after
+
+
+def test_records_survive_reopening(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    journal = JobJournal(path, flush_interval=60)
+    journal.record("a", SUBMITTED)
+    journal.set_setting("webhook_token", "secret")
+    journal.close()
+    journal = JobJournal(path)
+    assert [e.job_id for e in journal.unfinished()] == ["a"]
+    assert journal.setting("webhook_token") == "secret"
+    assert journal.setting("missing", 1) == 1
+    journal.close()
+
+
+def test_closed_journal(journal):
+    journal.close()
+    journal.close()
+    journal.record("a", SUBMITTED)
+    for query in (journal.unfinished, journal.counts, lambda: journal.setting("a")):
+        with pytest.raises(ValueError, match="closed"):
+            query()
+
+
+def test_resume_after_restart(tmp_path, make_mock, make_client):
+    mock = make_mock(delay=0.5)
+    path = str(tmp_path / "jobs.db")
+    port = free_port()
+    first = make_client(api_url=mock.url, journal=path, webhook_port=port)
+    first.register_callback(lambda job_id, r: None, "cb")
+    job_id = first.transcribe(wav_bytes(), timeout=-1)
+    first.stop()
+
+    results = []
+    second = make_client(api_url=mock.url, journal=path, webhook_port=port)
+    second.register_callback(lambda job_id, r: results.append(job_id), "cb")
+    assert second.resume() == [job_id]
+    deadline = time.monotonic() + 5
+    while job_id in mock.jobs and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert job_id not in mock.jobs
+    assert results == [job_id]  # Webhook accepted with the journaled token
+    assert second.resume() == []
+
+
+def test_collection_overrides_delete_after(journal):
+    journal.record("a", SUBMITTED, delete_after=True)
+    journal.record("a", COLLECTED, delete_after=False)
+    journal.record("b", SUBMITTED, delete_after=False)
+    journal.record("b", COMPLETED)  # Other records keep the stored choice
+    assert [e.job_id for e in journal.unfinished()] == ["b"]
+    assert not journal.unfinished()[0].delete_after
+
+
+def test_resume_keeps_results_collected_without_delete(
+    tmp_path, make_mock, make_client
+):
+    mock = make_mock(delay=0)
+    path = str(tmp_path / "jobs.db")
+    first = make_client(api_url=mock.url, journal=path)
+    job_id = first.transcribe(wav_bytes(), timeout=-1)
+    assert first.wait_result(job_id, 5, delete_after=False)
+    first.stop()
+
+    second = make_client(api_url=mock.url, journal=path)
+    assert second.resume() == []
+    time.sleep(0.2)
+    assert job_id in mock.jobs
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import pytest
+import requests
+
+from cpqdtrd.metrics import MetricsRegistry
+
+from conftest import wav_bytes
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry()
+    registry.counter("jobs_total", "Jobs.", ("status",)).labels('a"b').inc(2)
+    registry.gauge("queue", "Queue.").set(3)
+    histogram = registry.histogram("latency", "Latency.", buckets=(0.1, 1))
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+    text = registry.render()
+    assert '# TYPE jobs_total counter\njobs_total{status="a\\"b"} 2.0' in text
+    assert "queue 3.0" in text
+    assert 'latency_bucket{le="0.1"} 1' in text
+    assert 'latency_bucket{le="1.0"} 2' in text
+    assert 'latency_bucket{le="+Inf"} 3' in text
+    assert "latency_count 3" in text and "latency_sum 5.55" in text
+
+
+def test_metrics_are_registered_once():
+    registry = MetricsRegistry()
+    counter = registry.counter("a", "A.", ("x",))
+    assert registry.counter("a", "A.", ("x",)) is counter
+    with pytest.raises(ValueError):
+        registry.gauge("a", "A.")
+    with pytest.raises(ValueError):
+        counter.labels()
+
+
+def test_failing_hooks_are_isolated():
+    registry = MetricsRegistry()
+    events = []
+    registry.add_hook(lambda *args: 1 / 0)
+    registry.add_hook(lambda event, job_id, ts, info: events.append((event, info)))
+    registry.job_event("created", "a", tag="t")
+    assert events == [("created", {"tag": "t"})]
+
+
+def test_client_lifecycle_and_route(make_mock, make_client):
+    registry = MetricsRegistry()
+    client = make_client(
+        api_url=make_mock(delay=0).url, metrics=registry, metrics_route=True
+    )
+    events = []
+    registry.add_hook(lambda event, job_id, ts, info: events.append(event))
+    client.transcribe(wav_bytes(), timeout=5)
+    assert events[0] == "created" and events[-1] in ("done", "collected")
+    assert {"created", "webhook", "signaled", "done"} <= set(events)
+    r = requests.get("http://127.0.0.1:{}/metrics".format(client._webhook_port))
+    assert r.ok and 'cpqdtrd_api_requests_total{method="POST"' in r.text
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import gevent
+
+from cpqdtrd.api import TranscriptionApi
+from cpqdtrd.poller import JobPoller, job_from_document
+
+from conftest import wav_bytes
+
+
+def test_job_from_document():
+    assert job_from_document({"job": {"id": "a"}}) == {"id": "a"}
+    assert job_from_document({"_id": 1, "status": "FAILED"})["id"] == "1"
+
+
+def test_one_query_per_cycle_for_all_jobs(make_mock):
+    mock = make_mock(delay=0.1)
+    api = TranscriptionApi(mock.url, wait_ready=False)
+    done = {}
+    poller = JobPoller(api, done.__setitem__, min_interval=0.2, page_limit=2)
+    job_ids = [api.create(wav_bytes(0.1)).json()["job"]["id"] for _ in range(5)]
+    for job_id in job_ids:
+        poller.add(job_id)
+    poller.start()
+    try:
+        with gevent.Timeout(5):
+            while len(done) < 5:
+                gevent.sleep(0.05)
+    finally:
+        poller.stop()
+    assert sorted(done) == sorted(job_ids) and len(poller) == 0
+    assert all(job["status"] == "COMPLETED" for job in done.values())
+    assert poller.requests <= 6  # Pages of the first cycle, not one per job
+
+
+def test_polling_client(make_mock, make_client):
+    mock = make_mock(delay=0.1)
+    client = make_client(
+        api_url=mock.url, polling=True, poller_kwargs={"min_interval": 0.1}
+    )
+    calls = []
+    client.register_callback(lambda job_id, r: calls.append(job_id), "cb")
+    job_id, result = client.transcribe(wav_bytes(), timeout=5)
+    assert result["job"]["status"] == "COMPLETED"
+    assert calls == [job_id] and mock.stats["webhooks"] == 0
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import io
+
+import numpy as np
+import pytest
+
+sf = pytest.importorskip("soundfile")
+
+from cpqdtrd.preprocess import normalize_audio, resample, to_float  # noqa: E402
+
+
+def sine(rate, seconds=1.0, freq=440.0, amplitude=0.5):
+    t = np.arange(int(rate * seconds)) / rate
+    return amplitude * np.sin(2 * np.pi * freq * t)
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.int32])
+def test_integer_samples_are_scaled(dtype):
+    x = (sine(8000) * (np.iinfo(dtype).max + 1)).astype(dtype)
+    assert np.allclose(to_float(x), sine(8000), atol=1e-3)
+
+
+def test_unsigned_samples_are_centered():
+    assert np.allclose(to_float(np.array([0, 128, 255], np.uint8)), [-1, 0, 127 / 128])
+
+
+def test_stereo_int16_is_not_clipped():
+    x = (sine(48000) * 32768).astype(np.int16)
+    data = normalize_audio(np.stack([x, x], axis=1), 48000)
+    y, rate = sf.read(io.BytesIO(data))
+    assert rate == 16000
+    assert np.mean(np.abs(y) > 0.99) < 0.01
+    assert 0.45 < np.max(np.abs(y)) < 0.55
+
+
+def test_resample_float_rates():
+    y = resample(sine(48000).astype(np.float32), 48000.0, 16000.0)
+    assert abs(len(y) - 16000) <= 1
+
+
+def test_already_normalized_file_is_kept():
+    out = io.BytesIO()
+    sf.write(out, sine(8000), 8000, format="FLAC")
+    assert normalize_audio(out.getvalue()) is None
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+
+import pytest
+
+from cpqdtrd.streaming import SegmentStream, iter_fields
+
+from conftest import wav_bytes
+
+
+def random_value(rnd, depth=0):
+    kind = rnd.randrange(7 if depth < 3 else 4)
+    if kind == 0:
+        return rnd.choice([None, True, False])
+    if kind == 1:
+        return rnd.choice([rnd.uniform(-1e6, 1e6), rnd.randrange(-10**12, 10**12)])
+    if kind in (2, 3):
+        return "".join(rnd.choice('ab"\\\n\t{}[],:é€😀 ') for _ in range(rnd.randrange(12)))
+    if kind == 4:
+        return [random_value(rnd, depth + 1) for _ in range(rnd.randrange(4))]
+    return {
+        str(rnd.random()): random_value(rnd, depth + 1) for _ in range(rnd.randrange(4))
+    }
+
+
+def split(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def test_decodes_random_documents_in_any_chunking():
+    rnd = random.Random(1)
+    for _ in range(500):
+        keys = ["job", "segments", "other"]
+        rnd.shuffle(keys)
+        doc = {
+            key: [random_value(rnd) for _ in range(rnd.randrange(5))]
+            if key == "segments"
+            else random_value(rnd)
+            for key in keys
+        }
+        data = json.dumps(
+            doc, ensure_ascii=rnd.random() < 0.5, indent=rnd.choice([None, 2])
+        ).encode()
+        stream = SegmentStream(split(data, rnd.randrange(1, 20)))
+        assert stream.result() == doc and stream.complete
+
+
+def test_numbers_cut_by_chunks():
+    data = b'{"segments": [1.5, 22, -3e4], "job": 10}'
+    for size in range(1, len(data)):
+        assert SegmentStream(split(data, size)).result() == json.loads(data)
+
+
+@pytest.mark.parametrize(
+    "data", [b'{"job": {"a": 1}, "segments": [{"a"', b'[1, 2]', b'{"a": }', b""]
+)
+def test_invalid_documents(data):
+    with pytest.raises(ValueError):
+        list(iter_fields(split(data, 4)))
+
+
+def test_close_before_the_end():
+    closed = []
+    data = json.dumps({"job": {"id": "a"}, "segments": list(range(100))}).encode()
+    with SegmentStream(split(data, 8), closed.append) as stream:
+        segments = iter(stream)
+        assert next(segments) == 0 and stream.job == {"id": "a"}
+    stream.close()
+    assert closed == [False] and not stream.complete
+
+
+def test_wait_result_stream(make_mock, make_client):
+    mock = make_mock(delay=0, segments=1000)
+    client = make_client(api_url=mock.url)
+    job_id = client.transcribe(wav_bytes(), timeout=-1)
+    stream = client.wait_result(job_id, 5, stream=True)
+    texts = [segment["text"] for segment in stream]
+    assert len(texts) == 1000 and texts[0] == "segmento 0 da transcrição"
+    assert stream.job["id"] == job_id and job_id not in mock.jobs
+
+    job_id = client.transcribe(wav_bytes(), timeout=-1)
+    with client.wait_result(job_id, 5, stream=True) as stream:
+        next(iter(stream))
+    assert job_id in mock.jobs  # Not read to the end: kept on the server
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import time
+
+import gevent
+
+from cpqdtrd.tracker import JobTracker
+
+from conftest import wav_bytes
+
+
+def test_job_done_once_all_notices_arrive():
+    tracker = JobTracker()
+    tracker.add("a", ["__root__", "cb"])
+    event = tracker.waiter(tracker.get("a"))
+    assert tracker.signal("a", "cb") is not None
+    assert not event.is_set() and "a" in tracker
+    tracker.signal("a", "__root__")
+    assert event.is_set() and "a" not in tracker
+    assert tracker.signal("a", "__root__") is None
+
+
+def test_oldest_jobs_evicted_when_full():
+    evicted = []
+    tracker = JobTracker(max_jobs=2, on_evict=lambda job: evicted.append(job.job_id))
+    for job_id in "abc":
+        tracker.add(job_id, ["__root__"])
+    assert evicted == ["a"] and len(tracker) == 2
+
+
+def test_jobs_expire_after_ttl():
+    tracker = JobTracker(ttl=0.05)
+    job = tracker.add("a", ["__root__"])
+    event = tracker.waiter(job)
+    time.sleep(0.06)
+    tracker.expire()
+    assert job.evicted and event.is_set() and tracker.evicted == 1
+
+
+def test_watchers_notified_once():
+    tracker = JobTracker()
+    tracker.add("a", ["__root__"])
+    tracker.add("b", ["__root__"])
+    seen = []
+    notify = lambda job_id, evicted: seen.append((job_id, evicted))  # noqa: E731
+    tracker.watch(["a", "b", "unknown"], notify)
+    tracker.unwatch(["b"], notify)
+    tracker.signal("a", "__root__")
+    tracker.signal("b", "__root__")
+    assert seen == [("unknown", False), ("a", False)]
+
+
+def test_client_forgets_completed_jobs(client):
+    client.transcribe(wav_bytes())
+    assert len(client.jobs) == 0
+
+
+def test_stop_is_idempotent(make_client):
+    client = make_client()
+    client.stop()
+    client.stop()
+    client.__del__()
+    gevent.sleep(0)
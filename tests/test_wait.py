@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from cpqdtrd.api import TranscriptionApi
+
+from conftest import wav_bytes
+
+
+@pytest.fixture
+def slow_mock(make_mock):
+    # Processing takes as long as the audio
+    return make_mock(delay=0, rtf=1.0)
+
+
+def submit(client, *durations):
+    return [client.transcribe(wav_bytes(d), timeout=-1) for d in durations]
+
+
+def test_wait_any_returns_the_first_job(slow_mock, make_client):
+    client = make_client(api_url=slow_mock.url)
+    slow, fast = submit(client, 0.6, 0.1)
+    job_id, result = client.wait_any([slow, fast], timeout=5)
+    assert job_id == fast and result["job"]["id"] == fast
+    assert slow_mock.jobs[slow]  # Only the first result is collected
+    assert client.wait_any([slow], timeout=0.01) is False
+    assert client.wait_any([slow], timeout=5)[0] == slow
+    with pytest.raises(ValueError):
+        client.wait_any([])
+
+
+def test_as_completed_yields_in_completion_order(slow_mock, make_client):
+    client = make_client(api_url=slow_mock.url)
+    job_ids = submit(client, 0.5, 0.1, 0.3)
+    order = [job_id for job_id, _ in client.as_completed(job_ids, timeout=5)]
+    assert order == [job_ids[1], job_ids[2], job_ids[0]]
+    assert not slow_mock.jobs
+
+
+def test_deadline(slow_mock, make_client):
+    client = make_client(api_url=slow_mock.url)
+    fast, slow = submit(client, 0.1, 3.0)
+    items = client.as_completed([fast, slow], timeout=0.5)
+    assert next(items)[0] == fast
+    with pytest.raises(TranscriptionApi.TimeoutException):
+        next(items)
+    results = client.wait_all([slow, fast], timeout=0.5)
+    assert list(results) == [slow, fast] and results[slow] is False
+
+
+def test_evicted_jobs_are_errors(make_mock, make_client):
+    client = make_client(api_url=make_mock(delay=5).url, job_ttl=0.5)
+    (job_id,) = submit(client, 0.1)
+    with pytest.raises(TranscriptionApi.TimeoutException):
+        client.wait_any([job_id], timeout=5)